@@ -4,15 +4,50 @@ from __future__ import unicode_literals
 import json
 import os
 
+from urllib.parse import parse_qs
+
 from django.conf import settings
 
 from django.test import TestCase
 
 from webhook_receiver.models import JSONWebhookData
+from webhook_receiver.utils import reset_lms_clients
 
 from unittest.mock import Mock
 
 
+def bulk_enroll_callback(request, context, invalid=()):
+    """Build a bulk enrollment API response for a mock request,
+    flagging any identifiers in invalid as invalid."""
+    params = parse_qs(request.text)
+    courses = params['courses'][0].split(',')
+    identifiers = params['identifiers'][0].split(',')
+    results = []
+    for identifier in identifiers:
+        if identifier in invalid:
+            results.append({'identifier': identifier,
+                            'invalidIdentifier': True})
+        else:
+            results.append({'identifier': identifier,
+                            'before': {'enrollment': False,
+                                       'allowed': False,
+                                       'user': False,
+                                       'auto_enroll': False},
+                            'after': {'enrollment': False,
+                                      'allowed': True,
+                                      'user': False,
+                                      'auto_enroll': True}})
+    return {
+        'action': 'enroll',
+        'courses': dict((course, {'action': 'enroll',
+                                  'results': results,
+                                  'auto_enroll': True})
+                        for course in courses),
+        'email_students': True,
+        'auto_enroll': True,
+    }
+
+
 class WebhookTestCase(TestCase):
     """Abstract base class for webhook tests"""
     PAYLOAD_FILENAME = None
@@ -42,6 +77,10 @@ class WebhookTestCase(TestCase):
         course.id = self.COURSE_ID_STRING
 
     def setup_requests(self):
+        # Make sure we don't reuse an access token that a previous
+        # test has obtained.
+        reset_lms_clients()
+
         self.token_uri = '%s/oauth2/access_token' % settings.WEBHOOK_RECEIVER_LMS_BASE_URL  # noqa: E501
         self.enroll_uri = '%s/api/bulk_enroll/v1/bulk_enroll/' % settings.WEBHOOK_RECEIVER_LMS_BASE_URL  # noqa: E501
 
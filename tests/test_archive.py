@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+
+from datetime import timedelta
+from io import StringIO
+from unittest import skipUnless
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from webhook_receiver.archive import archive_webhooks, restore_webhook
+from webhook_receiver.archive import ArchiveException
+from webhook_receiver.models import JSONWebhookData, OutboxEntry
+from webhook_receiver.tasks import archive
+from webhook_receiver_shopify.models import ShopifyOrder
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class ArchiveTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.old = timezone.now() - timedelta(days=400)
+        self.webhooks = [self.create_webhook(i) for i in range(5)]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def create_webhook(self, i, received=None, status=None):
+        webhook = JSONWebhookData(
+            headers={'X-Shopify-Shop-Domain': 'example.com'},
+            body=('{"id": %d}' % i).encode('utf-8'),
+            content={'id': i},
+            source='127.0.0.1',
+            received=received or self.old,
+            status=JSONWebhookData.PROCESSED if status is None else status,
+        )
+        webhook.save()
+        return webhook
+
+    def create_order(self, i, webhook, status=ShopifyOrder.PROCESSED):
+        return ShopifyOrder.objects.create(id=i,
+                                           email='learner@example.com',
+                                           webhook=webhook,
+                                           status=status)
+
+    def test_archive(self):
+        recent = self.create_webhook(5, received=timezone.now())
+        failed = self.create_webhook(6, status=JSONWebhookData.ERROR)
+
+        count = archive_webhooks(self.directory, batch_size=2)
+        self.assertEqual(count, 5)
+
+        # Only the recent and the failed webhook should remain.
+        self.assertEqual(
+            set(JSONWebhookData.objects.values_list('id', flat=True)),
+            {recent.id, failed.id}
+        )
+        # 5 webhooks in batches of 2 make 3 archive files.
+        self.assertEqual(len(os.listdir(self.directory)), 3)
+
+    def test_archive_keeps_outbox(self):
+        OutboxEntry.objects.create(webhook=self.webhooks[0],
+                                   task='some.task')
+        archive_webhooks(self.directory)
+        self.assertEqual(JSONWebhookData.objects.get(), self.webhooks[0])
+
+    def test_archive_unlinks_orders(self):
+        order = self.create_order(1, self.webhooks[0])
+        archive_webhooks(self.directory)
+        order = ShopifyOrder.objects.get(id=order.id)
+        self.assertIsNone(order.webhook)
+
+    def test_archive_keeps_unprocessed_orders(self):
+        """Do we keep the webhooks of orders that we may still need
+        to process?"""
+        for i, status in enumerate((ShopifyOrder.NEW,
+                                    ShopifyOrder.PROCESSING,
+                                    ShopifyOrder.ERROR)):
+            self.create_order(i, self.webhooks[i], status)
+        self.create_order(3, self.webhooks[3])
+        self.create_order(4, self.webhooks[3], ShopifyOrder.ERROR)
+
+        self.assertEqual(archive_webhooks(self.directory), 1)
+        self.assertEqual(
+            set(JSONWebhookData.objects.values_list('id', flat=True)),
+            set(webhook.id for webhook in self.webhooks[:4])
+        )
+
+    def test_max_batches(self):
+        count = archive_webhooks(self.directory,
+                                 batch_size=2,
+                                 max_batches=1)
+        self.assertEqual(count, 2)
+        self.assertEqual(JSONWebhookData.objects.count(), 3)
+
+    def test_restore(self):
+        webhook = self.webhooks[3]
+        JSONWebhookData.objects.filter(id=webhook.id).update(
+            content_mode=JSONWebhookData.MINIMAL_CONTENT)
+        archive_webhooks(self.directory, batch_size=2)
+        restored = restore_webhook(webhook.id, self.directory)
+
+        restored = JSONWebhookData.objects.get(id=webhook.id)
+        self.assertEqual(restored.status, webhook.status)
+        self.assertEqual(restored.source, webhook.source)
+        self.assertEqual(restored.received, webhook.received)
+        self.assertEqual(restored.headers, webhook.headers)
+        self.assertEqual(bytes(restored.body), webhook.body)
+        self.assertEqual(restored.content, webhook.content)
+        self.assertEqual(restored.content_mode,
+                         JSONWebhookData.MINIMAL_CONTENT)
+
+    def test_restore_links_orders(self):
+        """Does restoring a webhook link the orders created from it to
+        it again?"""
+        order = self.create_order(1, self.webhooks[0])
+        other = self.create_order(2, self.webhooks[1])
+        archive_webhooks(self.directory)
+        restore_webhook(self.webhooks[0].id, self.directory)
+
+        order = ShopifyOrder.objects.get(id=order.id)
+        self.assertEqual(order.webhook_id, self.webhooks[0].id)
+        other = ShopifyOrder.objects.get(id=other.id)
+        self.assertIsNone(other.webhook)
+
+    def test_restore_missing(self):
+        archive_webhooks(self.directory)
+        with self.assertRaises(ArchiveException):
+            restore_webhook(self.webhooks[-1].id + 100, self.directory)
+
+    def test_restore_existing(self):
+        with self.assertRaises(ArchiveException):
+            restore_webhook(self.webhooks[0].id, self.directory)
+
+    @skipUnless(zstandard, 'zstandard is not installed')
+    def test_zstd(self):
+        archive_webhooks(self.directory, compression='zstd')
+        self.assertTrue(os.listdir(self.directory)[0].endswith('.zst'))
+        restore_webhook(self.webhooks[0].id, self.directory)
+
+    def test_unknown_compression(self):
+        with self.assertRaises(ArchiveException):
+            archive_webhooks(self.directory, compression='foo')
+
+    def test_task_disabled(self):
+        self.assertEqual(archive.delay().get(), 0)
+        self.assertEqual(JSONWebhookData.objects.count(), 5)
+
+    def test_task(self):
+        with override_settings(WEBHOOK_RECEIVER_ARCHIVE_DIR=self.directory):
+            self.assertEqual(archive.delay().get(), 5)
+
+    def test_commands(self):
+        out = StringIO()
+        call_command('archive_webhooks',
+                     directory=self.directory,
+                     dry_run=True,
+                     stdout=out)
+        self.assertIn('5 webhooks', out.getvalue())
+
+        call_command('archive_webhooks',
+                     directory=self.directory,
+                     stdout=StringIO())
+        self.assertFalse(JSONWebhookData.objects.exists())
+
+        call_command('restore_webhook',
+                     self.webhooks[0].id,
+                     directory=self.directory,
+                     stdout=StringIO())
+        self.assertTrue(
+            JSONWebhookData.objects.filter(id=self.webhooks[0].id).exists()
+        )
+
+        with self.assertRaises(CommandError):
+            call_command('restore_webhook',
+                         self.webhooks[0].id,
+                         directory=self.directory,
+                         stdout=StringIO())
@@ -0,0 +1,104 @@
+from __future__ import unicode_literals
+
+import time
+
+from django.test import TestCase, override_settings
+
+from webhook_receiver.cache import LocalLRUCache, SKUCache
+
+
+class LocalLRUCacheTest(TestCase):
+
+    def test_get_set(self):
+        cache = LocalLRUCache(2)
+        self.assertIsNone(cache.get('foo'))
+        cache.set('foo', 'bar', 60)
+        self.assertEqual(cache.get('foo'), 'bar')
+
+    def test_eviction(self):
+        # Do we evict the least recently used entry when full?
+        cache = LocalLRUCache(2)
+        cache.set('a', 1, 60)
+        cache.set('b', 2, 60)
+        cache.get('a')
+        cache.set('c', 3, 60)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_expiry(self):
+        cache = LocalLRUCache(2)
+        cache.set('foo', 'bar', 0.01)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('foo'))
+
+    def test_disabled(self):
+        cache = LocalLRUCache(0)
+        cache.set('foo', 'bar', 60)
+        self.assertIsNone(cache.get('foo'))
+
+
+@override_settings(CACHES={
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'test-sku-cache',
+    }
+})
+class SKUCacheTest(TestCase):
+
+    def setUp(self):
+        self.cache = SKUCache()
+        self.cache.shared.clear()
+
+    def test_miss(self):
+        self.assertIsNone(self.cache.get('foo'))
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_local_hit(self):
+        self.cache.set('foo', 'course-v1:org+course+run1')
+        self.assertEqual(self.cache.get('foo'), 'course-v1:org+course+run1')
+        self.assertEqual(self.cache.stats()['local_hits'], 1)
+
+    def test_shared_hit(self):
+        # A course ID that another process has cached should be
+        # found in the shared cache, and then in the local one.
+        other = SKUCache()
+        other.set('foo', 'course-v1:org+course+run1')
+        for i in range(2):
+            self.assertEqual(self.cache.get('foo'),
+                             'course-v1:org+course+run1')
+        self.assertEqual(self.cache.stats(), {'local_hits': 1,
+                                              'shared_hits': 1,
+                                              'misses': 0})
+
+    def test_not_found(self):
+        self.cache.set('foo', SKUCache.NOT_FOUND)
+        self.assertEqual(self.cache.get('foo'), SKUCache.NOT_FOUND)
+
+    @override_settings(WEBHOOK_RECEIVER_SKU_CACHE_NEGATIVE_TIMEOUT=0)
+    def test_not_found_disabled(self):
+        self.cache.set('foo', SKUCache.NOT_FOUND)
+        self.assertIsNone(self.cache.get('foo'))
+
+    def test_key_depends_on_lms(self):
+        key = self.cache.make_key('foo')
+        with self.settings(WEBHOOK_RECEIVER_LMS_BASE_URL='http://other'):
+            self.assertNotEqual(self.cache.make_key('foo'), key)
+        with self.settings(WEBHOOK_RECEIVER_SKU_PREFIX='sku/'):
+            self.assertNotEqual(self.cache.make_key('foo'), key)
+
+    @override_settings(WEBHOOK_RECEIVER_SKU_CACHE_LOCAL_TIMEOUT=0.01)
+    def test_delete_elsewhere(self):
+        # Another process deleting a SKU should reach our local tier
+        # once our entry expires.
+        self.cache.set('foo', 'course-v1:org+course+run1')
+        SKUCache().delete('foo')
+        time.sleep(0.02)
+        self.assertIsNone(self.cache.get('foo'))
+
+    def test_delete(self):
+        # Deleting a SKU should remove it from both tiers.
+        self.cache.set('foo', 'course-v1:org+course+run1')
+        self.cache.delete('foo')
+        self.assertIsNone(self.cache.get('foo'))
+        self.assertIsNone(self.cache.shared.get(self.cache.make_key('foo')))
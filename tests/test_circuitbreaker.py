@@ -0,0 +1,154 @@
+from __future__ import unicode_literals
+
+from unittest.mock import Mock, patch
+
+from django.conf import settings
+from django.core.cache import caches
+from django.test import TestCase, override_settings
+
+from webhook_receiver.circuitbreaker import CircuitBreaker, CircuitOpen
+from webhook_receiver.ratelimit import RateLimitExceeded
+from webhook_receiver.utils import LMSSession
+from webhook_receiver.utils import get_lms_client, reset_lms_clients
+
+import requests_mock
+
+from .test_ratelimit import FakeClock, LOCMEM_CACHES
+
+
+@override_settings(CACHES=LOCMEM_CACHES,
+                   WEBHOOK_RECEIVER_LMS_RATE_LIMIT=0,
+                   WEBHOOK_RECEIVER_LMS_BREAKER_FAILURE_RATE=0.5,
+                   WEBHOOK_RECEIVER_LMS_BREAKER_MIN_REQUESTS=4,
+                   WEBHOOK_RECEIVER_LMS_BREAKER_WINDOW=60,
+                   WEBHOOK_RECEIVER_LMS_BREAKER_COOLDOWN=30)
+class CircuitBreakerTest(TestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+        self.breaker = CircuitBreaker('http://lms.example.com')
+        self.clock = FakeClock(now=6000.0)
+        patcher = patch('webhook_receiver.circuitbreaker.time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def response(self, status_code):
+        return Mock(status_code=status_code)
+
+    def send(self, status_code):
+        probe = self.breaker.before_request()
+        response = self.response(status_code) if status_code else None
+        self.breaker.record(response, probe=probe)
+        return probe
+
+    def trip(self):
+        for status_code in (200, 200, 503, None):
+            self.send(status_code)
+        self.assertEqual(self.breaker.state(), CircuitBreaker.OPEN)
+
+    def test_open(self):
+        # Too few requests to judge the failure rate
+        for _ in range(3):
+            self.send(500)
+        self.assertEqual(self.breaker.state(), CircuitBreaker.CLOSED)
+        self.send(500)
+        self.assertEqual(self.breaker.state(), CircuitBreaker.OPEN)
+
+        self.clock.sleep(10)
+        with self.assertRaises(CircuitOpen) as context:
+            self.breaker.before_request()
+        self.assertEqual(context.exception.retry_after, 20)
+
+    def test_failure_rate(self):
+        for status_code in (200, 200, 200, 404, 500):
+            self.send(status_code)
+        self.assertEqual(self.breaker.state(), CircuitBreaker.CLOSED)
+        # 3 failures out of 7 requests
+        self.send(500)
+        self.send(500)
+        self.assertEqual(self.breaker.state(), CircuitBreaker.CLOSED)
+        # 4 failures out of 8 requests
+        self.send(500)
+        self.assertEqual(self.breaker.state(), CircuitBreaker.OPEN)
+
+    def test_window(self):
+        """Do failures from a past window count towards the rate?"""
+        for _ in range(3):
+            self.send(500)
+        self.clock.sleep(60)
+        self.send(500)
+        self.assertEqual(self.breaker.state(), CircuitBreaker.CLOSED)
+
+    def test_probe(self):
+        self.trip()
+        self.clock.sleep(30)
+        self.assertEqual(self.breaker.state(), CircuitBreaker.HALF_OPEN)
+
+        # Only one probe at a time
+        self.assertTrue(self.breaker.before_request())
+        with self.assertRaises(CircuitOpen):
+            self.breaker.before_request()
+
+        self.breaker.record(self.response(200), probe=True)
+        self.assertEqual(self.breaker.state(), CircuitBreaker.CLOSED)
+        self.assertFalse(self.send(200))
+
+    def test_failed_probe(self):
+        self.trip()
+        self.clock.sleep(30)
+        self.assertTrue(self.send(502))
+        self.assertEqual(self.breaker.state(), CircuitBreaker.OPEN)
+        with self.assertRaises(CircuitOpen):
+            self.breaker.before_request()
+
+    def test_rate_limited_probe(self):
+        """If the rate limiter holds back a probe, do we let another
+        one through?"""
+        self.trip()
+        self.clock.sleep(30)
+        limiter = Mock()
+        limiter.acquire.side_effect = RateLimitExceeded
+        session = LMSSession(limiter=limiter, breaker=self.breaker)
+        with requests_mock.Mocker() as m:
+            with self.assertRaises(RateLimitExceeded):
+                session.head('http://lms.example.com/foo')
+            self.assertEqual(m.call_count, 0)
+        session.close()
+        self.assertEqual(self.breaker.state(), CircuitBreaker.HALF_OPEN)
+        self.assertTrue(self.breaker.before_request())
+
+    def test_separate_circuits(self):
+        self.trip()
+        other = CircuitBreaker('http://other.example.com')
+        self.assertEqual(other.state(), CircuitBreaker.CLOSED)
+        self.assertFalse(other.before_request())
+
+    @override_settings(WEBHOOK_RECEIVER_LMS_BREAKER_FAILURE_RATE=0)
+    def test_disabled(self):
+        for _ in range(10):
+            self.send(None)
+        self.assertEqual(self.breaker.state(), CircuitBreaker.CLOSED)
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+    }})
+    def test_no_cache(self):
+        """Without a working cache, do we let requests through?"""
+        for _ in range(10):
+            self.send(None)
+        self.assertEqual(self.breaker.state(), CircuitBreaker.CLOSED)
+
+    def test_lms_client(self):
+        """Does the LMS client fail fast while the circuit is open?"""
+        reset_lms_clients()
+        self.addCleanup(reset_lms_clients)
+        url = '%s/foo' % settings.WEBHOOK_RECEIVER_LMS_BASE_URL
+        with requests_mock.Mocker() as m:
+            m.register_uri('HEAD', url, status_code=500)
+            for _ in range(4):
+                get_lms_client().head(url)
+            with self.assertRaises(CircuitOpen):
+                get_lms_client().head(url)
+            self.assertEqual(m.call_count, 4)
+        breaker = get_lms_client().session.breaker
+        self.assertEqual(breaker.state(), CircuitBreaker.OPEN)
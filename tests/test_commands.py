@@ -0,0 +1,465 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import os
+import shutil
+import tempfile
+
+from datetime import datetime
+from io import StringIO
+from unittest.mock import patch
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import TestCase, override_settings
+
+from webhook_receiver.cache import sku_cache
+from webhook_receiver.models import CompressedBinaryField
+from webhook_receiver.models import CourseMapping, JSONWebhookData
+from webhook_receiver.models import OutboxEntry
+from webhook_receiver_shopify.models import ShopifyOrder
+from webhook_receiver_shopify.models import ShopifyOrderItem
+from webhook_receiver_woocommerce.models import WooCommerceOrder
+from webhook_receiver_woocommerce.models import WooCommerceOrderItem
+
+import requests_mock
+
+from . import ShopifyTestCase, bulk_enroll_callback
+
+
+class ImportCourseMappingsTest(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        sku_cache.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, filename, content):
+        path = os.path.join(self.tmpdir, filename)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def assertMappings(self, expected):
+        self.assertEqual(
+            dict(CourseMapping.objects.values_list('sku', 'course_id')),
+            expected
+        )
+
+    def test_import_csv(self):
+        path = self.write('mappings.csv',
+                          'sku,course_id\n'
+                          'foo,course-v1:org+foo+run\n'
+                          '\n'
+                          '# A comment\n'
+                          'bar, course-v1:org+bar+run\n')
+        call_command('import_course_mappings', path, stdout=StringIO())
+        self.assertMappings({
+            'foo': 'course-v1:org+foo+run',
+            'bar': 'course-v1:org+bar+run',
+        })
+        self.assertEqual(
+            set(CourseMapping.objects.values_list('origin', flat=True)),
+            {CourseMapping.MANUAL}
+        )
+
+    def test_import_yaml_dict(self):
+        path = self.write('mappings.yml',
+                          'foo: course-v1:org+foo+run\n'
+                          'bar: course-v1:org+bar+run\n')
+        call_command('import_course_mappings', path, stdout=StringIO())
+        self.assertMappings({
+            'foo': 'course-v1:org+foo+run',
+            'bar': 'course-v1:org+bar+run',
+        })
+
+    def test_import_yaml_list(self):
+        path = self.write('mappings.txt',
+                          '- sku: foo\n'
+                          '  course_id: course-v1:org+foo+run\n')
+        call_command('import_course_mappings', path,
+                     format='yaml', stdout=StringIO())
+        self.assertMappings({
+            'foo': 'course-v1:org+foo+run',
+        })
+
+    def test_import_replaces(self):
+        # Importing a mapping for a SKU that we have already mapped
+        # should update the existing mapping, and forget any course
+        # ID we have cached for it.
+        CourseMapping.objects.create(sku='foo',
+                                     course_id='course-v1:org+foo+old',
+                                     origin=CourseMapping.RESOLVED)
+        sku_cache.set('foo', 'course-v1:org+foo+old')
+        path = self.write('mappings.csv',
+                          'foo,course-v1:org+foo+new\n')
+        out = StringIO()
+        call_command('import_course_mappings', path, stdout=out)
+        self.assertMappings({
+            'foo': 'course-v1:org+foo+new',
+        })
+        self.assertIsNone(sku_cache.get('foo'))
+        self.assertIn('1 new or changed', out.getvalue())
+
+    def test_import_invalid_course_id(self):
+        # A file with an invalid course ID should be rejected as a
+        # whole.
+        path = self.write('mappings.csv',
+                          'foo,course-v1:org+foo+run\n'
+                          'bar,not-a-course\n')
+        with self.assertRaises(CommandError):
+            call_command('import_course_mappings', path, stdout=StringIO())
+        self.assertMappings({})
+
+    def test_import_missing_file(self):
+        with self.assertRaises(CommandError):
+            call_command('import_course_mappings',
+                         os.path.join(self.tmpdir, 'nonexistent.csv'),
+                         stdout=StringIO())
+
+
+class WarmCourseMappingsTest(TestCase):
+
+    def setUp(self):
+        shopify_order = ShopifyOrder.objects.create(
+            id=1,
+            email='learner@example.com',
+        )
+        for sku in ('foo', 'bar', 'course-v1:org+baz+run'):
+            ShopifyOrderItem.objects.create(order=shopify_order,
+                                            sku=sku,
+                                            email='learner@example.com')
+        woocommerce_order = WooCommerceOrder.objects.create(
+            id=1,
+            email='learner@example.com',
+        )
+        for sku in ('foo', 'qux'):
+            WooCommerceOrderItem.objects.create(order=woocommerce_order,
+                                                sku=sku,
+                                                email='learner@example.com')
+
+    def register_sku(self, m, sku, course_id=None):
+        lookup_url = '%s/%s' % (settings.WEBHOOK_RECEIVER_LMS_BASE_URL,
+                                sku)
+        if course_id is None:
+            m.register_uri('HEAD', lookup_url, status_code=404)
+            return
+        found_url = '%s/courses/%s/about' % (settings.WEBHOOK_RECEIVER_LMS_BASE_URL,  # noqa: E501
+                                             course_id)
+        m.register_uri('HEAD',
+                       lookup_url,
+                       status_code=301,
+                       headers={'Location': found_url})
+        m.register_uri('HEAD',
+                       found_url,
+                       status_code=200)
+
+    def test_warm(self):
+        CourseMapping.objects.create(sku='bar',
+                                     course_id='course-v1:org+bar+run')
+        with requests_mock.Mocker() as m:
+            self.register_sku(m, 'foo', 'course-v1:org+foo+run')
+            self.register_sku(m, 'qux')
+            call_command('warm_course_mappings',
+                         stdout=StringIO(),
+                         stderr=StringIO())
+            # We should have looked up foo and qux (once each), but not
+            # bar, which was already mapped, nor the course ID.
+            lookups = [r.url for r in m.request_history
+                       if '/courses/' not in r.url]
+            self.assertEqual(len(lookups), 2)
+
+        self.assertEqual(
+            dict(CourseMapping.objects.values_list('sku', 'course_id')),
+            {
+                'foo': 'course-v1:org+foo+run',
+                'bar': 'course-v1:org+bar+run',
+            }
+        )
+
+    def test_dry_run(self):
+        out = StringIO()
+        with requests_mock.Mocker() as m:
+            call_command('warm_course_mappings', dry_run=True, stdout=out)
+            self.assertEqual(m.call_count, 0)
+        self.assertEqual(out.getvalue().split(), ['bar', 'foo', 'qux'])
+        self.assertFalse(CourseMapping.objects.exists())
+
+    def test_refresh(self):
+        # With --refresh, we should re-resolve previously resolved
+        # SKUs, but leave manual mappings alone.
+        CourseMapping.objects.create(sku='foo',
+                                     course_id='course-v1:org+foo+old',
+                                     origin=CourseMapping.RESOLVED)
+        CourseMapping.objects.create(sku='bar',
+                                     course_id='course-v1:org+bar+run',
+                                     origin=CourseMapping.MANUAL)
+        out = StringIO()
+        call_command('warm_course_mappings', refresh=True, dry_run=True,
+                     stdout=out)
+        self.assertEqual(out.getvalue().split(), ['foo', 'qux'])
+
+
+class StatusReportTest(TestCase):
+
+    def setUp(self):
+        for i in range(3):
+            ShopifyOrder.objects.create(id=i, email='learner@example.com')
+        order = ShopifyOrder.objects.get(id=0)
+        order.start_processing()
+        order.save()
+
+    def test_report(self):
+        out = StringIO()
+        call_command('status_report', stdout=out)
+        lines = out.getvalue().splitlines()
+        start = lines.index('webhook_receiver_shopify.ShopifyOrder')
+        new, processing, processed, error = lines[start + 1:start + 5]
+        self.assertEqual(new.split(), ['New', '2', '(oldest:',
+                                       new.split()[-1]])
+        self.assertEqual(processing.split()[:2], ['Processing', '1'])
+        self.assertEqual(processed.split(), ['Processed', '0'])
+        self.assertEqual(error.split(), ['Error', '0'])
+        self.assertIn('webhook_receiver.JSONWebhookData', lines)
+        self.assertIn('webhook_receiver_woocommerce.WooCommerceOrderItem',
+                      lines)
+
+    def test_explain(self):
+        out = StringIO()
+        call_command('status_report', explain=True, stdout=out)
+        self.assertIn('wr_shopify_order_status_recv', out.getvalue())
+
+
+class RecompressWebhooksTest(TestCase):
+
+    body = b'{"line_items": [%s]}' % b', '.join(
+        [b'{"sku": "course-v1:org+course+run1"}'] * 50
+    )
+
+    def stored_bodies(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT body FROM %s ORDER BY id' %
+                           JSONWebhookData._meta.db_table)
+            return [bytes(row[0]) for row in cursor.fetchall()]
+
+    def recompress(self, *args):
+        out = StringIO()
+        call_command('recompress_webhooks', *args, stdout=out)
+        return out.getvalue()
+
+    def test_recompress(self):
+        with override_settings(WEBHOOK_RECEIVER_BODY_COMPRESSION='none'):
+            for _ in range(3):
+                JSONWebhookData.objects.create(headers={}, body=self.body)
+            JSONWebhookData.objects.create(headers={}, body=b'{}')
+
+        output = self.recompress('--compression', 'zlib',
+                                 '--batch-size', '2')
+        self.assertIn('Examined 4 webhooks, rewrote 3.', output)
+        stored = self.stored_bodies()
+        for body in stored[:3]:
+            self.assertTrue(body.startswith(CompressedBinaryField.ZLIB_HEADER))
+        self.assertEqual(stored[3], b'{}')
+        for webhook in JSONWebhookData.objects.all()[:3]:
+            self.assertEqual(webhook.body, self.body)
+
+        # Running again has nothing left to do
+        output = self.recompress('--compression', 'zlib')
+        self.assertIn('Examined 4 webhooks, rewrote 0.', output)
+
+        # And we can go back
+        output = self.recompress('--compression', 'none')
+        self.assertIn('Examined 4 webhooks, rewrote 3.', output)
+        self.assertEqual(self.stored_bodies()[:3], [self.body] * 3)
+
+    def test_max_batches(self):
+        for _ in range(3):
+            JSONWebhookData.objects.create(headers={}, body=self.body)
+        output = self.recompress('--compression', 'zlib',
+                                 '--batch-size', '1', '--max-batches', '2')
+        self.assertIn('Examined 2 webhooks, rewrote 2.', output)
+
+
+class RetryOrdersTest(ShopifyTestCase):
+
+    def setUp(self):
+        self.setup_payload()
+        self.setup_webhook_data()
+        self.setup_requests()
+
+        customer = self.json_payload['customer']
+        self.order = ShopifyOrder.objects.create(
+            id=self.json_payload['id'],
+            webhook=self.webhook_data,
+            email=customer['email'],
+            first_name=customer['first_name'],
+            last_name=customer['last_name'],
+            received=datetime(2021, 3, 1),
+            status=ShopifyOrder.ERROR,
+            last_error='HTTPError: 503 Server Error',
+        )
+        item = self.json_payload['line_items'][0]
+        ShopifyOrderItem.objects.create(order=self.order,
+                                        sku=item['sku'],
+                                        email=item['properties'][0]['value'],
+                                        status=ShopifyOrderItem.ERROR)
+        ShopifyOrder.objects.create(id=1,
+                                    email='learner@example.com',
+                                    received=self.order.received,
+                                    status=ShopifyOrder.ERROR,
+                                    last_error='ValueError: Bad data')
+        WooCommerceOrder.objects.create(id=2,
+                                        email='learner@example.com',
+                                        status=WooCommerceOrder.ERROR)
+
+    def retry(self, *args):
+        out = StringIO()
+        call_command('retry_orders', *args, stdout=out)
+        return out.getvalue()
+
+    def test_dry_run(self):
+        output = self.retry('--dry-run')
+        self.assertIn('shopify: 1 failed orders to retry.', output)
+        self.assertIn('woocommerce: 0 failed orders to retry.', output)
+        # Orders 1 and 2 have no webhook.
+        self.assertIn('woocommerce: skipping 1 failed orders without a '
+                      'webhook', output)
+
+        output = self.retry('--dry-run', '--platform', 'shopify',
+                            '--error', 'HTTPError')
+        self.assertEqual(output, 'shopify: 1 failed orders to retry.\n')
+
+        output = self.retry('--dry-run', '--platform', 'shopify',
+                            '--since', '2021-03-02')
+        self.assertEqual(output, 'shopify: 0 failed orders to retry.\n')
+
+        output = self.retry('--dry-run', '--platform', 'shopify',
+                            '--since', '2021-02-28T12:00:00',
+                            '--until', '2021-03-02')
+        self.assertEqual(output, 'shopify: skipping 1 failed orders without '
+                         'a webhook; restore their webhooks with '
+                         'restore_webhook to retry them.\n'
+                         'shopify: 1 failed orders to retry.\n')
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(CommandError):
+            self.retry('--platform', 'magento')
+        with self.assertRaises(CommandError):
+            self.retry('--since', 'yesterday')
+
+    def test_retry(self):
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST',
+                           self.token_uri,
+                           json=self.token_response)
+            m.register_uri('POST',
+                           self.enroll_uri,
+                           json=bulk_enroll_callback)
+            output = self.retry('--platform', 'shopify',
+                                '--error', 'HTTPError',
+                                '--rate', '0')
+        self.assertEqual(output, 'shopify: scheduled 1 failed orders for '
+                         'processing.\n')
+
+        order = ShopifyOrder.objects.get(id=self.order.id)
+        self.assertEqual(order.status, ShopifyOrder.PROCESSED)
+        self.assertEqual(order.last_error, '')
+        self.assertEqual(
+            set(ShopifyOrderItem.objects.values_list('status', flat=True)),
+            {ShopifyOrderItem.PROCESSED}
+        )
+        self.assertEqual(ShopifyOrder.objects.get(id=1).status,
+                         ShopifyOrder.ERROR)
+
+    def test_retry_without_webhook(self):
+        """Do we skip orders that have no webhook to retry them from?"""
+        with patch('webhook_receiver_shopify.tasks.process.apply_async') as apply_async:  # noqa: E501
+            output = self.retry('--platform', 'shopify',
+                                '--error', 'ValueError',
+                                '--rate', '0')
+        apply_async.assert_not_called()
+        self.assertIn('shopify: skipping 1 failed orders without a '
+                      'webhook', output)
+        self.assertIn('shopify: scheduled 0 failed orders', output)
+        order = ShopifyOrder.objects.get(id=1)
+        self.assertEqual(order.status, ShopifyOrder.ERROR)
+        self.assertEqual(order.last_error, 'ValueError: Bad data')
+
+    def test_retry_records_error(self):
+        """Does an order that fails again record why?"""
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST',
+                           self.token_uri,
+                           json=self.token_response)
+            m.register_uri('POST',
+                           self.enroll_uri,
+                           status_code=500)
+            self.retry('--platform', 'shopify', '--error', 'HTTPError',
+                       '--rate', '0')
+
+        order = ShopifyOrder.objects.get(id=self.order.id)
+        self.assertEqual(order.status, ShopifyOrder.ERROR)
+        self.assertTrue(order.last_error.startswith('HTTPError: 500'))
+
+
+class BenchmarkWebhooksTest(TestCase):
+
+    def benchmark(self, *args):
+        out = StringIO()
+        call_command('benchmark_webhooks', '--use-existing-database',
+                     '--json', *args, stdout=out)
+        return [json.loads(line) for line in out.getvalue().splitlines()]
+
+    def test_benchmark(self):
+        results = self.benchmark('--count', '3', '--line-items', '1', '2')
+        self.assertEqual(len(results), 8)
+        for result in results:
+            self.assertEqual(result['count'], 3)
+            self.assertEqual(result['errors'], 0)
+            self.assertGreater(result['queries'], 0)
+        self.assertEqual(ShopifyOrder.objects.count(), 6)
+        self.assertEqual(WooCommerceOrder.objects.count(), 6)
+        self.assertEqual(
+            set(WooCommerceOrderItem.objects.values_list('status',
+                                                         flat=True)),
+            {WooCommerceOrderItem.PROCESSED}
+        )
+
+    def test_path(self):
+        """Do we benchmark the configured ingest path, unless told
+        otherwise, and report which one we benchmarked?"""
+        for outbox, args in ((settings.WEBHOOK_RECEIVER_OUTBOX, []),
+                             (True, ['--outbox']),
+                             (False, ['--no-outbox'])):
+            results = self.benchmark('--count', '2',
+                                     '--platform', 'shopify', *args)
+            for result in results:
+                self.assertEqual(result['outbox'], outbox)
+                self.assertEqual(result['count'], 2)
+                self.assertEqual(result['errors'], 0)
+        with override_settings(WEBHOOK_RECEIVER_OUTBOX=True):
+            results = self.benchmark('--count', '2',
+                                     '--platform', 'shopify')
+        for result in results:
+            self.assertTrue(result['outbox'])
+        self.assertEqual(
+            set(ShopifyOrder.objects.values_list('status', flat=True)),
+            {ShopifyOrder.PROCESSED}
+        )
+        self.assertFalse(OutboxEntry.objects.exists())
+
+    def test_sku_lookups(self):
+        results = self.benchmark('--count', '2', '--platform', 'shopify',
+                                 '--sku-lookups', '--allocations')
+        for result in results:
+            self.assertEqual(result['errors'], 0)
+            self.assertGreater(result['allocations'], 0)
+        self.assertEqual(
+            set(ShopifyOrderItem.objects.values_list('status', flat=True)),
+            {ShopifyOrderItem.PROCESSED}
+        )
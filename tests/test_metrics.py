@@ -0,0 +1,209 @@
+from __future__ import unicode_literals
+
+import threading
+
+from http.server import HTTPServer
+from unittest import skipUnless
+from unittest.mock import patch
+
+from django.conf import settings
+from django.core.cache import caches
+from django.test import Client, TestCase, override_settings
+
+from webhook_receiver.circuitbreaker import CircuitBreaker
+from webhook_receiver.utils import LMSSession
+from webhook_receiver.utils import get_lms_client, reset_lms_clients
+from webhook_receiver_shopify.tasks import flush_enrollments, process
+from webhook_receiver_shopify.utils import record_order
+
+import requests_mock
+
+from . import ShopifyTestCase, bulk_enroll_callback
+from .test_ratelimit import LOCMEM_CACHES
+from .test_utils import LMSRequestHandler
+
+try:
+    import prometheus_client
+    from webhook_receiver.metrics import registry
+except ImportError:
+    prometheus_client = None
+
+
+def get_sample(name, **labels):
+    return registry.get_sample_value(name, labels) or 0
+
+
+class MetricsDisabledTest(TestCase):
+
+    def test_not_found(self):
+        response = Client().get('/metrics')
+        self.assertEqual(response.status_code, 404)
+
+    @skipUnless(prometheus_client, 'prometheus_client is not installed')
+    def test_nothing_recorded(self):
+        labels = {'platform': 'shopify', 'status': '400'}
+        before = get_sample('webhook_receiver_webhooks_total', **labels)
+        response = Client().post('/webhooks/shopify/order/create', b'{}',
+                                 content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            get_sample('webhook_receiver_webhooks_total', **labels),
+            before)
+
+
+@skipUnless(prometheus_client, 'prometheus_client is not installed')
+@override_settings(WEBHOOK_RECEIVER_METRICS=True)
+class MetricsTest(ShopifyTestCase):
+
+    def setUp(self):
+        self.setup_payload()
+        self.setup_webhook_data()
+        self.setup_requests()
+        self.client = Client()
+
+    def test_export(self):
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'webhook_receiver_webhooks_total',
+                      response.content)
+        self.assertIn(b'webhook_receiver_lms_circuit_state'
+                      b'{state="closed"} 1.0',
+                      response.content)
+
+    @override_settings(CACHES=LOCMEM_CACHES,
+                       WEBHOOK_RECEIVER_LMS_BREAKER_FAILURE_RATE=0.5)
+    def test_circuit_state(self):
+        caches['default'].clear()
+        CircuitBreaker(settings.WEBHOOK_RECEIVER_LMS_BASE_URL).open()
+        response = self.client.get('/metrics')
+        self.assertIn(b'webhook_receiver_lms_circuit_state'
+                      b'{state="open"} 1.0',
+                      response.content)
+
+    def test_webhooks(self):
+        labels = {'platform': 'shopify', 'status': '400'}
+        before = get_sample('webhook_receiver_webhooks_total', **labels)
+        self.client.post('/webhooks/shopify/order/create', b'{}',
+                         content_type='application/json')
+        self.assertEqual(
+            get_sample('webhook_receiver_webhooks_total', **labels),
+            before + 1)
+
+    def test_webhook_steps(self):
+        labels = {'platform': 'shopify', 'step': 'receive'}
+        before = get_sample(
+            'webhook_receiver_webhook_duration_seconds_count', **labels)
+        self.client.post('/webhooks/shopify/order/create', b'{}',
+                         content_type='application/json')
+        self.assertEqual(
+            get_sample('webhook_receiver_webhook_duration_seconds_count',
+                       **labels),
+            before + 1)
+
+    def test_orders(self):
+        labels = {'platform': 'shopify', 'outcome': 'success'}
+        before = {
+            'orders': get_sample('webhook_receiver_orders_total', **labels),
+            'lag': get_sample('webhook_receiver_queue_lag_seconds_count',
+                              platform='shopify'),
+            'enroll': get_sample('webhook_receiver_lms_duration_seconds_count',
+                                 operation='enroll_in_course'),
+            'responses': get_sample('webhook_receiver_lms_responses_total',
+                                    status='200'),
+        }
+        order, created = record_order(self.webhook_data)
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST', self.token_uri, json=self.token_response)
+            m.register_uri('POST', self.enroll_uri,
+                           json=bulk_enroll_callback)
+            process.delay(order.id, self.webhook_data.id).get(5)
+
+        self.assertEqual(
+            get_sample('webhook_receiver_orders_total', **labels),
+            before['orders'] + 1)
+        self.assertEqual(
+            get_sample('webhook_receiver_queue_lag_seconds_count',
+                       platform='shopify'),
+            before['lag'] + 1)
+        self.assertEqual(
+            get_sample('webhook_receiver_lms_duration_seconds_count',
+                       operation='enroll_in_course'),
+            before['enroll'] + 2)
+        # One token request, and one enrollment request per line item
+        self.assertEqual(
+            get_sample('webhook_receiver_lms_responses_total',
+                       status='200'),
+            before['responses'] + 3)
+
+    @override_settings(CACHES=LOCMEM_CACHES,
+                       WEBHOOK_RECEIVER_BATCH_ENROLLMENTS=True,
+                       WEBHOOK_RECEIVER_BATCH_WINDOW=10)
+    def test_batched_orders(self):
+        """Do we count an order waiting for a batched enrollment as
+        successful only once it's enrolled?"""
+        caches['default'].clear()
+        labels = {'platform': 'shopify', 'outcome': 'success'}
+        before = get_sample('webhook_receiver_orders_total', **labels)
+        order, created = record_order(self.webhook_data)
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST', self.token_uri, json=self.token_response)
+            m.register_uri('POST', self.enroll_uri,
+                           json=bulk_enroll_callback)
+            with patch.object(flush_enrollments, 'apply_async'):
+                process.delay(order.id, self.webhook_data.id).get(5)
+            self.assertEqual(
+                get_sample('webhook_receiver_orders_total', **labels),
+                before)
+
+            flush_enrollments.delay().get(5)
+        self.assertEqual(
+            get_sample('webhook_receiver_orders_total', **labels),
+            before + 1)
+
+    def test_lms_errors(self):
+        reset_lms_clients()
+        self.addCleanup(reset_lms_clients)
+        url = '%s/foo' % settings.WEBHOOK_RECEIVER_LMS_BASE_URL
+        before = get_sample('webhook_receiver_lms_responses_total',
+                            status='404')
+        with requests_mock.Mocker() as m:
+            m.register_uri('HEAD', url, status_code=404)
+            get_lms_client().head(url)
+        self.assertEqual(
+            get_sample('webhook_receiver_lms_responses_total',
+                       status='404'),
+            before + 1)
+
+
+@skipUnless(prometheus_client, 'prometheus_client is not installed')
+@override_settings(WEBHOOK_RECEIVER_METRICS=True)
+class LMSConnectionMetricsTest(TestCase):
+
+    def setUp(self):
+        server = HTTPServer(('127.0.0.1', 0), LMSRequestHandler)
+        server.statuses = []
+        self.url = 'http://127.0.0.1:%s/' % server.server_port
+        thread = threading.Thread(target=server.serve_forever,
+                                  kwargs={'poll_interval': 0.01})
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+    def test_connections(self):
+        """Do we count new and reused connections to the LMS?"""
+        before = dict((c, get_sample('webhook_receiver_lms_connections_total',
+                                     connection=c))
+                      for c in ('new', 'reused'))
+        session = LMSSession()
+        self.addCleanup(session.close)
+        for i in range(3):
+            session.head(self.url)
+        self.assertEqual(
+            get_sample('webhook_receiver_lms_connections_total',
+                       connection='new'),
+            before['new'] + 1)
+        self.assertEqual(
+            get_sample('webhook_receiver_lms_connections_total',
+                       connection='reused'),
+            before['reused'] + 2)
@@ -3,12 +3,15 @@
 from __future__ import unicode_literals
 
 import datetime
+import json
+import unittest
 
-from django.test import TestCase
-from django.db import DatabaseError, IntegrityError
+from django.test import TestCase, override_settings
+from django.db import DatabaseError, IntegrityError, connection
 
 from django_fsm import TransitionNotAllowed
 
+from webhook_receiver.models import CompressedBinaryField, JSONWebhookData
 from webhook_receiver_shopify.models import ShopifyOrder as Order
 from webhook_receiver_shopify.models import ShopifyOrderItem as OrderItem
 
@@ -161,3 +164,64 @@ class TestOrderItem(TestCase):
         # Do we fail on a state transition that the FSM disallows?
         with self.assertRaises(TransitionNotAllowed):
             self.order_item.finish_processing()
+
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class TestCompressedBinaryField(TestCase):
+
+    body = json.dumps({'line_items': [{'sku': 'course-v1:org+course+run1'}
+                                      for _ in range(50)]}).encode()
+
+    def stored_body(self, webhook):
+        # Bypass the field, to see what's actually in the database
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT body FROM %s WHERE id = %%s' %
+                           JSONWebhookData._meta.db_table, [webhook.id])
+            return bytes(cursor.fetchone()[0])
+
+    def roundtrip(self):
+        webhook = JSONWebhookData.objects.create(headers={},
+                                                 body=self.body)
+        self.assertEqual(webhook.body, self.body)
+        self.assertEqual(JSONWebhookData.objects.get(id=webhook.id).body,
+                         self.body)
+        return self.stored_body(webhook)
+
+    @override_settings(WEBHOOK_RECEIVER_BODY_COMPRESSION='none')
+    def test_uncompressed(self):
+        self.assertEqual(self.roundtrip(), self.body)
+
+    @override_settings(WEBHOOK_RECEIVER_BODY_COMPRESSION='zlib')
+    def test_zlib(self):
+        stored = self.roundtrip()
+        self.assertTrue(stored.startswith(CompressedBinaryField.ZLIB_HEADER))
+        self.assertLess(len(stored), len(self.body))
+
+    @unittest.skipUnless(zstandard, 'requires zstandard')
+    @override_settings(WEBHOOK_RECEIVER_BODY_COMPRESSION='zstd')
+    def test_zstd(self):
+        stored = self.roundtrip()
+        self.assertTrue(stored.startswith(CompressedBinaryField.ZSTD_HEADER))
+        self.assertLess(len(stored), len(self.body))
+
+    @override_settings(WEBHOOK_RECEIVER_BODY_COMPRESSION='zlib')
+    def test_incompressible(self):
+        # Bodies that compression doesn't make any smaller are stored
+        # as is
+        self.body = b'{}'
+        self.assertEqual(self.roundtrip(), self.body)
+
+    def test_read_after_changing_compression(self):
+        with override_settings(WEBHOOK_RECEIVER_BODY_COMPRESSION='zlib'):
+            webhook = JSONWebhookData.objects.create(headers={},
+                                                     body=self.body)
+        with override_settings(WEBHOOK_RECEIVER_BODY_COMPRESSION='none'):
+            self.assertEqual(
+                JSONWebhookData.objects.get(id=webhook.id).body,
+                self.body
+            )
@@ -0,0 +1,128 @@
+from __future__ import unicode_literals
+
+import json
+
+from unittest.mock import patch
+
+from django.conf import settings
+from django.test import Client, TestCase, override_settings
+
+from webhook_receiver.benchmark import get_shopify_headers
+from webhook_receiver.benchmark import make_shopify_payload
+from webhook_receiver.profiling import Profile, get_profile, profiled
+
+
+PROFILER_MIDDLEWARE = 'webhook_receiver.profiling.ProfilerMiddleware'
+
+
+# The settings only install the middleware if profiling is configured.
+@override_settings(WEBHOOK_RECEIVER_OUTBOX=True,
+                   MIDDLEWARE=[PROFILER_MIDDLEWARE] + settings.MIDDLEWARE)
+class ProfilerMiddlewareTest(TestCase):
+
+    def setUp(self):
+        self.client = Client()
+
+    def post_webhook(self, **extra):
+        body = json.dumps(make_shopify_payload(1, 1)).encode('utf-8')
+        extra.update(get_shopify_headers(body))
+        return self.client.post('/webhooks/shopify/order/create', body,
+                                content_type='application/json',
+                                **extra)
+
+    def test_disabled(self):
+        with patch('webhook_receiver.profiling.logger') as logger:
+            response = self.post_webhook(HTTP_X_PROFILE='1')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Server-Timing', response)
+        logger.info.assert_not_called()
+
+    @override_settings(WEBHOOK_RECEIVER_PROFILE=True)
+    def test_log(self):
+        with self.assertLogs('webhook_receiver.profiling') as logs:
+            response = self.post_webhook()
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Server-Timing', response)
+        self.assertEqual(len(logs.output), 1)
+        message = logs.output[0]
+        self.assertIn('Profile of POST /webhooks/shopify/order/create '
+                      '(200): sql=', message)
+        for step in ('parse', 'receive', 'hmac', 'enqueue', 'total'):
+            self.assertIn(' %s=' % step, message)
+
+    @override_settings(WEBHOOK_RECEIVER_PROFILE_HEADER='X-Profile',
+                       WEBHOOK_RECEIVER_PROFILE_SECRET='s3cret')
+    def test_header(self):
+        with self.assertLogs('webhook_receiver.profiling'):
+            response = self.post_webhook(HTTP_X_PROFILE='s3cret')
+        self.assertEqual(response.status_code, 200)
+        timing = response['Server-Timing']
+        self.assertRegex(timing, r'^sql;dur=[0-9.]+;desc="[1-9][0-9]* '
+                         r'queries", ')
+        self.assertIn('hmac;dur=', timing)
+        self.assertIn('total;dur=', timing)
+
+    @override_settings(WEBHOOK_RECEIVER_PROFILE_HEADER='X-Profile',
+                       WEBHOOK_RECEIVER_PROFILE_SECRET='s3cret')
+    def test_header_missing(self):
+        response = self.post_webhook()
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Server-Timing', response)
+
+    @override_settings(WEBHOOK_RECEIVER_PROFILE_HEADER='X-Profile',
+                       WEBHOOK_RECEIVER_PROFILE_SECRET='s3cret')
+    def test_header_wrong_secret(self):
+        with patch('webhook_receiver.profiling.logger') as logger:
+            response = self.post_webhook(HTTP_X_PROFILE='1')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Server-Timing', response)
+        logger.info.assert_not_called()
+
+    @override_settings(WEBHOOK_RECEIVER_PROFILE_HEADER='X-Profile')
+    def test_header_without_secret(self):
+        """Is the header ignored unless there is a secret?"""
+        with patch('webhook_receiver.profiling.logger') as logger:
+            response = self.post_webhook(HTTP_X_PROFILE='1')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Server-Timing', response)
+        logger.info.assert_not_called()
+
+    @override_settings(WEBHOOK_RECEIVER_PROFILE=True,
+                       WEBHOOK_RECEIVER_PROFILE_HEADER='X-Profile',
+                       WEBHOOK_RECEIVER_PROFILE_SECRET='s3cret')
+    def test_other_paths(self):
+        response = self.client.get('/admin/login/', HTTP_X_PROFILE='s3cret')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Server-Timing', response)
+
+    @override_settings(WEBHOOK_RECEIVER_PROFILE=True)
+    def test_profile_reset(self):
+        self.post_webhook()
+        self.assertIsNone(get_profile())
+
+
+class ProfilerSettingsTest(TestCase):
+
+    def test_not_installed(self):
+        """Is the middleware left out unless profiling is
+        configured?"""
+        self.assertFalse(settings.WEBHOOK_RECEIVER_PROFILE)
+        self.assertNotIn(PROFILER_MIDDLEWARE, settings.MIDDLEWARE)
+
+
+class ProfileTest(TestCase):
+
+    def test_format(self):
+        profile = Profile()
+        profile.queries = 3
+        profile.query_time = 0.002
+        profile.add('hmac', 0.0005)
+        profile.add('hmac', 0.0005)
+        self.assertEqual(profile.format(), 'sql=3/2.0ms hmac=1.0ms')
+        self.assertEqual(profile.server_timing(),
+                         'sql;dur=2.0;desc="3 queries", hmac;dur=1.0')
+
+    def test_profiled_without_profile(self):
+        with profiled('step'):
+            pass
+        self.assertIsNone(get_profile())
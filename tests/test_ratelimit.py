@@ -0,0 +1,151 @@
+from __future__ import unicode_literals
+
+from unittest.mock import Mock, patch
+
+from django.conf import settings
+from django.core.cache import caches
+from django.test import TestCase, override_settings
+
+from webhook_receiver.ratelimit import AdaptiveRateLimiter
+from webhook_receiver.ratelimit import RateLimitExceeded
+from webhook_receiver.utils import get_lms_client, reset_lms_clients
+
+import requests_mock
+
+
+LOCMEM_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+
+DUMMY_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+    },
+}
+
+
+class FakeClock(object):
+    """Stand-in for the time module, whose clock only advances when
+    we sleep."""
+
+    def __init__(self, now=1000.5):
+        self.now = now
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@override_settings(CACHES=LOCMEM_CACHES,
+                   WEBHOOK_RECEIVER_LMS_RATE_LIMIT=4,
+                   WEBHOOK_RECEIVER_LMS_RATE_LIMIT_MIN=1,
+                   WEBHOOK_RECEIVER_LMS_RATE_LIMIT_INCREASE=1,
+                   WEBHOOK_RECEIVER_LMS_RATE_LIMIT_DECREASE=0.5,
+                   WEBHOOK_RECEIVER_LMS_RATE_LIMIT_MAX_WAIT=0)
+class AdaptiveRateLimiterTest(TestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+        self.limiter = AdaptiveRateLimiter('http://lms.example.com')
+        self.clock = FakeClock()
+        patcher = patch('webhook_receiver.ratelimit.time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def response(self, status_code):
+        return Mock(status_code=status_code)
+
+    def test_limit(self):
+        for _ in range(4):
+            self.limiter.acquire()
+        with self.assertRaises(RateLimitExceeded):
+            self.limiter.acquire()
+
+    @override_settings(WEBHOOK_RECEIVER_LMS_RATE_LIMIT_MAX_WAIT=1)
+    def test_wait(self):
+        """Do we wait for the next second, if we may?"""
+        for _ in range(5):
+            self.limiter.acquire()
+        self.assertEqual(self.clock.sleeps, [0.5])
+
+    def test_separate_limits(self):
+        for _ in range(4):
+            self.limiter.acquire()
+        AdaptiveRateLimiter('http://other.example.com').acquire()
+
+    def test_adapt(self):
+        self.limiter.record(self.response(503))
+        self.assertEqual(self.limiter.get_rate(), 2)
+        self.limiter.record(self.response(429))
+        self.assertEqual(self.limiter.get_rate(), 1)
+        self.limiter.record(None)
+        self.assertEqual(self.limiter.get_rate(), 1)
+
+        self.limiter.acquire()
+        with self.assertRaises(RateLimitExceeded):
+            self.limiter.acquire()
+
+        # Client errors don't mean the LMS is overloaded
+        for _ in range(5):
+            self.limiter.record(self.response(404))
+        self.assertEqual(self.limiter.get_rate(), 4)
+
+    @override_settings(WEBHOOK_RECEIVER_LMS_RATE_LIMIT=0)
+    def test_disabled(self):
+        for _ in range(10):
+            self.limiter.acquire()
+        self.limiter.record(self.response(503))
+        self.assertIsNone(caches['default'].get(
+            self.limiter.make_key('rate')))
+
+    @override_settings(CACHES=DUMMY_CACHES)
+    def test_no_cache(self):
+        """Without a working cache, do we let requests through, and
+        only warn about it once?"""
+        with patch('webhook_receiver.ratelimit.logger') as logger:
+            for _ in range(10):
+                self.limiter.acquire()
+                self.limiter.record(self.response(503))
+        logger.warning.assert_called_once_with(
+            'Not limiting the rate of requests to http://lms.example.com, '
+            'which requires a shared cache')
+
+    @override_settings(WEBHOOK_RECEIVER_LMS_RATE_LIMITS={
+        'http://lms.example.com/': 2,
+        'http://other.example.com': 0,
+    })
+    def test_per_url_limits(self):
+        """Do limits for individual LMSs override the default?"""
+        self.assertEqual(self.limiter.get_rate(), 2)
+        for _ in range(2):
+            self.limiter.acquire()
+        with self.assertRaises(RateLimitExceeded):
+            self.limiter.acquire()
+        for _ in range(5):
+            self.limiter.record(self.response(200))
+        self.assertEqual(self.limiter.get_rate(), 2)
+
+        other = AdaptiveRateLimiter('http://other.example.com')
+        self.assertFalse(other.enabled)
+        third = AdaptiveRateLimiter('http://third.example.com')
+        self.assertEqual(third.get_rate(), 4)
+
+    def test_lms_client(self):
+        """Does the LMS client report responses to its limiter?"""
+        reset_lms_clients()
+        self.addCleanup(reset_lms_clients)
+        url = '%s/foo' % settings.WEBHOOK_RECEIVER_LMS_BASE_URL
+        with requests_mock.Mocker() as m:
+            m.register_uri('HEAD', url, status_code=503)
+            get_lms_client().head(url)
+        limiter = get_lms_client().session.limiter
+        self.assertEqual(limiter.get_rate(), 2)
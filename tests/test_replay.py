@@ -0,0 +1,128 @@
+from __future__ import unicode_literals
+
+import json
+
+from io import StringIO
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+
+from webhook_receiver.models import JSONWebhookData
+from webhook_receiver.replay import iter_webhooks
+from webhook_receiver.utils import hmac_is_valid
+
+import requests_mock
+
+
+TARGET = 'http://receiver.example.com'
+
+
+class ReplayWebhooksTest(TestCase):
+
+    def setUp(self):
+        self.shopify = self.store({
+            'Host': 'webhooks.example.com',
+            'Content-Type': 'application/json',
+            'X-Shopify-Hmac-Sha256': 'production-signature',
+            'X-Shopify-Shop-Domain': 'shop.example.com',
+            'X-Shopify-Webhook-Id': 'delivery-1',
+        }, {'id': 1})
+        self.woocommerce = self.store({
+            'Content-Type': 'application/json',
+            'X-Wc-Webhook-Signature': 'production-signature',
+            'X-Wc-Webhook-Source': 'https://shop.example.com/',
+            'X-Wc-Webhook-Delivery-Id': '17',
+        }, {'id': 2}, status=JSONWebhookData.ERROR)
+        # Not from any platform we know
+        self.store({'Content-Type': 'application/json'}, {'id': 3})
+
+    def store(self, headers, payload, status=JSONWebhookData.PROCESSED):
+        body = json.dumps(payload).encode('utf-8')
+        return JSONWebhookData.objects.create(headers=headers, body=body,
+                                              status=status)
+
+    def replay(self, *args):
+        if not any(arg.endswith('secret') for arg in args):
+            args = ('--secret', 'test') + args
+        out = StringIO()
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST', requests_mock.ANY, status_code=200)
+            call_command('replay_webhooks', TARGET, '--json', *args,
+                         stdout=out)
+        return json.loads(out.getvalue()), m.request_history
+
+    def test_replay(self):
+        summary, requests = self.replay('--concurrency', '2',
+                                        '--shop-domain', 'test.example.com')
+        self.assertEqual(summary['count'], 2)
+        self.assertEqual(summary['errors'], 0)
+        self.assertEqual(summary['statuses'], {'200': 2})
+
+        requests = dict((r.url, r) for r in requests)
+        request = requests[TARGET + '/webhooks/shopify/order/create']
+        self.assertEqual(request.body, bytes(self.shopify.body))
+        self.assertTrue(hmac_is_valid('test', request.body,
+                                      request.headers['X-Shopify-Hmac-Sha256']))  # noqa: E501
+        self.assertEqual(request.headers['X-Shopify-Shop-Domain'],
+                         'test.example.com')
+        self.assertNotEqual(request.headers['X-Shopify-Webhook-Id'],
+                            'delivery-1')
+        self.assertNotEqual(request.headers.get('Host'),
+                            'webhooks.example.com')
+
+        request = requests[TARGET + '/webhooks/woocommerce/order/create']
+        self.assertTrue(hmac_is_valid('test', request.body,
+                                      request.headers['X-Wc-Webhook-Signature']))  # noqa: E501
+        self.assertEqual(request.headers['X-Wc-Webhook-Source'],
+                         'https://shop.example.com/')
+
+    def test_secrets(self):
+        """Do we sign webhooks with the secret for their platform?"""
+        summary, requests = self.replay('--shopify-secret', 'shopify',
+                                        '--secret', 'other')
+        self.assertEqual(summary['count'], 2)
+        requests = dict((r.url, r) for r in requests)
+        request = requests[TARGET + '/webhooks/shopify/order/create']
+        self.assertTrue(hmac_is_valid('shopify', request.body,
+                                      request.headers['X-Shopify-Hmac-Sha256']))  # noqa: E501
+        request = requests[TARGET + '/webhooks/woocommerce/order/create']
+        self.assertTrue(hmac_is_valid('other', request.body,
+                                      request.headers['X-Wc-Webhook-Signature']))  # noqa: E501
+
+        # We only need secrets for the platforms we replay.
+        summary, requests = self.replay('--woocommerce-secret', 'wc',
+                                        '--platform', 'woocommerce')
+        self.assertEqual(summary['count'], 1)
+        self.assertTrue(hmac_is_valid('wc', requests[0].body,
+                                      requests[0].headers['X-Wc-Webhook-Signature']))  # noqa: E501
+
+        with self.assertRaises(CommandError):
+            self.replay('--woocommerce-secret', 'wc')
+
+    def test_platform_query(self):
+        """Do we only load webhooks from the platforms we replay?"""
+        with self.assertNumQueries(2):
+            webhooks = list(iter_webhooks(platforms=['woocommerce'],
+                                          batch_size=1))
+        self.assertEqual(webhooks, [(self.woocommerce, 'woocommerce')])
+
+    def test_filters(self):
+        summary, requests = self.replay('--platform', 'woocommerce',
+                                        '--keep-delivery-ids')
+        self.assertEqual(summary['count'], 1)
+        self.assertEqual(requests[0].headers['X-Wc-Webhook-Delivery-Id'],
+                         '17')
+
+        summary, requests = self.replay('--status', 'processed')
+        self.assertEqual(summary['count'], 1)
+        self.assertTrue(requests[0].url.endswith('/shopify/order/create'))
+
+        summary, requests = self.replay('--since', '2100-01-01')
+        self.assertEqual(summary['count'], 0)
+
+    def test_rate(self):
+        summary, requests = self.replay('--rate', '20', '--limit', '2')
+        self.assertEqual(summary['count'], 2)
+        # The second request waits for 1/20 s.
+        self.assertLessEqual(summary['rate'], 40)
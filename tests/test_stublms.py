@@ -0,0 +1,54 @@
+from __future__ import unicode_literals
+
+import threading
+
+from django.test import TestCase, override_settings
+
+from requests.exceptions import HTTPError
+
+from webhook_receiver.stublms import StubLMS, StubLMSServer
+from webhook_receiver.utils import enroll_in_course, get_lms_client
+from webhook_receiver.utils import lookup_course_id, reset_lms_clients
+
+
+class StubLMSServerTest(TestCase):
+
+    def start(self, **kwargs):
+        self.lms = StubLMS(**kwargs)
+        server = StubLMSServer(('127.0.0.1', 0), self.lms)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        reset_lms_clients()
+        self.addCleanup(reset_lms_clients)
+        settings = override_settings(WEBHOOK_RECEIVER_LMS_BASE_URL=server.url,
+                                     WEBHOOK_RECEIVER_LMS_MAX_RETRIES=0)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_enrollment(self):
+        self.start()
+        self.assertEqual(lookup_course_id('SKU1'), 'course-v1:org+SKU1+run')
+        enroll_in_course('course-v1:org+SKU1+run', 'learner@example.com')
+        # Token, SKU redirect, course page, and enrollment
+        self.assertEqual(self.lms.requests, 4)
+        self.assertEqual(get_lms_client().token_requests, 1)
+
+    def test_errors(self):
+        self.start(error_rate=1)
+        with self.assertRaises(HTTPError) as context:
+            get_lms_client().get_access_token()
+        self.assertEqual(context.exception.response.status_code, 503)
+
+    def test_rate_limit(self):
+        self.start(rate_limit=1)
+        url = '%s/courses/course-v1:org+course+run/about' % (
+            get_lms_client().base_url)
+        statuses = [get_lms_client().head(url).status_code
+                    for _ in range(3)]
+        # We may just have crossed into the next second.
+        self.assertIn(429, statuses)
+        self.assertEqual(statuses[0], 200)
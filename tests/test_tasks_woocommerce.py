@@ -3,17 +3,27 @@ from __future__ import unicode_literals
 
 import json
 
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.core.cache import caches
+from django.test import override_settings
+from django.utils import timezone
+
 from requests.exceptions import HTTPError
 
 from webhook_receiver.models import JSONWebhookData
+from webhook_receiver.tasks import reap
 
 from webhook_receiver_woocommerce.models import WooCommerceOrder as Order
-from webhook_receiver_woocommerce.tasks import process
-from webhook_receiver_woocommerce.utils import record_order
+from webhook_receiver_woocommerce.models import WooCommerceOrderItem as OrderItem  # noqa: E501
+from webhook_receiver_woocommerce.tasks import process, flush_enrollments
+from webhook_receiver_woocommerce.utils import record_order, process_order
 
 import requests_mock
 
-from . import WooCommerceTestCase
+from . import WooCommerceTestCase, bulk_enroll_callback
+from .test_ratelimit import DUMMY_CACHES, LOCMEM_CACHES
 
 
 class ProcessOrderTest(WooCommerceTestCase):
@@ -42,7 +52,7 @@ class ProcessOrderTest(WooCommerceTestCase):
                            self.enroll_uri,
                            status_code=400)
             with self.assertRaises(HTTPError):
-                result = process.delay(fixup_json_payload)
+                result = process.delay(order.id, fixup_webhook_data.id)
                 result.get(5)
 
         self.assertEqual(result.state, 'FAILURE')
@@ -96,7 +106,7 @@ class ProcessOrderTest(WooCommerceTestCase):
             m.register_uri('POST',
                            self.enroll_uri,
                            json=enrollment_response)
-            result = process.delay(self.json_payload)
+            result = process.delay(order.id, self.webhook_data.id)
             result.get(5)
 
         self.assertEqual(result.state, 'SUCCESS')
@@ -106,6 +116,69 @@ class ProcessOrderTest(WooCommerceTestCase):
         order = Order.objects.get(pk=order.id)
         self.assertEqual(order.status, Order.PROCESSED)
 
+    def test_legacy_payload(self):
+        """Do we still process task messages that carry the full
+        webhook payload, as queued by earlier versions?"""
+        order, created = record_order(self.webhook_data)
+
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST',
+                           self.token_uri,
+                           json=self.token_response)
+            m.register_uri('POST',
+                           self.enroll_uri,
+                           json=bulk_enroll_callback)
+            result = process.delay(self.json_payload, False)
+            result.get(5)
+
+        self.assertEqual(result.state, 'SUCCESS')
+
+        order = Order.objects.get(pk=order.id)
+        self.assertEqual(order.status, Order.PROCESSED)
+
+    def test_later_webhook(self):
+        """If we're asked to process an order from a webhook other
+        than the one that created it, do we use that webhook's
+        payload?"""
+        webhook_data = JSONWebhookData(headers={},
+                                       body=b'',
+                                       content={})
+        webhook_data.save()
+        order, created = record_order(self.webhook_data)
+        order.webhook = webhook_data
+        order.save()
+
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST',
+                           self.token_uri,
+                           json=self.token_response)
+            m.register_uri('POST',
+                           self.enroll_uri,
+                           json=bulk_enroll_callback)
+            result = process.delay(order.id, self.webhook_data.id)
+            result.get(5)
+            self.assertTrue(m.called)
+
+        order = Order.objects.get(pk=order.id)
+        self.assertEqual(order.status, Order.PROCESSED)
+
+    def test_missing_webhook(self):
+        """Do we fail an order whose webhook is gone, rather than
+        leaving it new?"""
+        order, created = record_order(self.webhook_data)
+        webhook_id = self.webhook_data.id
+        # Archiving the webhook unlinks the order from it.
+        self.webhook_data.delete()
+
+        for args in ((order.id, None, False), (order.id, webhook_id, False)):
+            result = process.apply(args)
+            self.assertTrue(result.failed())
+            order = Order.objects.get(pk=order.id)
+            self.assertEqual(order.status, Order.ERROR)
+            self.assertTrue(order.last_error.startswith(
+                'MissingWebhookException: Order %s has no webhook' % order.id))
+            Order.objects.filter(pk=order.id).update(status=Order.NEW)
+
     def test_order_collision(self):
         order, created = record_order(self.webhook_data)
 
@@ -144,9 +217,9 @@ class ProcessOrderTest(WooCommerceTestCase):
             m.register_uri('POST',
                            self.enroll_uri,
                            json=enrollment_response)
-            result1 = process.delay(self.json_payload)
-            result2 = process.delay(self.json_payload)
-            result3 = process.delay(self.json_payload)
+            result1 = process.delay(order.id, self.webhook_data.id)
+            result2 = process.delay(order.id, self.webhook_data.id)
+            result3 = process.delay(order.id, self.webhook_data.id)
             result1.get(5)
             result2.get(5)
             result3.get(5)
@@ -159,3 +232,179 @@ class ProcessOrderTest(WooCommerceTestCase):
         # because of the FSM-protected status field)
         order = Order.objects.get(pk=order.id)
         self.assertEqual(order.status, Order.PROCESSED)
+
+
+@override_settings(CACHES=LOCMEM_CACHES,
+                   WEBHOOK_RECEIVER_BATCH_ENROLLMENTS=True,
+                   WEBHOOK_RECEIVER_BATCH_WINDOW=10)
+class BatchWindowTest(WooCommerceTestCase):
+
+    def setUp(self):
+        self.setup_payload()
+        self.setup_webhook_data()
+        self.setup_requests()
+        caches['default'].clear()
+
+    def test_valid_order(self):
+        order, created = record_order(self.webhook_data)
+
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST',
+                           self.token_uri,
+                           json=self.token_response)
+            m.register_uri('POST',
+                           self.enroll_uri,
+                           json=bulk_enroll_callback)
+            # In always-eager mode, the flush_enrollments task runs
+            # right away rather than at the end of the batch window.
+            result = process.delay(order.id, self.webhook_data.id)
+            result.get(5)
+
+        self.assertEqual(result.state, 'SUCCESS')
+
+        order = Order.objects.get(pk=order.id)
+        self.assertEqual(order.status, Order.PROCESSED)
+
+    @override_settings(CACHES=DUMMY_CACHES)
+    def test_dummy_cache(self):
+        """Without a shared cache, do we enroll each order's line
+        items right away, rather than leaving them for a flush?"""
+        order, created = record_order(self.webhook_data)
+
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST',
+                           self.token_uri,
+                           json=self.token_response)
+            m.register_uri('POST',
+                           self.enroll_uri,
+                           json=bulk_enroll_callback)
+            with patch.object(flush_enrollments, 'apply_async') as flush:
+                process.delay(order.id, self.webhook_data.id).get(5)
+            flush.assert_not_called()
+
+        order = Order.objects.get(pk=order.id)
+        self.assertEqual(order.status, Order.PROCESSED)
+
+    def test_multiple_orders(self):
+        """Do we enroll the line items of several orders with one
+        request per course?"""
+        orders = []
+        for i in range(3):
+            payload = dict(self.json_payload, id=self.json_payload['id'] + i)
+            webhook_data = JSONWebhookData(headers={},
+                                           body=b'',
+                                           content=payload)
+            webhook_data.save()
+            order, created = record_order(webhook_data)
+            process_order(order, payload)
+            orders.append(order)
+
+        # Until the flush, orders and their items remain in the
+        # PROCESSING state.
+        for order in orders:
+            self.assertEqual(order.status, Order.PROCESSING)
+        self.assertEqual(
+            OrderItem.objects.filter(status=OrderItem.PROCESSING).count(),
+            len(orders) * len(self.json_payload['line_items']))
+
+        courses = set(item['sku'] for item in self.json_payload['line_items'])
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST',
+                           self.token_uri,
+                           json=self.token_response)
+            m.register_uri('POST',
+                           self.enroll_uri,
+                           json=bulk_enroll_callback)
+            flush_enrollments.delay().get(5)
+            enroll_requests = [r for r in m.request_history
+                               if r.url == self.enroll_uri]
+            self.assertEqual(len(enroll_requests), len(courses))
+
+        for order in orders:
+            order = Order.objects.get(pk=order.id)
+            self.assertEqual(order.status, Order.PROCESSED)
+        self.assertFalse(
+            OrderItem.objects.exclude(status=OrderItem.PROCESSED).exists())
+
+
+class ReapExpiredLeasesTest(WooCommerceTestCase):
+
+    def setUp(self):
+        self.setup_payload()
+        self.setup_webhook_data()
+        self.setup_requests()
+        self.order, created = record_order(self.webhook_data)
+
+    def start_processing(self):
+        self.order.start_processing()
+        self.order.save()
+
+    def reap(self):
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST',
+                           self.token_uri,
+                           json=self.token_response)
+            m.register_uri('POST',
+                           self.enroll_uri,
+                           json=bulk_enroll_callback)
+            return reap.delay().get(5)
+
+    def test_lease(self):
+        """Does processing an order take a lease on it, and finishing
+        it release the lease?"""
+        self.start_processing()
+        order = Order.objects.get(pk=self.order.id)
+        self.assertTrue(order.lease_owner)
+        self.assertGreater(order.lease_expires, timezone.now())
+
+        # An order with a valid lease is left alone
+        self.assertEqual(self.reap(), 0)
+        self.assertEqual(Order.objects.get(pk=self.order.id).status,
+                         Order.PROCESSING)
+
+    def test_reap_expired(self):
+        self.start_processing()
+        Order.objects.filter(pk=self.order.id).update(
+            lease_expires=timezone.now() - timedelta(minutes=1)
+        )
+        self.assertEqual(self.reap(), 1)
+
+        order = Order.objects.get(pk=self.order.id)
+        self.assertEqual(order.status, Order.PROCESSED)
+        self.assertEqual(order.lease_owner, '')
+        self.assertIsNone(order.lease_expires)
+        self.assertEqual(self.reap(), 0)
+
+    def test_reap_unleased(self):
+        """Are orders that we started processing before we had leases
+        reaped once they're old enough?"""
+        self.start_processing()
+        Order.objects.filter(pk=self.order.id).update(lease_expires=None)
+        self.assertEqual(self.reap(), 0)
+
+        Order.objects.filter(pk=self.order.id).update(
+            received=timezone.now() - timedelta(days=1)
+        )
+        self.assertEqual(self.reap(), 1)
+        self.assertEqual(Order.objects.get(pk=self.order.id).status,
+                         Order.PROCESSED)
+
+    def test_reap_missing_webhook(self):
+        """Are expired orders without a webhook failed, rather than
+        rescheduled?"""
+        self.start_processing()
+        Order.objects.filter(pk=self.order.id).update(
+            webhook=None,
+            lease_expires=None,
+            received=timezone.now() - timedelta(days=1),
+        )
+        with patch('webhook_receiver.utils.logger') as logger:
+            self.assertEqual(self.reap(), 0)
+        logger.error.assert_called_once()
+
+        order = Order.objects.get(pk=self.order.id)
+        self.assertEqual(order.status, Order.ERROR)
+        self.assertTrue(order.last_error.startswith(
+            'MissingWebhookException: Order %s has no webhook' % order.id))
+        self.assertIsNone(order.lease_expires)
+        self.assertEqual(self.reap(), 0)
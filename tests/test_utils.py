@@ -1,14 +1,166 @@
 from __future__ import unicode_literals
 
+import json
+import threading
+
+from unittest.mock import Mock
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
 from django.conf import settings
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
 
+from webhook_receiver.cache import sku_cache
+from webhook_receiver.models import CourseMapping, JSONWebhookData
 from webhook_receiver.utils import hmac_is_valid, lookup_course_id
 from webhook_receiver.utils import SKULookupException
+from webhook_receiver.utils import receive_json_webhook
+from webhook_receiver.utils import fail_and_save, finish_and_save
+from webhook_receiver.utils import is_duplicate_delivery
+from webhook_receiver.utils import enroll_in_course, get_lms_client
+from webhook_receiver.utils import reset_lms_clients, LMSSession
+from webhook_receiver.utils import bulk_enroll_in_course, enroll_order_items
+from webhook_receiver_shopify.models import ShopifyOrder as Order
+from webhook_receiver_shopify.models import ShopifyOrderItem as OrderItem
 
 import requests_mock
 from requests.exceptions import HTTPError
 
+from . import bulk_enroll_callback
+
+
+def count_writes(queries):
+    """Count the INSERT and UPDATE statements in a list of captured
+    queries."""
+    return len([q for q in queries
+                if q['sql'].startswith(('INSERT', 'UPDATE'))])
+
+
+class ReceiveJSONWebhookTest(TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.payload = {'id': 42, 'line_items': []}
+
+    def post(self, body):
+        return self.factory.post('/webhooks/test',
+                                 body,
+                                 content_type='application/json')
+
+    def receive(self, single_write, body=None, finish=True):
+        if body is None:
+            body = json.dumps(self.payload).encode('utf-8')
+        request = self.post(body)
+        with CaptureQueriesContext(connection) as queries:
+            data = receive_json_webhook(request, single_write=single_write)
+            if finish:
+                finish_and_save(data)
+            else:
+                fail_and_save(data)
+        return data, queries
+
+    def test_receive(self):
+        for single_write in (False, True):
+            data, queries = self.receive(single_write)
+            data = JSONWebhookData.objects.get(pk=data.id)
+            self.assertEqual(data.status, JSONWebhookData.PROCESSED)
+            self.assertEqual(data.content, self.payload)
+            self.assertEqual(data.source, '127.0.0.1')
+
+    def test_receive_failed(self):
+        for single_write in (False, True):
+            data, queries = self.receive(single_write, finish=False)
+            data = JSONWebhookData.objects.get(pk=data.id)
+            self.assertEqual(data.status, JSONWebhookData.ERROR)
+
+    def test_receive_corrupt(self):
+        for single_write in (False, True):
+            request = self.post(b'{')
+            with self.assertRaises(ValueError):
+                receive_json_webhook(request, single_write=single_write)
+            data = JSONWebhookData.objects.latest('id')
+            self.assertEqual(data.status, JSONWebhookData.ERROR)
+            self.assertEqual(bytes(data.body), b'{')
+
+    @override_settings(WEBHOOK_RECEIVER_STORE_CONTENT='none')
+    def test_receive_no_content(self):
+        """If we don't store the content, do we still get the payload
+        from the body?"""
+        data, queries = self.receive(single_write=True)
+        self.assertEqual(data.payload, self.payload)
+        data = JSONWebhookData.objects.get(pk=data.id)
+        self.assertIsNone(data.content)
+        self.assertEqual(data.payload, self.payload)
+
+    @override_settings(WEBHOOK_RECEIVER_STORE_CONTENT='minimal')
+    def test_receive_minimal_content(self):
+        """If we only store minimal content, do we keep exactly what we
+        need for processing orders?"""
+        self.payload = {
+            'id': 42,
+            'note': 'Please hurry',
+            'customer': {'email': 'learner@example.com',
+                         'first_name': 'Jane',
+                         'last_name': 'Doe',
+                         'orders_count': 17},
+            'line_items': [{'sku': 'course-v1:org+course+run1',
+                            'properties': [],
+                            'price': '10.00'}],
+        }
+        data, queries = self.receive(single_write=True)
+        data = JSONWebhookData.objects.get(pk=data.id)
+        self.assertEqual(data.content, {
+            'id': 42,
+            'customer': {'email': 'learner@example.com',
+                         'first_name': 'Jane',
+                         'last_name': 'Doe'},
+            'line_items': [{'sku': 'course-v1:org+course+run1',
+                            'properties': []}],
+        })
+        self.assertEqual(json.loads(bytes(data.body).decode('utf-8')),
+                         self.payload)
+        # The payload is still the full content, and we only parse the
+        # body for it.
+        self.assertEqual(data.content_mode, JSONWebhookData.MINIMAL_CONTENT)
+        self.assertEqual(data.order_content, data.content)
+        self.assertEqual(data.payload, self.payload)
+
+        # Even if we store full content from now on
+        with override_settings(WEBHOOK_RECEIVER_STORE_CONTENT='full'):
+            data = JSONWebhookData.objects.get(pk=data.id)
+            self.assertEqual(data.payload, self.payload)
+
+    def test_queries_per_webhook(self):
+        """Benchmark the number of database writes per webhook, with
+        and without single-write ingest."""
+        data, queries_before = self.receive(single_write=False)
+        data, queries_after = self.receive(single_write=True)
+
+        # Saving on receipt, on starting processing, and on finishing
+        # processing means three writes. Single-write ingest gets
+        # this down to one.
+        self.assertEqual(count_writes(queries_before), 3)
+        self.assertEqual(count_writes(queries_after), 1)
+        self.assertLess(len(queries_after), len(queries_before))
+
+    def test_concurrent_duplicate_delivery(self):
+        """If a webhook with the same delivery ID gets accepted while
+        we're receiving one, do we notice, and still save ours?"""
+        for single_write in (False, True):
+            first = receive_json_webhook(self.post(b'{}'),
+                                         single_write=single_write)
+            second = receive_json_webhook(self.post(b'{}'),
+                                          single_write=single_write)
+            delivery_id = 'test:%s' % single_write
+            self.assertTrue(finish_and_save(first, delivery_id))
+            self.assertFalse(finish_and_save(second, delivery_id))
+
+            self.assertTrue(is_duplicate_delivery(delivery_id))
+            second = JSONWebhookData.objects.get(pk=second.id)
+            self.assertEqual(second.status, JSONWebhookData.PROCESSED)
+            self.assertIsNone(second.delivery_id)
+
 
 class SignatureVerificationTest(TestCase):
 
@@ -46,6 +198,10 @@ class SignatureVerificationTest(TestCase):
 
 class SKULookupTest(TestCase):
 
+    def setUp(self):
+        sku_cache.clear()
+        sku_cache.reset_stats()
+
     def test_sku_roundtrip(self):
         """When given a SKU that looks like a course ID, do we return it
         unchanged?"""
@@ -116,3 +272,469 @@ class SKULookupTest(TestCase):
                            status_code=200)
             with self.assertRaises(SKULookupException):
                 lookup_course_id(sku)
+
+    def test_cached_lookup(self):
+        """When given the same SKU twice, do we only look it up once?"""
+        sku = 'course001'
+        course_id = 'course-v1:org+course+run1'
+        lookup_url = '%s/%s' % (settings.WEBHOOK_RECEIVER_LMS_BASE_URL,
+                                sku)
+        found_url = '%s/courses/%s/about' % (settings.WEBHOOK_RECEIVER_LMS_BASE_URL,  # noqa: E501
+                                             course_id)
+
+        with requests_mock.Mocker() as m:
+            m.register_uri('HEAD',
+                           lookup_url,
+                           status_code=301,
+                           headers={'Location': found_url})
+            m.register_uri('HEAD',
+                           found_url,
+                           status_code=200)
+            self.assertEqual(lookup_course_id(sku), course_id)
+            self.assertEqual(lookup_course_id(sku), course_id)
+            self.assertEqual(m.call_count, 2)
+
+        self.assertEqual(sku_cache.stats(), {'local_hits': 1,
+                                             'shared_hits': 0,
+                                             'misses': 1})
+
+    def test_cached_invalid_redirect(self):
+        """When given the same unresolvable SKU twice, do we only look
+        it up once?"""
+        sku = 'course001'
+        lookup_url = '%s/%s' % (settings.WEBHOOK_RECEIVER_LMS_BASE_URL,
+                                sku)
+
+        with requests_mock.Mocker() as m:
+            m.register_uri('HEAD',
+                           lookup_url,
+                           status_code=200)
+            for i in range(2):
+                with self.assertRaises(SKULookupException):
+                    lookup_course_id(sku)
+            self.assertEqual(m.call_count, 1)
+
+    def test_uncached_http_error(self):
+        """When a SKU lookup fails with an HTTP error, do we try
+        again next time?"""
+        sku = 'course001'
+        lookup_url = '%s/%s' % (settings.WEBHOOK_RECEIVER_LMS_BASE_URL,
+                                sku)
+
+        with requests_mock.Mocker() as m:
+            m.register_uri('HEAD',
+                           lookup_url,
+                           status_code=503)
+            for i in range(2):
+                with self.assertRaises(HTTPError):
+                    lookup_course_id(sku)
+            self.assertEqual(m.call_count, 2)
+
+    def test_mapped_lookup(self):
+        """When given a SKU that has a course mapping, do we return its
+        course ID without asking the LMS?"""
+        CourseMapping.objects.create(sku='course001',
+                                     course_id='course-v1:org+course+run1')
+
+        with requests_mock.Mocker() as m:
+            self.assertEqual(lookup_course_id('course001'),
+                             'course-v1:org+course+run1')
+            self.assertEqual(m.call_count, 0)
+
+    def test_mapping_after_failed_lookup(self):
+        """When a SKU failed to resolve, and we then add a course
+        mapping for it, do we use that right away?"""
+        sku = 'course001'
+        lookup_url = '%s/%s' % (settings.WEBHOOK_RECEIVER_LMS_BASE_URL,
+                                sku)
+
+        with requests_mock.Mocker() as m:
+            m.register_uri('HEAD',
+                           lookup_url,
+                           status_code=200)
+            with self.assertRaises(SKULookupException):
+                lookup_course_id(sku)
+
+            CourseMapping.objects.create(sku=sku,
+                                         course_id='course-v1:org+course+run1')
+            self.assertEqual(lookup_course_id(sku),
+                             'course-v1:org+course+run1')
+            self.assertEqual(m.call_count, 1)
+
+    def test_lookup_records_mapping(self):
+        """When we resolve a SKU via the LMS, do we record a course
+        mapping for it?"""
+        sku = 'course001'
+        course_id = 'course-v1:org+course+run1'
+        lookup_url = '%s/%s' % (settings.WEBHOOK_RECEIVER_LMS_BASE_URL,
+                                sku)
+        found_url = '%s/courses/%s/about' % (settings.WEBHOOK_RECEIVER_LMS_BASE_URL,  # noqa: E501
+                                             course_id)
+
+        with requests_mock.Mocker() as m:
+            m.register_uri('HEAD',
+                           lookup_url,
+                           status_code=301,
+                           headers={'Location': found_url})
+            m.register_uri('HEAD',
+                           found_url,
+                           status_code=200)
+            lookup_course_id(sku)
+
+        mapping = CourseMapping.objects.get(sku=sku)
+        self.assertEqual(mapping.course_id, course_id)
+        self.assertEqual(mapping.origin, CourseMapping.RESOLVED)
+
+        # Even with an empty cache, we should now no longer need the
+        # LMS to resolve the SKU.
+        sku_cache.clear()
+        with requests_mock.Mocker() as m:
+            self.assertEqual(lookup_course_id(sku), course_id)
+            self.assertEqual(m.call_count, 0)
+
+    @override_settings(WEBHOOK_RECEIVER_RECORD_COURSE_MAPPINGS=False)
+    def test_lookup_does_not_record_mapping(self):
+        """If we're configured not to record course mappings, do we
+        refrain from doing so?"""
+        sku = 'course001'
+        course_id = 'course-v1:org+course+run1'
+        lookup_url = '%s/%s' % (settings.WEBHOOK_RECEIVER_LMS_BASE_URL,
+                                sku)
+        found_url = '%s/courses/%s/about' % (settings.WEBHOOK_RECEIVER_LMS_BASE_URL,  # noqa: E501
+                                             course_id)
+
+        with requests_mock.Mocker() as m:
+            m.register_uri('HEAD',
+                           lookup_url,
+                           status_code=301,
+                           headers={'Location': found_url})
+            m.register_uri('HEAD',
+                           found_url,
+                           status_code=200)
+            self.assertEqual(lookup_course_id(sku), course_id)
+
+        self.assertFalse(CourseMapping.objects.exists())
+
+
+class LMSRequestHandler(BaseHTTPRequestHandler):
+    """Respond to HEAD requests with the statuses in the server's
+    statuses list, and then with HTTP 200, keeping connections
+    alive."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        statuses = self.server.statuses
+        self.send_response(statuses.pop(0) if statuses else 200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LMSSessionTest(TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), LMSRequestHandler)
+        self.server.statuses = []
+        self.url = 'http://127.0.0.1:%s/' % self.server.server_port
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  kwargs={'poll_interval': 0.01})
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connection_reuse(self):
+        """Do we send consecutive requests over the same connection?"""
+        session = LMSSession()
+        for i in range(3):
+            session.head(self.url)
+        self.assertEqual(session.connection_stats(), {'connections': 1,
+                                                      'requests': 3,
+                                                      'reused': 2})
+        session.close()
+
+    @override_settings(WEBHOOK_RECEIVER_LMS_RETRY_BACKOFF=0)
+    def test_retry(self):
+        """Do we retry idempotent requests on HTTP 503?"""
+        self.server.statuses = [503, 503]
+        session = LMSSession()
+        self.assertEqual(session.head(self.url).status_code, 200)
+        self.assertEqual(session.connection_stats()['requests'], 3)
+        session.close()
+
+    @override_settings(WEBHOOK_RECEIVER_LMS_RETRY_BACKOFF=0)
+    def test_retry_recorded(self):
+        """Do the rate limiter and the circuit breaker see the
+        responses we retry on, and the final one only once?"""
+        self.server.statuses = [503, 503]
+        recorded = []
+        limiter = Mock()
+        limiter.record = lambda response: recorded.append(
+            ('limiter', response.status_code))
+        breaker = Mock()
+        breaker.before_request.return_value = True
+        breaker.record = lambda response, probe: recorded.append(
+            ('breaker', response.status_code, probe))
+        session = LMSSession(limiter=limiter, breaker=breaker)
+        session.head(self.url)
+        session.close()
+        self.assertEqual(recorded, [
+            ('limiter', 503), ('breaker', 503, False),
+            ('limiter', 503), ('breaker', 503, False),
+            ('limiter', 200), ('breaker', 200, True),
+        ])
+
+    @override_settings(WEBHOOK_RECEIVER_LMS_MAX_RETRIES=1,
+                       WEBHOOK_RECEIVER_LMS_RETRY_BACKOFF=0)
+    def test_retries_exhausted(self):
+        """Once we've run out of retries, do we return the last
+        response?"""
+        self.server.statuses = [503, 503]
+        session = LMSSession()
+        self.assertEqual(session.head(self.url).status_code, 503)
+        session.close()
+
+    @override_settings(WEBHOOK_RECEIVER_LMS_CONNECT_TIMEOUT=1,
+                       WEBHOOK_RECEIVER_LMS_READ_TIMEOUT=2)
+    def test_default_timeout(self):
+        """Do we apply the default timeouts, unless overridden?"""
+        session = LMSSession()
+        with requests_mock.Mocker() as m:
+            m.register_uri('HEAD', self.url)
+            session.head(self.url)
+            self.assertEqual(m.last_request.timeout, (1, 2))
+            session.head(self.url, timeout=10)
+            self.assertEqual(m.last_request.timeout, 10)
+        session.close()
+
+
+class LMSClientTest(TestCase):
+
+    def setUp(self):
+        reset_lms_clients()
+        base_url = settings.WEBHOOK_RECEIVER_LMS_BASE_URL
+        self.token_uri = '%s/oauth2/access_token' % base_url
+        self.enroll_uri = '%s/api/bulk_enroll/v1/bulk_enroll/' % base_url
+        self.token_response = {
+            'access_token': 'foobar',
+            'expires_in': 3600
+        }
+
+    def tearDown(self):
+        reset_lms_clients()
+
+    def token_requests(self, m):
+        return [r for r in m.request_history if r.url == self.token_uri]
+
+    def test_shared_client(self):
+        """Do we get the same client for the same configuration, and a
+        fresh one after resetting?"""
+        client = get_lms_client()
+        self.assertIs(get_lms_client(), client)
+        reset_lms_clients()
+        self.assertIsNot(get_lms_client(), client)
+
+    def test_token_reuse(self):
+        """Do we fetch only one access token for several enrollments?"""
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST',
+                           self.token_uri,
+                           json=self.token_response)
+            m.register_uri('POST',
+                           self.enroll_uri,
+                           json={})
+            for i in range(3):
+                enroll_in_course('course-v1:org+course+run1',
+                                 'learner%d@example.com' % i)
+            self.assertEqual(len(self.token_requests(m)), 1)
+            enroll_requests = [r for r in m.request_history
+                               if r.url == self.enroll_uri]
+            self.assertEqual(len(enroll_requests), 3)
+            for request in enroll_requests:
+                self.assertEqual(request.headers['Authorization'],
+                                 'JWT foobar')
+
+    def test_token_expiry(self):
+        """Do we fetch a new access token when ours is about to
+        expire?"""
+        self.token_response['expires_in'] = 0
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST',
+                           self.token_uri,
+                           json=self.token_response)
+            m.register_uri('POST',
+                           self.enroll_uri,
+                           json={})
+            for i in range(2):
+                enroll_in_course('course-v1:org+course+run1',
+                                 'learner@example.com')
+            self.assertEqual(len(self.token_requests(m)), 2)
+
+    def test_token_refresh_on_401(self):
+        """Do we fetch a new access token, and retry, if the LMS
+        rejects ours?"""
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST',
+                           self.token_uri,
+                           [{'json': {'access_token': 'revoked',
+                                      'expires_in': 3600}},
+                            {'json': self.token_response}])
+            m.register_uri('POST',
+                           self.enroll_uri,
+                           [{'status_code': 401},
+                            {'json': {}}])
+            enroll_in_course('course-v1:org+course+run1',
+                             'learner@example.com')
+            self.assertEqual(len(self.token_requests(m)), 2)
+            self.assertEqual(m.last_request.headers['Authorization'],
+                             'JWT foobar')
+
+    def test_persistent_401(self):
+        """Do we give up if the LMS keeps rejecting our token?"""
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST',
+                           self.token_uri,
+                           json=self.token_response)
+            m.register_uri('POST',
+                           self.enroll_uri,
+                           status_code=401)
+            with self.assertRaises(HTTPError):
+                enroll_in_course('course-v1:org+course+run1',
+                                 'learner@example.com')
+            self.assertEqual(len(self.token_requests(m)), 2)
+
+
+class BulkEnrollmentTest(TestCase):
+
+    def setUp(self):
+        reset_lms_clients()
+        sku_cache.clear()
+        base_url = settings.WEBHOOK_RECEIVER_LMS_BASE_URL
+        self.token_uri = '%s/oauth2/access_token' % base_url
+        self.enroll_uri = '%s/api/bulk_enroll/v1/bulk_enroll/' % base_url
+        self.token_response = {
+            'access_token': 'foobar',
+            'expires_in': 3600
+        }
+        self.order = Order(id=1,
+                           email='buyer@example.com',
+                           first_name='Jane',
+                           last_name='Doe')
+        self.order.save()
+
+    def make_order_item(self, sku, email):
+        order_item = OrderItem(order=self.order, sku=sku, email=email)
+        order_item.start_processing()
+        order_item.save()
+        return order_item
+
+    def enroll_requests(self, m):
+        return [r for r in m.request_history if r.url == self.enroll_uri]
+
+    def test_bulk_enroll_in_course(self):
+        invalid = ['invalid@example.com']
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST',
+                           self.token_uri,
+                           json=self.token_response)
+            m.register_uri('POST',
+                           self.enroll_uri,
+                           json=lambda r, c: bulk_enroll_callback(r, c,
+                                                                  invalid))
+            enrolled = bulk_enroll_in_course('course-v1:org+course+run1',
+                                             ['learner1@example.com',
+                                              'learner2@example.com',
+                                              'invalid@example.com'])
+            self.assertEqual(len(self.enroll_requests(m)), 1)
+
+        self.assertEqual(enrolled, {'learner1@example.com',
+                                    'learner2@example.com'})
+
+    def test_enroll_order_items(self):
+        """Do we send one request per course, and mark each order item
+        according to its result?"""
+        order_items = [
+            self.make_order_item('course-v1:org+course+run1',
+                                 'learner1@example.com'),
+            self.make_order_item('course-v1:org+course+run1',
+                                 'learner2@example.com'),
+            self.make_order_item('course-v1:org+course+run2',
+                                 'learner1@example.com'),
+            self.make_order_item('course-v1:org+course+run2',
+                                 'invalid@example.com'),
+            self.make_order_item('course-v1:org+course+run2',
+                                 'notanemailaddress'),
+        ]
+        invalid = ['invalid@example.com']
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST',
+                           self.token_uri,
+                           json=self.token_response)
+            m.register_uri('POST',
+                           self.enroll_uri,
+                           json=lambda r, c: bulk_enroll_callback(r, c,
+                                                                  invalid))
+            failed = enroll_order_items(order_items)
+            self.assertEqual(len(self.enroll_requests(m)), 2)
+
+        self.assertEqual(failed, order_items[3:])
+        statuses = [OrderItem.objects.get(pk=o.id).status
+                    for o in order_items]
+        self.assertEqual(statuses, [OrderItem.PROCESSED,
+                                    OrderItem.PROCESSED,
+                                    OrderItem.PROCESSED,
+                                    OrderItem.ERROR,
+                                    OrderItem.ERROR])
+
+    @override_settings(WEBHOOK_RECEIVER_BATCH_SIZE=2)
+    def test_enroll_order_items_batch_size(self):
+        order_items = [
+            self.make_order_item('course-v1:org+course+run1',
+                                 'learner%d@example.com' % i)
+            for i in range(5)
+        ]
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST',
+                           self.token_uri,
+                           json=self.token_response)
+            m.register_uri('POST',
+                           self.enroll_uri,
+                           json=bulk_enroll_callback)
+            self.assertEqual(enroll_order_items(order_items), [])
+            self.assertEqual(len(self.enroll_requests(m)), 3)
+
+    def test_enroll_order_items_http_error(self):
+        """Do we carry on with other courses if a request fails, and
+        then raise the error, leaving the affected order items to be
+        retried?"""
+        order_items = [
+            self.make_order_item('course-v1:org+nosuchcourse+run1',
+                                 'learner1@example.com'),
+            self.make_order_item('course-v1:org+course+run1',
+                                 'learner1@example.com'),
+        ]
+
+        def callback(request, context):
+            if 'nosuchcourse' in request.text:
+                context.status_code = 404
+                return {}
+            return bulk_enroll_callback(request, context)
+
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST',
+                           self.token_uri,
+                           json=self.token_response)
+            m.register_uri('POST',
+                           self.enroll_uri,
+                           json=callback)
+            with self.assertRaises(HTTPError):
+                enroll_order_items(order_items)
+
+        statuses = [OrderItem.objects.get(pk=o.id).status
+                    for o in order_items]
+        self.assertEqual(statuses, [OrderItem.PROCESSING,
+                                    OrderItem.PROCESSED])
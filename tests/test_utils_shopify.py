@@ -3,19 +3,23 @@ from __future__ import unicode_literals
 import json
 
 from django.core.exceptions import ValidationError
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 
 from requests.exceptions import HTTPError
 
 from webhook_receiver.models import JSONWebhookData
+from webhook_receiver.utils import EnrollmentException
 
-from webhook_receiver_shopify.utils import record_order
+from webhook_receiver_shopify.utils import record_order, record_line_items
 from webhook_receiver_shopify.utils import process_order, process_line_item
 from webhook_receiver_shopify.models import ShopifyOrder as Order
 from webhook_receiver_shopify.models import ShopifyOrderItem as OrderItem
 
 import requests_mock
 
-from . import ShopifyTestCase
+from . import ShopifyTestCase, bulk_enroll_callback
 
 
 class RecordOrderTest(ShopifyTestCase):
@@ -36,6 +40,46 @@ class RecordOrderTest(ShopifyTestCase):
         self.assertFalse(created2)
         self.assertEqual(order1, order2)
 
+    def test_record_line_items(self):
+        """Does recording line items take the same number of queries,
+        however many there are?"""
+        order, created = record_order(self.webhook_data)
+        item = self.json_payload['line_items'][0]
+        items = []
+        for i in range(10):
+            items.append(dict(item, sku='course-v1:org+course+run%d' % i))
+
+        with CaptureQueriesContext(connection) as queries_one:
+            order_items = record_line_items(order, items[:1])
+        with CaptureQueriesContext(connection) as queries_many:
+            order_items = record_line_items(order, items)
+        self.assertEqual(len(queries_one), len(queries_many))
+
+        self.assertEqual([o.sku for o in order_items],
+                         [i['sku'] for i in items])
+        self.assertEqual(OrderItem.objects.filter(
+            order=order,
+            status=OrderItem.PROCESSING
+        ).count(), 10)
+
+        # Recording them again just fetches them
+        self.assertEqual(record_line_items(order, items), order_items)
+        self.assertEqual(OrderItem.objects.count(), 10)
+
+    def test_record_line_items_other_email(self):
+        """Does recording a line item leave alone a new one with the
+        same SKU, for a different email address?"""
+        order, created = record_order(self.webhook_data)
+        item = self.json_payload['line_items'][0]
+        other = OrderItem.objects.create(order=order,
+                                         sku=item['sku'],
+                                         email='other@example.com')
+
+        order_item, = record_line_items(order, [item])
+        self.assertEqual(order_item.status, OrderItem.PROCESSING)
+        self.assertEqual(OrderItem.objects.get(pk=other.pk).status,
+                         OrderItem.NEW)
+
 
 class ProcessOrderTest(ShopifyTestCase):
 
@@ -120,6 +164,137 @@ class ProcessOrderTest(ShopifyTestCase):
         self.test_valid_order()
 
 
+@override_settings(WEBHOOK_RECEIVER_BATCH_ENROLLMENTS=True)
+class ProcessOrderBatchedTest(ShopifyTestCase):
+
+    def setUp(self):
+        self.setup_payload()
+        self.setup_webhook_data()
+        self.setup_requests()
+
+    def process_order(self, order):
+        """Process the order, and return the number of enrollment
+        requests that took."""
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST',
+                           self.token_uri,
+                           json=self.token_response)
+            m.register_uri('POST',
+                           self.enroll_uri,
+                           json=bulk_enroll_callback)
+            process_order(order, self.json_payload)
+            return len([r for r in m.request_history
+                        if r.url == self.enroll_uri])
+
+    def test_valid_order(self):
+        order, created = record_order(self.webhook_data)
+
+        # We expect one enrollment request per course.
+        courses = set(item['sku'] for item in self.json_payload['line_items'])
+        self.assertEqual(self.process_order(order), len(courses))
+
+        self.assertEqual(order.status, Order.PROCESSED)
+        for order_item in OrderItem.objects.filter(order=order):
+            self.assertEqual(order_item.status, OrderItem.PROCESSED)
+
+    def test_invalid_identifier(self):
+        self.emails = ['learner@example.com']
+        order, created = record_order(self.webhook_data)
+
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST',
+                           self.token_uri,
+                           json=self.token_response)
+            m.register_uri('POST',
+                           self.enroll_uri,
+                           json=lambda r, c: bulk_enroll_callback(
+                               r, c, invalid=self.emails))
+            with self.assertRaises(EnrollmentException):
+                process_order(order, self.json_payload)
+
+        # It's the task failure handler's job to set the order status
+        # to ERROR, but the order items have failed.
+        self.assertEqual(order.status, Order.PROCESSING)
+        for order_item in OrderItem.objects.filter(order=order):
+            self.assertEqual(order_item.status, OrderItem.ERROR)
+
+    def test_valid_order_again(self):
+        """Re-inject a previously processed order, so we can check
+        idempotency of order processing."""
+        self.test_valid_order()
+        order = Order.objects.get(pk=self.json_payload['id'])
+        self.assertEqual(self.process_order(order), 0)
+
+
+@override_settings(WEBHOOK_RECEIVER_LINE_ITEM_CONCURRENCY=4)
+class ProcessOrderConcurrentTest(ShopifyTestCase):
+
+    def setUp(self):
+        self.setup_payload()
+        self.setup_webhook_data()
+        self.setup_requests()
+
+    # Enrollments in this course run fail, if self.fail is set.
+    FAILING_RUN = 'run2'
+
+    def enroll_callback(self, request, context):
+        if self.fail and self.FAILING_RUN in request.text:
+            context.status_code = 503
+            return {}
+        return bulk_enroll_callback(request, context)
+
+    def process_order(self, order):
+        """Process the order, and return the number of enrollment
+        requests that took."""
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST',
+                           self.token_uri,
+                           json=self.token_response)
+            m.register_uri('POST',
+                           self.enroll_uri,
+                           json=self.enroll_callback)
+            try:
+                process_order(order, self.json_payload)
+            finally:
+                self.enroll_requests = len([r for r in m.request_history
+                                            if r.url == self.enroll_uri])
+
+    def test_valid_order(self):
+        self.fail = False
+        order, created = record_order(self.webhook_data)
+
+        # We expect one enrollment request per line item.
+        self.process_order(order)
+        self.assertEqual(self.enroll_requests,
+                         len(self.json_payload['line_items']))
+
+        self.assertEqual(order.status, Order.PROCESSED)
+        for order_item in OrderItem.objects.filter(order=order):
+            self.assertEqual(order_item.status, OrderItem.PROCESSED)
+
+    def test_http_error(self):
+        """If one enrollment fails, do we still enroll the other line
+        items, and then raise the error so we can retry?"""
+        self.fail = True
+        order, created = record_order(self.webhook_data)
+
+        with self.assertRaises(HTTPError):
+            self.process_order(order)
+
+        self.assertEqual(order.status, Order.PROCESSING)
+        for order_item in OrderItem.objects.filter(order=order):
+            if self.FAILING_RUN in order_item.sku:
+                self.assertEqual(order_item.status, OrderItem.PROCESSING)
+            else:
+                self.assertEqual(order_item.status, OrderItem.PROCESSED)
+
+        # On retry, we should only enroll the line item that failed.
+        self.fail = False
+        self.process_order(order)
+        self.assertEqual(self.enroll_requests, 1)
+        self.assertEqual(order.status, Order.PROCESSED)
+
+
 class ProcessLineItemTest(ShopifyTestCase):
 
     def setUp(self):
@@ -1,16 +1,42 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import asyncio
 import hashlib
 import base64
 import hmac
 
+import django
+
+from io import StringIO
+from unittest import skipIf
+from unittest.mock import patch
+
+try:
+    # asgiref comes with Django 3.0 and later.
+    from asgiref.sync import async_to_sync
+except ImportError:
+    async_to_sync = None
+
 from django.conf import settings
-from django.test import Client
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.test import Client, RequestFactory, TestCase
+from django.test import TransactionTestCase
+from django.db import DatabaseError
+from django.test import override_settings
+
+from webhook_receiver.models import JSONWebhookData, OutboxEntry
+from webhook_receiver.utils import async_webhook_view, get_webhook_view
+from webhook_receiver_shopify import views as shopify_views
+from webhook_receiver_shopify.models import ShopifyOrder
+from webhook_receiver_woocommerce import views as woocommerce_views
+from webhook_receiver_woocommerce.models import WooCommerceOrder
 
 import requests_mock
 
 from . import ShopifyTestCase, WooCommerceTestCase, WooCommerceUnpaidTestCase
+from . import bulk_enroll_callback
 
 
 class ShopifyTestOrderCreation(ShopifyTestCase):
@@ -151,6 +177,73 @@ class ShopifyTestOrderCreation(ShopifyTestCase):
         self.test_valid_order()
         self.test_valid_order()
 
+    def post_delivery(self, delivery_id):
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST',
+                           self.token_uri,
+                           json=self.token_response)
+            m.register_uri('POST',
+                           self.enroll_uri,
+                           json=bulk_enroll_callback)
+            return self.client.post('/webhooks/shopify/order/create',
+                                    self.raw_payload,
+                                    content_type='application/json',
+                                    HTTP_X_SHOPIFY_HMAC_SHA256=self.correct_signature,  # noqa: E501
+                                    HTTP_X_SHOPIFY_SHOP_DOMAIN='example.com',  # noqa: E501
+                                    HTTP_X_SHOPIFY_WEBHOOK_ID=delivery_id)
+
+    def test_duplicate_delivery(self):
+        """Is a redelivery of a webhook acknowledged without storing
+        it again?"""
+        response = self.post_delivery('b54557e4-bdd9')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(JSONWebhookData.objects.get().delivery_id,
+                         'shopify:b54557e4-bdd9')
+
+        for cache_timeout in (86400, 0):
+            with override_settings(
+                    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},  # noqa: E501
+                    WEBHOOK_RECEIVER_DELIVERY_CACHE_TIMEOUT=cache_timeout):
+                response = self.post_delivery('b54557e4-bdd9')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(JSONWebhookData.objects.count(), 1)
+
+        # A different delivery is stored
+        response = self.post_delivery('c1a8e2f0-9e77')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(JSONWebhookData.objects.count(), 2)
+
+    @override_settings(WEBHOOK_RECEIVER_DEDUPLICATE_DELIVERIES=False)
+    def test_duplicate_delivery_disabled(self):
+        self.post_delivery('b54557e4-bdd9')
+        self.post_delivery('b54557e4-bdd9')
+        self.assertEqual(
+            list(JSONWebhookData.objects.values_list('delivery_id',
+                                                     flat=True)),
+            [None, None]
+        )
+
+    def test_publish_failure(self):
+        """If publishing the processing task fails, do we process the
+        redelivery of the webhook?"""
+        if settings.WEBHOOK_RECEIVER_OUTBOX:
+            self.skipTest('The outbox has its own test for this')
+        with patch.object(shopify_views.process, 'delay',
+                          side_effect=ConnectionError):
+            with self.assertRaises(ConnectionError):
+                self.post_delivery('b54557e4-bdd9')
+        self.assertEqual(ShopifyOrder.objects.get().status,
+                         ShopifyOrder.NEW)
+        self.assertFalse(JSONWebhookData.objects.filter(
+            delivery_id__isnull=False).exists())
+
+        response = self.post_delivery('b54557e4-bdd9')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(ShopifyOrder.objects.get().status,
+                         ShopifyOrder.PROCESSED)
+        self.assertEqual(JSONWebhookData.objects.get(
+            delivery_id__isnull=False).delivery_id, 'shopify:b54557e4-bdd9')
+
 
 class WooCommerceTestOrderCreation(WooCommerceTestCase):
 
@@ -309,8 +402,267 @@ class WooCommerceTestOrderCreation(WooCommerceTestCase):
         self.test_valid_order()
         self.test_valid_order()
 
+    def post_delivery(self, delivery_id):
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST',
+                           self.token_uri,
+                           json=self.token_response)
+            m.register_uri('POST',
+                           self.enroll_uri,
+                           json=bulk_enroll_callback)
+            return self.client.post('/webhooks/woocommerce/order/create',
+                                    self.raw_payload,
+                                    content_type='application/json',
+                                    HTTP_X_WC_WEBHOOK_SIGNATURE=self.correct_signature,  # noqa: E501
+                                    HTTP_X_WC_WEBHOOK_SOURCE='https://example.com',  # noqa: E501
+                                    HTTP_X_WC_WEBHOOK_DELIVERY_ID=delivery_id)  # noqa: E501
+
+    def test_duplicate_delivery(self):
+        """Is a redelivery of a webhook acknowledged without storing
+        it again? (Unless we rejected it for lack of payment, in which
+        case we must check it again.)"""
+        expected = self.TEST_VALID_ORDER_EXPECTED_STATUS_CODE
+        for _ in range(2):
+            response = self.post_delivery('1234')
+            self.assertEqual(response.status_code, expected)
+        if expected == 200:
+            self.assertEqual(JSONWebhookData.objects.get().delivery_id,
+                             'woocommerce:1234')
+        else:
+            self.assertEqual(JSONWebhookData.objects.count(), 2)
+
+    def test_publish_failure(self):
+        """If publishing the processing task fails, do we process the
+        redelivery of the webhook?"""
+        if settings.WEBHOOK_RECEIVER_OUTBOX:
+            self.skipTest('The outbox has its own test for this')
+        if self.TEST_VALID_ORDER_EXPECTED_STATUS_CODE != 200:
+            self.skipTest('We never publish tasks for unpaid orders')
+        with patch.object(woocommerce_views.process, 'delay',
+                          side_effect=ConnectionError):
+            with self.assertRaises(ConnectionError):
+                self.post_delivery('1234')
+        self.assertEqual(WooCommerceOrder.objects.get().status,
+                         WooCommerceOrder.NEW)
+        self.assertFalse(JSONWebhookData.objects.filter(
+            delivery_id__isnull=False).exists())
+
+        response = self.post_delivery('1234')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(WooCommerceOrder.objects.get().status,
+                         WooCommerceOrder.PROCESSED)
+        self.assertEqual(JSONWebhookData.objects.get(
+            delivery_id__isnull=False).delivery_id, 'woocommerce:1234')
+
 
 class WooCommerceTestOrderUpdate(WooCommerceUnpaidTestCase,
                                  WooCommerceTestOrderCreation):
 
     TEST_VALID_ORDER_EXPECTED_STATUS_CODE = 402
+
+
+@override_settings(WEBHOOK_RECEIVER_SINGLE_WRITE_INGEST=True)
+class ShopifyTestOrderCreationSingleWrite(ShopifyTestOrderCreation):
+    pass
+
+
+@override_settings(WEBHOOK_RECEIVER_SINGLE_WRITE_INGEST=True)
+class WooCommerceTestOrderCreationSingleWrite(WooCommerceTestOrderCreation):
+    pass
+
+
+class WebhookViewTest(TestCase):
+
+    def test_get_webhook_view(self):
+        self.assertIs(get_webhook_view(shopify_views.order_create),
+                      shopify_views.order_create)
+        with self.settings(WEBHOOK_RECEIVER_ASYNC_VIEWS=True):
+            if django.VERSION < (3, 1):
+                with self.assertRaises(ImproperlyConfigured):
+                    get_webhook_view(shopify_views.order_create)
+            else:
+                self.assertTrue(asyncio.iscoroutinefunction(
+                    get_webhook_view(shopify_views.order_create)))
+
+
+@skipIf(async_to_sync is None, 'asgiref is not installed')
+class AsyncViewTest(TransactionTestCase):
+    """Test the async webhook views, by running them in an event loop
+    of their own (which works regardless of whether the Django
+    version we're testing with can serve async views)."""
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_shopify_invalid_method(self):
+        request = self.factory.get('/webhooks/shopify/order/create')
+        view = async_webhook_view(shopify_views.order_create)
+        response = async_to_sync(view)(request)
+        self.assertEqual(response.status_code, 405)
+
+    def test_shopify_invalid_data(self):
+        request = self.factory.post('/webhooks/shopify/order/create',
+                                    b'{',
+                                    content_type='application/json')
+        view = async_webhook_view(shopify_views.order_create)
+        response = async_to_sync(view)(request)
+        self.assertEqual(response.status_code, 400)
+
+    def test_woocommerce_invalid_signature(self):
+        request = self.factory.post(
+            '/webhooks/woocommerce/order/create',
+            b'{}',
+            content_type='application/json',
+            HTTP_X_WC_WEBHOOK_SOURCE='https://example.com',
+            HTTP_X_WC_WEBHOOK_SIGNATURE='invalid'
+        )
+        view = async_webhook_view(woocommerce_views.order_create_or_update)
+        response = async_to_sync(view)(request)
+        self.assertEqual(response.status_code, 403)
+
+        # The webhook must have been recorded, in the pool thread's
+        # own database connection.
+        self.assertEqual(JSONWebhookData.objects.get().status,
+                         JSONWebhookData.ERROR)
+
+
+@override_settings(WEBHOOK_RECEIVER_STORE_CONTENT='minimal')
+class ShopifyTestOrderCreationMinimalContent(ShopifyTestOrderCreation):
+    pass
+
+
+@override_settings(WEBHOOK_RECEIVER_STORE_CONTENT='none')
+class ShopifyTestOrderCreationNoContent(ShopifyTestOrderCreation):
+
+    def test_order_processed(self):
+        """Do we process the order from the webhook body alone?"""
+        self.test_valid_order()
+        self.assertIsNone(JSONWebhookData.objects.get().content)
+        self.assertEqual(ShopifyOrder.objects.get().status,
+                         ShopifyOrder.PROCESSED)
+
+
+@override_settings(WEBHOOK_RECEIVER_STORE_CONTENT='minimal')
+class WooCommerceTestOrderCreationMinimalContent(WooCommerceTestOrderCreation):
+    pass
+
+
+@override_settings(WEBHOOK_RECEIVER_STORE_CONTENT='none')
+class WooCommerceTestOrderCreationNoContent(WooCommerceTestOrderCreation):
+
+    def test_order_processed(self):
+        """Do we process the order from the webhook body alone?"""
+        self.test_valid_order()
+        self.assertIsNone(JSONWebhookData.objects.get().content)
+        self.assertEqual(WooCommerceOrder.objects.get().status,
+                         WooCommerceOrder.PROCESSED)
+
+
+@override_settings(WEBHOOK_RECEIVER_OUTBOX=True)
+class ShopifyTestOrderCreationOutbox(ShopifyTestOrderCreation):
+
+    def test_outbox(self):
+        """Does a valid webhook go to the outbox, and get processed once
+        the outbox is relayed?"""
+        response = self.client.post('/webhooks/shopify/order/create',
+                                    self.raw_payload,
+                                    content_type='application/json',
+                                    HTTP_X_SHOPIFY_HMAC_SHA256=self.correct_signature,  # noqa: E501
+                                    HTTP_X_SHOPIFY_SHOP_DOMAIN='example.com')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(ShopifyOrder.objects.exists())
+        entry = OutboxEntry.objects.get()
+        self.assertEqual(entry.task,
+                         'webhook_receiver_shopify.tasks.process_webhook')
+
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST',
+                           self.token_uri,
+                           json=self.token_response)
+            m.register_uri('POST',
+                           self.enroll_uri,
+                           json=bulk_enroll_callback)
+            call_command('relay_outbox', once=True, stdout=StringIO())
+
+        self.assertFalse(OutboxEntry.objects.exists())
+        self.assertEqual(ShopifyOrder.objects.get().status,
+                         ShopifyOrder.PROCESSED)
+
+    def post_outbox_delivery(self):
+        return self.client.post('/webhooks/shopify/order/create',
+                                self.raw_payload,
+                                content_type='application/json',
+                                HTTP_X_SHOPIFY_HMAC_SHA256=self.correct_signature,  # noqa: E501
+                                HTTP_X_SHOPIFY_SHOP_DOMAIN='example.com',  # noqa: E501
+                                HTTP_X_SHOPIFY_WEBHOOK_ID='b54557e4-bdd9')  # noqa: E501
+
+    def test_outbox_failure(self):
+        """If adding the task to the outbox fails, do we leave the
+        webhook unfinished, and process its redelivery?"""
+        with patch.object(OutboxEntry.objects, 'create',
+                          side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                self.post_outbox_delivery()
+        self.assertFalse(JSONWebhookData.objects.filter(
+            status=JSONWebhookData.PROCESSED).exists())
+        self.assertFalse(JSONWebhookData.objects.filter(
+            delivery_id__isnull=False).exists())
+
+        response = self.post_outbox_delivery()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(OutboxEntry.objects.get().webhook.status,
+                         JSONWebhookData.PROCESSED)
+
+
+@override_settings(WEBHOOK_RECEIVER_OUTBOX=True)
+class WooCommerceTestOrderCreationOutbox(WooCommerceTestOrderCreation):
+
+    def test_outbox(self):
+        """Does a valid webhook go to the outbox, and get processed once
+        the outbox is relayed?"""
+        response = self.client.post('/webhooks/woocommerce/order/create',
+                                    self.raw_payload,
+                                    content_type='application/json',
+                                    HTTP_X_WC_WEBHOOK_SIGNATURE=self.correct_signature,  # noqa: E501
+                                    HTTP_X_WC_WEBHOOK_SOURCE='https://example.com')  # noqa: E501
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(WooCommerceOrder.objects.exists())
+        self.assertEqual(OutboxEntry.objects.count(), 1)
+
+        with requests_mock.Mocker() as m:
+            m.register_uri('POST',
+                           self.token_uri,
+                           json=self.token_response)
+            m.register_uri('POST',
+                           self.enroll_uri,
+                           json=bulk_enroll_callback)
+            call_command('relay_outbox', once=True, stdout=StringIO())
+
+        self.assertFalse(OutboxEntry.objects.exists())
+        self.assertEqual(WooCommerceOrder.objects.get().status,
+                         WooCommerceOrder.PROCESSED)
+
+    def post_outbox_delivery(self):
+        return self.client.post('/webhooks/woocommerce/order/create',
+                                self.raw_payload,
+                                content_type='application/json',
+                                HTTP_X_WC_WEBHOOK_SIGNATURE=self.correct_signature,  # noqa: E501
+                                HTTP_X_WC_WEBHOOK_SOURCE='https://example.com',  # noqa: E501
+                                HTTP_X_WC_WEBHOOK_DELIVERY_ID='1234')  # noqa: E501
+
+    def test_outbox_failure(self):
+        """If adding the task to the outbox fails, do we leave the
+        webhook unfinished, and process its redelivery?"""
+        with patch.object(OutboxEntry.objects, 'create',
+                          side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                self.post_outbox_delivery()
+        self.assertFalse(JSONWebhookData.objects.filter(
+            status=JSONWebhookData.PROCESSED).exists())
+        self.assertFalse(JSONWebhookData.objects.filter(
+            delivery_id__isnull=False).exists())
+
+        response = self.post_outbox_delivery()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(OutboxEntry.objects.get().webhook.status,
+                         JSONWebhookData.PROCESSED)
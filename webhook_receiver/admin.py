@@ -0,0 +1,31 @@
+from django.contrib import admin
+
+from .cache import sku_cache
+from .models import CourseMapping
+
+
+@admin.register(CourseMapping)
+class CourseMappingAdmin(admin.ModelAdmin):
+    list_display = ('sku', 'course_id', 'origin', 'modified')
+    list_filter = ('origin',)
+    search_fields = ('sku', 'course_id')
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        # Make sure the change takes effect right away (or, in other
+        # processes, once their local cache entry expires), rather
+        # than when the cached course ID expires. If the SKU itself
+        # was changed, also forget the course ID for the old SKU.
+        sku_cache.delete(obj.sku)
+        if 'sku' in form.initial:
+            sku_cache.delete(form.initial['sku'])
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        sku_cache.delete(obj.sku)
+
+    def delete_queryset(self, request, queryset):
+        skus = list(queryset.values_list('sku', flat=True))
+        super().delete_queryset(request, queryset)
+        for sku in skus:
+            sku_cache.delete(sku)
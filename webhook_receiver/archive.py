@@ -0,0 +1,272 @@
+import base64
+import glob
+import gzip
+import io
+import json
+import logging
+import os
+import re
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import JSONWebhookData
+from .utils import get_order_models
+
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_NAME = 'webhooks-%010d-%010d.jsonl%s'
+ARCHIVE_NAME_REGEX = r'webhooks-(\d+)-(\d+)\.jsonl(\.gz|\.zst)$'
+
+EXTENSIONS = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+
+class ArchiveException(Exception):
+    pass
+
+
+def open_archive(path, mode):
+    """Open a compressed archive file for reading ('r') or writing
+    ('w') text, choosing the compression by the file name extension.
+
+    zstd compression requires the zstandard package.
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+
+    try:
+        import zstandard
+    except ImportError:
+        raise ArchiveException('zstd compression requires '
+                               'the zstandard package')
+    f = open(path, mode + 'b')
+    if mode == 'w':
+        stream = zstandard.ZstdCompressor().stream_writer(f)
+    else:
+        stream = zstandard.ZstdDecompressor().stream_reader(f)
+    return io.TextIOWrapper(stream, encoding='utf-8')
+
+
+def serialize_webhook(webhook, orders=None):
+    """Serialize webhook for the archive, along with the IDs of the
+    orders that were created from it, given as a dictionary of lists
+    keyed by platform."""
+    return {
+        'id': webhook.id,
+        'status': webhook.status,
+        'source': webhook.source,
+        'received': webhook.received.isoformat(),
+        'headers': webhook.headers,
+        'body': base64.b64encode(bytes(webhook.body)).decode(),
+        'content': webhook.content,
+        'content_mode': webhook.content_mode,
+        'delivery_id': webhook.delivery_id,
+        'orders': orders or {},
+    }
+
+
+def deserialize_webhook(record):
+    return JSONWebhookData(
+        id=record['id'],
+        status=record['status'],
+        source=record['source'],
+        received=parse_datetime(record['received']),
+        headers=record['headers'],
+        body=base64.b64decode(record['body']),
+        content=record['content'],
+        # Archives written before we recorded content modes only have
+        # full content.
+        content_mode=record.get('content_mode',
+                                JSONWebhookData.FULL_CONTENT),
+        # Archives written before we recorded delivery IDs don't
+        # have them
+        delivery_id=record.get('delivery_id'),
+    )
+
+
+def get_webhook_orders(webhooks):
+    """Return the IDs of the orders created from each of webhooks,
+    as a dictionary, keyed by webhook ID, of dictionaries of lists,
+    keyed by platform."""
+    orders = {}
+    for platform, model in sorted(get_order_models().items()):
+        for webhook_id, order_id in model.objects.filter(
+                webhook__in=webhooks).values_list('webhook_id', 'id'):
+            orders.setdefault(webhook_id, {}).setdefault(
+                platform, []).append(order_id)
+    return orders
+
+
+def get_archivable_webhooks(days=None):
+    """Return the webhooks that are due for archival: those we have
+    processed successfully more than days (by default,
+    settings.WEBHOOK_RECEIVER_ARCHIVE_AFTER_DAYS) days ago, that
+    aren't waiting in the outbox, and whose orders (if any) have all
+    been processed.
+
+    An order that we may still process (or retry, or reap) needs its
+    webhook, which archiving would unlink it from."""
+    if days is None:
+        days = settings.WEBHOOK_RECEIVER_ARCHIVE_AFTER_DAYS
+    cutoff = timezone.now() - timedelta(days=days)
+    webhooks = JSONWebhookData.objects.filter(
+        status=JSONWebhookData.PROCESSED,
+        received__lt=cutoff,
+        outboxentry__isnull=True,
+    )
+    for model in get_order_models().values():
+        webhooks = webhooks.exclude(
+            id__in=model.objects.filter(
+                webhook__isnull=False,
+            ).exclude(
+                status=model.PROCESSED,
+            ).values('webhook_id')
+        )
+    return webhooks
+
+
+def archive_webhooks(directory=None, days=None, batch_size=None,
+                     compression=None, max_batches=None):
+    """Move webhooks that are due for archival from the database into
+    compressed JSON Lines files in directory. Return the number of
+    webhooks archived.
+
+    Webhooks are archived in batches of batch_size, each of which
+    goes into a file of its own, named after the lowest and highest
+    webhook ID it contains. We only delete a batch from the database
+    once its file is safely written, so at most batch_size webhooks
+    are held in memory, and an interrupted run loses nothing.
+
+    Deleting a webhook unlinks the orders created from it, so we
+    record their IDs in the archive, for restore_webhook() to link
+    them again.
+    """
+    if directory is None:
+        directory = settings.WEBHOOK_RECEIVER_ARCHIVE_DIR
+    if batch_size is None:
+        batch_size = settings.WEBHOOK_RECEIVER_ARCHIVE_BATCH_SIZE
+    if compression is None:
+        compression = settings.WEBHOOK_RECEIVER_ARCHIVE_COMPRESSION
+    if not directory:
+        raise ArchiveException('No archive directory configured')
+    try:
+        extension = EXTENSIONS[compression]
+    except KeyError:
+        raise ArchiveException('Unknown compression %s' % compression)
+
+    os.makedirs(directory, exist_ok=True)
+
+    archived = batches = 0
+    last_id = 0
+    while max_batches is None or batches < max_batches:
+        webhooks = list(get_archivable_webhooks(days).filter(
+            id__gt=last_id
+        ).order_by('id')[:batch_size])
+        if not webhooks:
+            break
+        last_id = webhooks[-1].id
+
+        path = os.path.join(directory,
+                            ARCHIVE_NAME % (webhooks[0].id,
+                                            webhooks[-1].id,
+                                            extension))
+        write_archive(path, webhooks, get_webhook_orders(webhooks))
+
+        with transaction.atomic():
+            JSONWebhookData.objects.filter(
+                id__in=[webhook.id for webhook in webhooks]
+            ).delete()
+
+        logger.info('Archived %d webhooks to %s' % (len(webhooks), path))
+        archived += len(webhooks)
+        batches += 1
+
+    return archived
+
+
+def write_archive(path, webhooks, orders=None):
+    # Write to a temporary file first, so that we never leave a
+    # partially written archive under its final name.
+    orders = orders or {}
+    directory, filename = os.path.split(path)
+    tmp_path = os.path.join(directory, '.tmp-%s' % filename)
+    with open_archive(tmp_path, 'w') as f:
+        for webhook in webhooks:
+            f.write(json.dumps(serialize_webhook(webhook,
+                                                 orders.get(webhook.id))))
+            f.write('\n')
+    with open(tmp_path, 'rb') as f:
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+
+
+def find_archived_webhook(webhook_id, directory=None):
+    """Return the archived webhook with the given ID, as an unsaved
+    JSONWebhookData instance, or None if it isn't in the archive."""
+    record = find_archived_record(webhook_id, directory)
+    if record is None:
+        return None
+    return deserialize_webhook(record)
+
+
+def find_archived_record(webhook_id, directory=None):
+    """Return the archive record of the webhook with the given ID, or
+    None if it isn't in the archive."""
+    if directory is None:
+        directory = settings.WEBHOOK_RECEIVER_ARCHIVE_DIR
+
+    for path in sorted(glob.glob(os.path.join(directory, 'webhooks-*'))):
+        match = re.search(ARCHIVE_NAME_REGEX, path)
+        if not match:
+            continue
+        first, last = int(match.group(1)), int(match.group(2))
+        if not first <= webhook_id <= last:
+            continue
+        with open_archive(path, 'r') as f:
+            for line in f:
+                record = json.loads(line)
+                if record['id'] == webhook_id:
+                    return record
+    return None
+
+
+def restore_webhook(webhook_id, directory=None):
+    """Restore an archived webhook to the database, under its
+    original ID, link the orders that were created from it to it
+    again, and return it.
+
+    Orders that have since been deleted, or linked to another
+    webhook, stay as they are.
+    """
+    if JSONWebhookData.objects.filter(id=webhook_id).exists():
+        raise ArchiveException('Webhook %s exists in the '
+                               'database' % webhook_id)
+    record = find_archived_record(webhook_id, directory)
+    if record is None:
+        raise ArchiveException('Webhook %s not found in the '
+                               'archive' % webhook_id)
+    webhook = deserialize_webhook(record)
+    order_models = get_order_models()
+    with transaction.atomic():
+        webhook.save(force_insert=True)
+        # Archives written before we recorded orders don't have them
+        for platform, order_ids in record.get('orders', {}).items():
+            if platform not in order_models:
+                logger.warning('Not linking %s orders %s to webhook %s, '
+                               'as that platform is not installed' % (
+                                   platform, order_ids, webhook_id))
+                continue
+            order_models[platform].objects.filter(
+                id__in=order_ids,
+                webhook__isnull=True,
+            ).update(webhook=webhook)
+    logger.info('Restored webhook %s from the archive' % webhook_id)
+    return webhook
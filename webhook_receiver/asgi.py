@@ -0,0 +1,16 @@
+import os
+from os.path import abspath, dirname
+from sys import path
+
+SITE_ROOT = dirname(dirname(abspath(__file__)))
+path.append(SITE_ROOT)
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE",
+                      "webhook_receiver.settings.production")
+
+# Serving the webhook receiver via ASGI requires Django 3.0 or later,
+# and taking advantage of it requires Django 3.1 or later, and
+# WEBHOOK_RECEIVER_ASYNC_VIEWS set to True.
+from django.core.asgi import get_asgi_application  # noqa: E402
+
+application = get_asgi_application()
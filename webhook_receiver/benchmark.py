@@ -0,0 +1,290 @@
+"""Benchmark webhook ingest and order processing, end to end.
+
+Synthetic Shopify and WooCommerce webhooks are posted to the real
+webhook views, and the orders they contain are then processed by the
+real Celery tasks (run eagerly), against a stub LMS that answers
+in-process (or against an LMS at a URL of your choice, such as a
+StubLMSServer). See the benchmark_webhooks management command.
+"""
+import json
+import math
+import time
+import tracemalloc
+import uuid
+
+from contextlib import contextmanager
+from celery import current_app
+from celery.app.task import Task
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Max
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from .models import Order, OutboxEntry
+from .stublms import StubLMS, StubLMSAdapter
+from .utils import get_hmac, get_lms_client, get_order_models
+from .utils import reset_lms_clients
+
+
+def make_line_item_sku(index, sku_lookups):
+    if sku_lookups:
+        return 'BENCH%d' % index
+    return 'course-v1:org+bench%d+run' % index
+
+
+def make_shopify_payload(order_id, line_items, padding=0,
+                         sku_lookups=False):
+    return {
+        'id': order_id,
+        'email': 'customer%d@example.com' % order_id,
+        'customer': {
+            'email': 'customer%d@example.com' % order_id,
+            'first_name': 'Benchmark',
+            'last_name': 'Customer',
+        },
+        'line_items': [{
+            'id': order_id * 1000 + i,
+            'sku': make_line_item_sku(i, sku_lookups),
+            'quantity': 1,
+            'price': '10.00',
+            'properties': [{
+                'name': 'email',
+                'value': 'learner%d-%d@example.com' % (order_id, i),
+            }],
+        } for i in range(line_items)],
+        'note': 'x' * padding,
+    }
+
+
+def make_woocommerce_payload(order_id, line_items, padding=0,
+                             sku_lookups=False):
+    return {
+        'id': order_id,
+        'status': 'processing',
+        'date_paid_gmt': '2021-01-01T00:00:00',
+        'billing': {
+            'email': 'customer%d@example.com' % order_id,
+            'first_name': 'Benchmark',
+            'last_name': 'Customer',
+        },
+        'line_items': [{
+            'id': order_id * 1000 + i,
+            'sku': make_line_item_sku(i, sku_lookups),
+            'quantity': 1,
+            'price': 10,
+            'meta_data': [{
+                'id': i,
+                'key': '_alg_wc_pif_global',
+                'value': [{
+                    'type': 'email',
+                    '_value': 'learner%d-%d@example.com' % (order_id, i),
+                }],
+            }],
+        } for i in range(line_items)],
+        'customer_note': 'x' * padding,
+    }
+
+
+def get_shopify_headers(body):
+    conf = settings.WEBHOOK_RECEIVER_SETTINGS['shopify']
+    return {
+        'HTTP_X_SHOPIFY_SHOP_DOMAIN': conf['shop_domain'],
+        'HTTP_X_SHOPIFY_HMAC_SHA256': get_hmac(conf['api_key'], body),
+        'HTTP_X_SHOPIFY_WEBHOOK_ID': str(uuid.uuid4()),
+    }
+
+
+def get_woocommerce_headers(body):
+    conf = settings.WEBHOOK_RECEIVER_SETTINGS['woocommerce']
+    return {
+        'HTTP_X_WC_WEBHOOK_SOURCE': conf['source'],
+        'HTTP_X_WC_WEBHOOK_SIGNATURE': get_hmac(conf['secret'], body),
+        'HTTP_X_WC_WEBHOOK_DELIVERY_ID': str(uuid.uuid4()),
+    }
+
+
+PLATFORMS = {
+    'shopify': {
+        'url': '/webhooks/shopify/order/create',
+        'make_payload': make_shopify_payload,
+        'get_headers': get_shopify_headers,
+    },
+    'woocommerce': {
+        'url': '/webhooks/woocommerce/order/create',
+        'make_payload': make_woocommerce_payload,
+        'get_headers': get_woocommerce_headers,
+    },
+}
+
+
+def percentile(values, p):
+    """Return the pth percentile of values (by the nearest-rank
+    method)."""
+    if not values:
+        return 0
+    values = sorted(values)
+    rank = max(int(math.ceil(p / 100.0 * len(values))), 1)
+    return values[rank - 1]
+
+
+class PhaseResult(object):
+    """Measurements for one phase (ingest or process) of a benchmark
+    run: the latency (in seconds), number of queries, and peak
+    allocated memory (in bytes, if traced) of each webhook."""
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.queries = []
+        self.allocations = []
+        self.errors = 0
+
+    @property
+    def count(self):
+        return len(self.latencies)
+
+    @property
+    def rate(self):
+        total = sum(self.latencies)
+        return self.count / total if total else 0
+
+    def mean(self, values):
+        return sum(values) / len(values) if values else 0
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'rate': self.rate,
+            'p50': percentile(self.latencies, 50),
+            'p99': percentile(self.latencies, 99),
+            'queries': self.mean(self.queries),
+            'allocations': self.mean(self.allocations),
+        }
+
+
+@contextmanager
+def measure(result, trace_allocations=False):
+    """Measure the block, as one webhook of result."""
+    if trace_allocations:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        with CaptureQueriesContext(connection) as queries:
+            yield
+    finally:
+        result.latencies.append(time.perf_counter() - start)
+        result.queries.append(len(queries))
+        if trace_allocations:
+            result.allocations.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+
+
+@contextmanager
+def benchmark_lms(latency=0, lms_url=None):
+    """Send all requests to the LMS at lms_url or, if it's None,
+    answer them in-process with a StubLMS; and run Celery tasks
+    eagerly."""
+    base_url = lms_url or settings.WEBHOOK_RECEIVER_LMS_BASE_URL
+    always_eager = current_app.conf.task_always_eager
+    with override_settings(WEBHOOK_RECEIVER_LMS_BASE_URL=base_url):
+        reset_lms_clients()
+        if lms_url is None:
+            adapter = StubLMSAdapter(StubLMS(latency=latency))
+            get_lms_client().session.mount(base_url, adapter)
+        current_app.conf.task_always_eager = True
+        try:
+            yield
+        finally:
+            current_app.conf.task_always_eager = always_eager
+            reset_lms_clients()
+
+
+@contextmanager
+def captured_tasks():
+    """Collect the tasks that are published (as tuples of task name,
+    args, and kwargs) in the list we yield, rather than publishing or
+    running them."""
+    tasks = []
+
+    def apply_async(task, args=None, kwargs=None, **options):
+        tasks.append((task.name, args or (), kwargs or {}))
+
+    original = Task.apply_async
+    Task.apply_async = apply_async
+    try:
+        yield tasks
+    finally:
+        Task.apply_async = original
+
+
+def run_benchmark(platform, count, line_items=1, padding=0,
+                  sku_lookups=False, trace_allocations=False,
+                  lms_latency=0, lms_url=None, first_order_id=None,
+                  outbox=None):
+    """Post count synthetic webhooks for platform, with line_items
+    line items each (and padding extra bytes), to its webhook view,
+    and then run the tasks that process their orders, against the
+    LMS at lms_url, or an in-process StubLMS that takes lms_latency
+    seconds to answer each request. Return the PhaseResults for
+    ingest and processing.
+
+    If outbox is true (by default, if settings.WEBHOOK_RECEIVER_OUTBOX
+    is), the webhook views store their tasks in the outbox, from
+    where we run them. Otherwise, they record orders and publish
+    their tasks themselves, but we collect those tasks rather than
+    sending them to the broker. Either way, we measure ingesting the
+    webhooks separately from processing them.
+    """
+    if outbox is None:
+        outbox = settings.WEBHOOK_RECEIVER_OUTBOX
+    conf = PLATFORMS[platform]
+    order_model = get_order_models()[platform]
+    if first_order_id is None:
+        # Don't collide with the orders of earlier runs.
+        last_order_id = order_model.objects.aggregate(
+            last=Max('id'))['last']
+        first_order_id = max(last_order_id or 0, 10 ** 9) + 1
+    client = Client()
+    ingest = PhaseResult('ingest')
+    process = PhaseResult('process')
+
+    mode = override_settings(WEBHOOK_RECEIVER_OUTBOX=outbox)
+    with mode, benchmark_lms(lms_latency, lms_url):
+        with captured_tasks() as tasks:
+            for i in range(count):
+                payload = conf['make_payload'](first_order_id + i,
+                                               line_items, padding,
+                                               sku_lookups)
+                body = json.dumps(payload).encode('utf-8')
+                headers = conf['get_headers'](body)
+                with measure(ingest, trace_allocations):
+                    response = client.post(conf['url'], body,
+                                           content_type='application/json',
+                                           **headers)
+                if response.status_code != 200:
+                    ingest.errors += 1
+
+        if outbox:
+            for entry in OutboxEntry.objects.order_by('id'):
+                tasks.append((entry.task, (), entry.kwargs))
+                entry.delete()
+
+        for name, args, kwargs in tasks:
+            with measure(process, trace_allocations):
+                result = current_app.tasks[name].apply(args=args,
+                                                       kwargs=kwargs)
+            if result.failed():
+                process.errors += 1
+
+    # Processing an order happens in a task of its own, whose failure
+    # doesn't fail the task that scheduled it, so count failed orders
+    # separately.
+    process.errors += order_model.objects.filter(
+        id__gte=first_order_id,
+        id__lt=first_order_id + count,
+    ).exclude(status=Order.PROCESSED).count()
+
+    return ingest, process
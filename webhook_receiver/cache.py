@@ -0,0 +1,177 @@
+import hashlib
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+logger = logging.getLogger(__name__)
+
+
+class LocalLRUCache(object):
+    """A small, thread-safe, in-process LRU cache whose entries expire
+    after a per-entry timeout."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the value for key, or None if there is none or if
+        it has expired."""
+        with self._lock:
+            try:
+                value, expires = self._data[key]
+            except KeyError:
+                return None
+            if time.monotonic() >= expires:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + timeout)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class SKUCache(object):
+    """Cache for SKU to course ID resolution.
+
+    Lookups first consult an in-process LRU cache, then the Django
+    cache configured by settings.WEBHOOK_RECEIVER_SKU_CACHE_ALIAS
+    (which is shared between processes, if that cache is). SKUs that
+    we could not resolve to a course ID are cached too, as
+    NOT_FOUND, but usually for a shorter time.
+
+    delete() can only reach the local tier of the process that calls
+    it, so the local tier keeps entries for no longer than
+    settings.WEBHOOK_RECEIVER_SKU_CACHE_LOCAL_TIMEOUT seconds. That
+    bounds how long other processes keep using a deleted entry.
+    """
+
+    KEY_PREFIX = 'webhook_receiver:sku:'
+
+    # Course IDs are never empty, so we can use an empty string to
+    # mark SKUs that don't resolve to one.
+    NOT_FOUND = ''
+
+    def __init__(self, maxsize=None):
+        if maxsize is None:
+            maxsize = settings.WEBHOOK_RECEIVER_SKU_CACHE_LOCAL_SIZE
+        self.local = LocalLRUCache(maxsize)
+        self._stats_lock = threading.Lock()
+        self.reset_stats()
+
+    @property
+    def shared(self):
+        return caches[settings.WEBHOOK_RECEIVER_SKU_CACHE_ALIAS]
+
+    def make_key(self, sku):
+        # Include the LMS URL and SKU prefix in the key, so that
+        # changing either doesn't leave us with stale course IDs.
+        # Hash everything, so that the key is safe to use with
+        # memcached regardless of what characters the SKU contains.
+        raw_key = '%s|%s|%s' % (settings.WEBHOOK_RECEIVER_LMS_BASE_URL,
+                                settings.WEBHOOK_RECEIVER_SKU_PREFIX,
+                                sku)
+        digest = hashlib.sha1(raw_key.encode('utf-8')).hexdigest()
+        return self.KEY_PREFIX + digest
+
+    def _count(self, stat):
+        with self._stats_lock:
+            self._stats[stat] += 1
+
+    def get(self, sku):
+        """Return the cached course ID for sku, NOT_FOUND if sku is
+        known not to resolve, or None if we don't know."""
+        key = self.make_key(sku)
+
+        course_id = self.local.get(key)
+        if course_id is not None:
+            self._count('local_hits')
+            return course_id
+
+        try:
+            course_id = self.shared.get(key)
+        except Exception as e:
+            logger.warning('Unable to read SKU %s from cache: %s' % (sku, e))
+            course_id = None
+        if course_id is not None:
+            self._count('shared_hits')
+            self.local.set(key, course_id, self._local_timeout(course_id))
+            return course_id
+
+        self._count('misses')
+        return None
+
+    def set(self, sku, course_id):
+        """Cache course_id (or NOT_FOUND) for sku."""
+        timeout = self._timeout(course_id)
+        if timeout <= 0:
+            return
+        key = self.make_key(sku)
+        self.local.set(key, course_id, self._local_timeout(course_id))
+        try:
+            self.shared.set(key, course_id, timeout)
+        except Exception as e:
+            logger.warning('Unable to write SKU %s to cache: %s' % (sku, e))
+
+    def delete(self, sku):
+        """Forget what we know about sku. This affects the shared
+        cache tier, and the local tier of this process; other
+        processes forget sku once their local entry expires."""
+        key = self.make_key(sku)
+        self.local.delete(key)
+        try:
+            self.shared.delete(key)
+        except Exception as e:
+            logger.warning('Unable to delete SKU %s from cache: %s' % (sku, e))
+
+    def _timeout(self, course_id):
+        if course_id == self.NOT_FOUND:
+            return settings.WEBHOOK_RECEIVER_SKU_CACHE_NEGATIVE_TIMEOUT
+        return settings.WEBHOOK_RECEIVER_SKU_CACHE_TIMEOUT
+
+    def _local_timeout(self, course_id):
+        return min(self._timeout(course_id),
+                   settings.WEBHOOK_RECEIVER_SKU_CACHE_LOCAL_TIMEOUT)
+
+    def clear(self):
+        """Clear the local cache tier. Shared cache entries are left
+        to expire."""
+        self.local.clear()
+
+    def stats(self):
+        """Return a dictionary of cache hit and miss counts."""
+        with self._stats_lock:
+            return dict(self._stats)
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self._stats = {
+                'local_hits': 0,
+                'shared_hits': 0,
+                'misses': 0,
+            }
+
+
+sku_cache = SKUCache()
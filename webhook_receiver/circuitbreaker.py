@@ -0,0 +1,186 @@
+import hashlib
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+from requests.exceptions import RequestException
+
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpen(RequestException):
+    """Raised instead of sending a request to an LMS that is currently
+    considered down. retry_after is the number of seconds after which
+    it makes sense to try again."""
+
+    def __init__(self, *args, retry_after=0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker(object):
+    """A circuit breaker for requests to one LMS, shared between
+    processes via the Django cache named by
+    settings.WEBHOOK_RECEIVER_LMS_BREAKER_CACHE_ALIAS.
+
+    The circuit is normally closed, letting all requests through. If,
+    within a window of settings.WEBHOOK_RECEIVER_LMS_BREAKER_WINDOW
+    seconds, at least settings.WEBHOOK_RECEIVER_LMS_BREAKER_MIN_REQUESTS
+    requests were sent, and at least the fraction
+    settings.WEBHOOK_RECEIVER_LMS_BREAKER_FAILURE_RATE of them failed
+    (with a 5xx response, or no response at all), the circuit opens:
+    for settings.WEBHOOK_RECEIVER_LMS_BREAKER_COOLDOWN seconds, all
+    requests fail right away, with CircuitOpen. After that, the
+    circuit is half-open: we let a single probe request through at a
+    time, and close the circuit once one succeeds, or open it again
+    if it fails.
+
+    If the cache is unavailable, the circuit stays closed.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    KEY_PREFIX = 'webhook_receiver:breaker:'
+
+    # How long to remember that the circuit has opened for, beyond its
+    # cooldown, while we're waiting for a successful probe.
+    OPEN_TIMEOUT = 3600
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+    @property
+    def cache(self):
+        return caches[settings.WEBHOOK_RECEIVER_LMS_BREAKER_CACHE_ALIAS]
+
+    @property
+    def enabled(self):
+        return settings.WEBHOOK_RECEIVER_LMS_BREAKER_FAILURE_RATE > 0
+
+    def make_key(self, name):
+        # Keep a separate circuit for every LMS, and hash the URL, so
+        # that the key is safe to use with memcached.
+        digest = hashlib.sha1(self.base_url.encode('utf-8')).hexdigest()
+        return '%s%s:%s' % (self.KEY_PREFIX, digest, name)
+
+    def _get_open_until(self):
+        try:
+            return self.cache.get(self.make_key('open_until'))
+        except Exception as e:
+            logger.warning('Unable to read circuit state from cache: %s' % e)
+            return None
+
+    def state(self):
+        """Return the current state of the circuit: CLOSED, OPEN, or
+        HALF_OPEN."""
+        if not self.enabled:
+            return self.CLOSED
+        open_until = self._get_open_until()
+        if open_until is None:
+            return self.CLOSED
+        if time.time() < open_until:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def before_request(self):
+        """Raise CircuitOpen if we mustn't send a request now. Return
+        whether the request is a probe."""
+        if not self.enabled:
+            return False
+        open_until = self._get_open_until()
+        if open_until is None:
+            return False
+
+        now = time.time()
+        if now < open_until:
+            raise CircuitOpen('Circuit for %s is open' % self.base_url,
+                              retry_after=open_until - now)
+
+        # Half-open: only let one probe through at a time. Give up on
+        # a probe that hasn't reported back within the request
+        # timeout.
+        connect_timeout = settings.WEBHOOK_RECEIVER_LMS_CONNECT_TIMEOUT
+        read_timeout = settings.WEBHOOK_RECEIVER_LMS_READ_TIMEOUT
+        probe_timeout = int(connect_timeout + read_timeout) + 1
+        try:
+            probing = self.cache.add(self.make_key('probe'), True,
+                                     probe_timeout)
+        except Exception as e:
+            logger.warning('Unable to read circuit state from cache: %s' % e)
+            return False
+        if not probing:
+            raise CircuitOpen('Circuit for %s is half-open, and already '
+                              'probing' % self.base_url,
+                              retry_after=probe_timeout)
+        logger.info('Probing %s with a request' % self.base_url)
+        return True
+
+    def release_probe(self):
+        """Give up the probe that before_request() let through,
+        without sending a request after all, so that another one may
+        probe the LMS right away."""
+        if not self.enabled:
+            return
+        try:
+            self.cache.delete(self.make_key('probe'))
+        except Exception as e:
+            logger.warning('Unable to record circuit state in cache: %s' % e)
+
+    @staticmethod
+    def is_failure(response):
+        return response is None or response.status_code >= 500
+
+    def record(self, response=None, probe=False):
+        """Record the response to a request (or the failure to get one,
+        if response is None), opening or closing the circuit as
+        needed."""
+        if not self.enabled:
+            return
+        failed = self.is_failure(response)
+        try:
+            if probe:
+                self.cache.delete(self.make_key('probe'))
+                if failed:
+                    self.open()
+                else:
+                    self.close()
+                return
+            self._count(failed)
+        except Exception as e:
+            logger.warning('Unable to record circuit state in cache: %s' % e)
+
+    def _count(self, failed):
+        window_size = settings.WEBHOOK_RECEIVER_LMS_BREAKER_WINDOW
+        window = int(time.time() // window_size)
+        timeout = window_size * 2
+        requests_key = self.make_key('requests:%d' % window)
+        failures_key = self.make_key('failures:%d' % window)
+        self.cache.add(requests_key, 0, timeout)
+        requests = self.cache.incr(requests_key)
+        if not failed:
+            return
+
+        self.cache.add(failures_key, 0, timeout)
+        failures = self.cache.incr(failures_key)
+        min_requests = settings.WEBHOOK_RECEIVER_LMS_BREAKER_MIN_REQUESTS
+        failure_rate = settings.WEBHOOK_RECEIVER_LMS_BREAKER_FAILURE_RATE
+        if requests >= min_requests and failures >= requests * failure_rate:
+            self.open()
+            # Start counting afresh once the circuit closes again.
+            self.cache.delete_many([requests_key, failures_key])
+
+    def open(self):
+        cooldown = settings.WEBHOOK_RECEIVER_LMS_BREAKER_COOLDOWN
+        self.cache.set(self.make_key('open_until'), time.time() + cooldown,
+                       cooldown + self.OPEN_TIMEOUT)
+        logger.warning('Circuit for %s opened, failing requests for '
+                       '%d seconds' % (self.base_url, cooldown))
+
+    def close(self):
+        self.cache.delete(self.make_key('open_until'))
+        logger.info('Circuit for %s closed' % self.base_url)
@@ -0,0 +1,53 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from webhook_receiver.archive import ArchiveException, EXTENSIONS
+from webhook_receiver.archive import archive_webhooks
+from webhook_receiver.archive import get_archivable_webhooks
+
+
+class Command(BaseCommand):
+    help = ('Move webhooks that were successfully processed a while ago '
+            'from the database into compressed archive files.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--directory',
+                            default=settings.WEBHOOK_RECEIVER_ARCHIVE_DIR,
+                            help='Directory to write archive files to')
+        parser.add_argument('--days',
+                            type=int,
+                            default=settings.WEBHOOK_RECEIVER_ARCHIVE_AFTER_DAYS,  # noqa: E501
+                            help='Archive webhooks received more than '
+                            'this many days ago')
+        parser.add_argument('--batch-size',
+                            type=int,
+                            default=settings.WEBHOOK_RECEIVER_ARCHIVE_BATCH_SIZE,  # noqa: E501
+                            help='Maximum number of webhooks per '
+                            'archive file')
+        parser.add_argument('--compression',
+                            choices=sorted(EXTENSIONS),
+                            default=settings.WEBHOOK_RECEIVER_ARCHIVE_COMPRESSION)  # noqa: E501
+        parser.add_argument('--max-batches',
+                            type=int,
+                            help='Stop after writing this many archive '
+                            'files')
+        parser.add_argument('--dry-run',
+                            action='store_true',
+                            help='Only report how many webhooks are due '
+                            'for archival')
+
+    def handle(self, *args, **options):
+        if options['dry_run']:
+            count = get_archivable_webhooks(options['days']).count()
+            self.stdout.write('%d webhooks are due for archival.' % count)
+            return
+
+        try:
+            count = archive_webhooks(directory=options['directory'],
+                                     days=options['days'],
+                                     batch_size=options['batch_size'],
+                                     compression=options['compression'],
+                                     max_batches=options['max_batches'])
+        except ArchiveException as e:
+            raise CommandError(e)
+        self.stdout.write('Archived %d webhooks.' % count)
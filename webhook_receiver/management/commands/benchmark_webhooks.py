@@ -0,0 +1,131 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import setup_test_environment
+from django.test.utils import teardown_test_environment
+
+from webhook_receiver.benchmark import PLATFORMS, run_benchmark
+
+
+class Command(BaseCommand):
+    help = ('Post synthetic webhooks to the webhook views, process their '
+            'orders against a stub LMS, and report throughput, latency, '
+            'queries, and memory allocations per webhook.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--platform',
+                            action='append',
+                            choices=sorted(PLATFORMS),
+                            help='Platform to benchmark (may be given '
+                            'more than once; default: all)')
+        parser.add_argument('--count',
+                            type=int,
+                            default=100,
+                            help='Number of webhooks per run')
+        parser.add_argument('--line-items',
+                            type=int,
+                            nargs='+',
+                            default=[1],
+                            help='Numbers of line items per order, one '
+                            'run each')
+        parser.add_argument('--padding',
+                            type=int,
+                            default=0,
+                            help='Extra bytes to add to each payload')
+        parser.add_argument('--sku-lookups',
+                            action='store_true',
+                            help='Use SKUs that must be resolved via '
+                            'the LMS, rather than course IDs')
+        parser.add_argument('--lms-latency',
+                            type=float,
+                            default=0,
+                            help='Seconds that the in-process stub LMS '
+                            'takes to answer each request')
+        parser.add_argument('--lms-url',
+                            help='Send requests to the LMS at this URL '
+                            '(such as one started with run_stub_lms), '
+                            'rather than answering them in-process')
+        parser.add_argument('--outbox',
+                            action='store_true',
+                            default=None,
+                            help='Store tasks in the outbox, rather '
+                            'than publishing them from the webhook views '
+                            '(default: per WEBHOOK_RECEIVER_OUTBOX)')
+        parser.add_argument('--no-outbox',
+                            action='store_false',
+                            dest='outbox',
+                            help='Publish tasks from the webhook views, '
+                            'rather than storing them in the outbox')
+        parser.add_argument('--allocations',
+                            action='store_true',
+                            help='Trace memory allocations (which '
+                            'slows everything else down)')
+        parser.add_argument('--json',
+                            action='store_true',
+                            help='Report results as JSON lines')
+        parser.add_argument('--use-existing-database',
+                            action='store_true',
+                            help='Run against the configured database, '
+                            'rather than a throwaway test database. '
+                            'This leaves the benchmark webhooks and '
+                            'orders behind.')
+
+    def handle(self, *args, **options):
+        if options['use_existing_database']:
+            self.run(options)
+            return
+
+        old_name = connection.settings_dict['NAME']
+        setup_test_environment()
+        connection.creation.create_test_db(verbosity=0,
+                                           autoclobber=True,
+                                           serialize=False)
+        try:
+            self.run(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+    def run(self, options):
+        if options['outbox'] is None:
+            options['outbox'] = settings.WEBHOOK_RECEIVER_OUTBOX
+        if not options['json']:
+            self.stdout.write('%-12s %-8s %-7s %6s %6s %6s %9s %8s %8s %8s %9s' % (  # noqa: E501
+                'platform', 'phase', 'path', 'items', 'count', 'errors',
+                'req/s', 'p50 ms', 'p99 ms', 'queries', 'alloc KiB'))
+
+        for platform in options['platform'] or sorted(PLATFORMS):
+            for line_items in options['line_items']:
+                phases = run_benchmark(
+                    platform,
+                    options['count'],
+                    line_items=line_items,
+                    padding=options['padding'],
+                    sku_lookups=options['sku_lookups'],
+                    trace_allocations=options['allocations'],
+                    lms_latency=options['lms_latency'],
+                    lms_url=options['lms_url'],
+                    outbox=options['outbox'],
+                )
+                for phase in phases:
+                    self.report(platform, phase, line_items, options)
+
+    def report(self, platform, phase, line_items, options):
+        summary = phase.summary()
+        if options['json']:
+            summary.update(platform=platform,
+                           phase=phase.name,
+                           outbox=options['outbox'],
+                           line_items=line_items,
+                           padding=options['padding'])
+            self.stdout.write(json.dumps(summary, sort_keys=True))
+            return
+
+        self.stdout.write('%-12s %-8s %-7s %6d %6d %6d %9.1f %8.2f %8.2f %8.1f %9.1f' % (  # noqa: E501
+            platform, phase.name,
+            'outbox' if options['outbox'] else 'direct', line_items,
+            summary['count'], summary['errors'], summary['rate'],
+            summary['p50'] * 1000, summary['p99'] * 1000,
+            summary['queries'], summary['allocations'] / 1024.0))
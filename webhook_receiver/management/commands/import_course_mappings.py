@@ -0,0 +1,95 @@
+import csv
+import os
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from webhook_receiver.cache import sku_cache
+from webhook_receiver.models import CourseMapping
+from webhook_receiver.utils import COURSE_ID_REGEX, record_course_mapping
+
+
+class Command(BaseCommand):
+    help = ('Import SKU to course ID mappings from a CSV or YAML file. '
+            'CSV files contain one SKU and course ID per row, optionally '
+            'preceded by a "sku,course_id" header row. YAML files contain '
+            'either a dictionary of SKUs and course IDs, or a list of '
+            'dictionaries with "sku" and "course_id" keys.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('filename')
+        parser.add_argument('--format',
+                            choices=('csv', 'yaml'),
+                            help='File format (default: guess from the '
+                            'file name extension)')
+
+    def handle(self, *args, **options):
+        filename = options['filename']
+        file_format = options['format']
+        if not file_format:
+            extension = os.path.splitext(filename)[1].lower()
+            file_format = 'yaml' if extension in ('.yml', '.yaml') else 'csv'
+
+        try:
+            with open(filename, newline='') as f:
+                if file_format == 'yaml':
+                    mappings = self.read_yaml(f)
+                else:
+                    mappings = self.read_csv(f)
+        except OSError as e:
+            raise CommandError('Unable to read %s: %s' % (filename, e))
+
+        for sku, course_id in mappings:
+            if not sku or not re.match(COURSE_ID_REGEX, course_id):
+                raise CommandError('Invalid mapping from SKU "%s" to '
+                                   'course ID "%s"' % (sku, course_id))
+
+        changed = 0
+        with transaction.atomic():
+            for sku, course_id in mappings:
+                if record_course_mapping(sku, course_id,
+                                         CourseMapping.MANUAL):
+                    changed += 1
+        for sku, _ in mappings:
+            sku_cache.delete(sku)
+
+        self.stdout.write('Imported %d mappings '
+                          '(%d new or changed).' % (len(mappings), changed))
+
+    def read_csv(self, f):
+        mappings = []
+        for row in csv.reader(f):
+            row = [column.strip() for column in row]
+            if not any(row) or row[0].startswith('#'):
+                continue
+            if [column.lower() for column in row] == ['sku', 'course_id']:
+                continue
+            if len(row) != 2:
+                raise CommandError('Expected SKU and course ID, '
+                                   'got: %s' % ','.join(row))
+            mappings.append(tuple(row))
+        return mappings
+
+    def read_yaml(self, f):
+        try:
+            import yaml
+        except ImportError:
+            raise CommandError('Importing YAML files requires PyYAML.')
+
+        try:
+            data = yaml.safe_load(f)
+        except yaml.YAMLError as e:
+            raise CommandError('Unable to parse YAML: %s' % e)
+
+        try:
+            if isinstance(data, dict):
+                items = data.items()
+            else:
+                items = ((d['sku'], d['course_id']) for d in data or [])
+            return [(str(sku).strip(), str(course_id).strip())
+                    for sku, course_id in items]
+        except (KeyError, TypeError):
+            raise CommandError('Expected a dictionary of SKUs and course '
+                               'IDs, or a list of dictionaries with "sku" '
+                               'and "course_id" keys.')
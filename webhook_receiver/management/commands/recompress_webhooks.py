@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from webhook_receiver.utils import recompress_webhook_bodies
+
+
+class Command(BaseCommand):
+    help = ('Rewrite the stored bodies of existing webhooks with the '
+            'configured compression, in batches.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--compression',
+                            choices=['none', 'zlib', 'zstd'],
+                            default=settings.WEBHOOK_RECEIVER_BODY_COMPRESSION,  # noqa: E501
+                            help='Compression to rewrite bodies with')
+        parser.add_argument('--batch-size',
+                            type=int,
+                            default=1000,
+                            help='Number of webhooks to rewrite per '
+                            'transaction')
+        parser.add_argument('--max-batches',
+                            type=int,
+                            help='Stop after this many batches')
+
+    def handle(self, *args, **options):
+        examined, rewritten = recompress_webhook_bodies(
+            compression=options['compression'],
+            batch_size=options['batch_size'],
+            max_batches=options['max_batches'],
+        )
+        self.stdout.write('Examined %d webhooks, rewrote %d.' % (examined,
+                                                                 rewritten))
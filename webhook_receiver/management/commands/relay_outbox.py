@@ -0,0 +1,44 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from webhook_receiver.utils import relay_outbox
+
+
+class Command(BaseCommand):
+    help = ('Publish the Celery tasks that webhook views have stored in '
+            'the outbox (with WEBHOOK_RECEIVER_OUTBOX enabled). Unless '
+            'invoked with --once, keep polling the outbox for new tasks.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size',
+                            type=int,
+                            default=settings.WEBHOOK_RECEIVER_OUTBOX_BATCH_SIZE,  # noqa: E501
+                            help='Maximum number of tasks to publish '
+                            'per database transaction')
+        parser.add_argument('--interval',
+                            type=float,
+                            default=1.0,
+                            help='Seconds to wait before polling the '
+                            'outbox again, once it is empty')
+        parser.add_argument('--once',
+                            action='store_true',
+                            help='Exit once the outbox is empty')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        total = 0
+        try:
+            while True:
+                close_old_connections()
+                relayed = relay_outbox(batch_size)
+                total += relayed
+                if relayed < batch_size:
+                    if options['once']:
+                        break
+                    time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write('Relayed %d tasks.' % total)
@@ -0,0 +1,144 @@
+import itertools
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from webhook_receiver import STATE
+from webhook_receiver.replay import PLATFORM_HEADERS, Replayer
+from webhook_receiver.replay import iter_webhooks
+from webhook_receiver.utils import parse_timestamp
+
+
+STATUSES = dict((label.lower(), status) for status, label in STATE.CHOICES)
+
+
+class Command(BaseCommand):
+    help = ('Replay stored webhooks against a webhook receiver, re-signed '
+            'with test secrets, at a given rate and concurrency.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('url',
+                            help='Base URL of the webhook receiver to '
+                            'replay webhooks to (e.g. '
+                            'http://localhost:8000)')
+        parser.add_argument('--shopify-secret',
+                            help='Secret to sign Shopify webhooks with '
+                            '(the Shopify API key that the target '
+                            'receiver is configured with)')
+        parser.add_argument('--woocommerce-secret',
+                            help='Secret to sign WooCommerce webhooks '
+                            'with (the WooCommerce secret that the '
+                            'target receiver is configured with)')
+        parser.add_argument('--secret',
+                            help='Secret to sign webhooks from any '
+                            'platform without a secret of its own with')
+        parser.add_argument('--platform',
+                            action='append',
+                            choices=sorted(PLATFORM_HEADERS),
+                            help='Only replay webhooks from this platform; '
+                            'can be given more than once')
+        parser.add_argument('--since',
+                            help='Only replay webhooks received at or '
+                            'after this date or time (ISO 8601)')
+        parser.add_argument('--until',
+                            help='Only replay webhooks received before '
+                            'this date or time (ISO 8601)')
+        parser.add_argument('--status',
+                            action='append',
+                            choices=sorted(STATUSES),
+                            help='Only replay webhooks in this state; can '
+                            'be given more than once')
+        parser.add_argument('--limit',
+                            type=int,
+                            help='Replay at most this many webhooks')
+        parser.add_argument('--concurrency',
+                            type=int,
+                            default=1,
+                            help='Number of requests to have in flight at '
+                            'a time')
+        parser.add_argument('--rate',
+                            type=float,
+                            default=0,
+                            help='Send at most this many requests per '
+                            'second (0 means no limit)')
+        parser.add_argument('--speedup',
+                            type=float,
+                            default=0,
+                            help='Instead of at a fixed rate, replay '
+                            'webhooks at the intervals at which they were '
+                            'received, divided by this factor')
+        parser.add_argument('--shop-domain',
+                            help='Replace the Shopify shop domain with '
+                            'this one')
+        parser.add_argument('--source',
+                            help='Replace the WooCommerce webhook source '
+                            'with this one')
+        parser.add_argument('--keep-delivery-ids',
+                            action='store_true',
+                            help='Replay webhooks with their original '
+                            'delivery IDs, rather than new ones (so that '
+                            'the target may ignore them as duplicates)')
+        parser.add_argument('--timeout',
+                            type=float,
+                            default=30,
+                            help='Seconds to wait for each response')
+        parser.add_argument('--json',
+                            action='store_true',
+                            help='Report the results as JSON')
+
+    def handle(self, *args, **options):
+        if options['concurrency'] < 1:
+            raise CommandError('--concurrency must be at least 1')
+        if options['rate'] and options['speedup']:
+            raise CommandError('--rate and --speedup are mutually '
+                               'exclusive')
+        try:
+            since = options['since'] and parse_timestamp(options['since'])
+            until = options['until'] and parse_timestamp(options['until'])
+        except ValueError as e:
+            raise CommandError(e)
+
+        platforms = options['platform'] or sorted(PLATFORM_HEADERS)
+        secrets = {}
+        for platform in platforms:
+            secret = options['%s_secret' % platform] or options['secret']
+            if not secret:
+                raise CommandError('No secret to sign %s webhooks with; '
+                                   'use --%s-secret or --secret' % (
+                                       platform, platform))
+            secrets[platform] = secret
+
+        webhooks = iter_webhooks(
+            platforms=platforms,
+            since=since,
+            until=until,
+            statuses=[STATUSES[s] for s in options['status'] or []],
+        )
+        if options['limit'] is not None:
+            webhooks = itertools.islice(webhooks, options['limit'])
+
+        replayer = Replayer(
+            options['url'],
+            secrets,
+            concurrency=options['concurrency'],
+            rate=options['rate'],
+            speedup=options['speedup'],
+            shops={
+                'shopify': options['shop_domain'],
+                'woocommerce': options['source'],
+            },
+            new_delivery_ids=not options['keep_delivery_ids'],
+            timeout=options['timeout'],
+        )
+        summary = replayer.replay(webhooks).summary()
+
+        if options['json']:
+            self.stdout.write(json.dumps(summary, sort_keys=True))
+            return
+        self.stdout.write('Replayed %d webhooks (%d errors) at %.1f/s, '
+                          'p50 %.2f ms, p99 %.2f ms.' % (
+                              summary['count'], summary['errors'],
+                              summary['rate'], summary['p50'] * 1000,
+                              summary['p99'] * 1000))
+        for status, count in sorted(summary['statuses'].items()):
+            self.stdout.write('  %-6s %8d' % (status, count))
@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from webhook_receiver.archive import ArchiveException, restore_webhook
+
+
+class Command(BaseCommand):
+    help = ('Restore an archived webhook to the database, and link the '
+            'orders that were created from it to it again.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('webhook_id', type=int)
+        parser.add_argument('--directory',
+                            default=settings.WEBHOOK_RECEIVER_ARCHIVE_DIR,
+                            help='Directory containing the archive files')
+
+    def handle(self, *args, **options):
+        try:
+            webhook = restore_webhook(options['webhook_id'],
+                                      options['directory'])
+        except ArchiveException as e:
+            raise CommandError(e)
+        self.stdout.write('Restored webhook %s.' % webhook.id)
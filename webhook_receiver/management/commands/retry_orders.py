@@ -0,0 +1,88 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from webhook_receiver.utils import get_order_models, get_platform_tasks
+from webhook_receiver.utils import parse_timestamp
+
+
+class Command(BaseCommand):
+    help = ('Reset orders that have failed to process, and schedule '
+            'them for processing again, at a limited rate.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--platform',
+                            action='append',
+                            help='Only retry orders from this platform '
+                            '(e.g. shopify or woocommerce); can be given '
+                            'more than once')
+        parser.add_argument('--since',
+                            help='Only retry orders received at or after '
+                            'this date or time (ISO 8601)')
+        parser.add_argument('--until',
+                            help='Only retry orders received before this '
+                            'date or time (ISO 8601)')
+        parser.add_argument('--error',
+                            help='Only retry orders that failed with this '
+                            'type of error (e.g. HTTPError)')
+        parser.add_argument('--rate',
+                            type=float,
+                            default=settings.WEBHOOK_RECEIVER_RETRY_RATE,
+                            help='Schedule at most this many orders per '
+                            'second (0 means no limit)')
+        parser.add_argument('--batch-size',
+                            type=int,
+                            default=settings.WEBHOOK_RECEIVER_RETRY_BATCH_SIZE,  # noqa: E501
+                            help='Number of orders to schedule at a time')
+        parser.add_argument('--dry-run',
+                            action='store_true',
+                            help='Only report how many orders would be '
+                            'retried')
+
+    def handle(self, *args, **options):
+        models = get_order_models()
+        platforms = options['platform'] or sorted(models)
+        unknown = set(platforms) - set(models)
+        if unknown:
+            raise CommandError('Unknown platform(s): %s' %
+                               ', '.join(sorted(unknown)))
+
+        try:
+            since = options['since'] and parse_timestamp(options['since'])
+            until = options['until'] and parse_timestamp(options['until'])
+        except ValueError as e:
+            raise CommandError(e)
+
+        for platform in platforms:
+            model = models[platform]
+            orders = model.objects.filter(status=model.ERROR)
+            if since:
+                orders = orders.filter(received__gte=since)
+            if until:
+                orders = orders.filter(received__lt=until)
+            if options['error']:
+                orders = orders.filter(
+                    last_error__startswith='%s:' % options['error']
+                )
+
+            # Orders without a webhook would only fail again.
+            missing = orders.filter(webhook__isnull=True).count()
+            if missing:
+                self.stdout.write('%s: skipping %d failed orders without '
+                                  'a webhook; restore their webhooks with '
+                                  'restore_webhook to retry them.' % (
+                                      platform, missing))
+            orders = orders.filter(webhook__isnull=False)
+
+            if options['dry_run']:
+                self.stdout.write('%s: %d failed orders to retry.' % (
+                    platform, orders.count()))
+                continue
+
+            tasks = get_platform_tasks(model)
+            count = tasks.retry_failed_orders(
+                orders,
+                rate=options['rate'],
+                batch_size=options['batch_size'],
+            )
+            self.stdout.write('%s: scheduled %d failed orders for '
+                              'processing.' % (platform, count))
@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand
+
+from webhook_receiver.stublms import StubLMS, StubLMSServer
+
+
+class Command(BaseCommand):
+    help = ('Run a stub LMS, which answers OAuth2 token, SKU lookup, and '
+            'bulk enrollment requests, for load testing.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host',
+                            default='127.0.0.1',
+                            help='Address to listen on')
+        parser.add_argument('--port',
+                            type=int,
+                            default=18000,
+                            help='Port to listen on')
+        parser.add_argument('--latency',
+                            type=float,
+                            default=0,
+                            help='Seconds to take to answer each request')
+        parser.add_argument('--jitter',
+                            type=float,
+                            default=0,
+                            help='Maximum number of seconds by which to '
+                            'randomly vary the latency')
+        parser.add_argument('--error-rate',
+                            type=float,
+                            default=0,
+                            help='Fraction of requests to fail with '
+                            'HTTP 503')
+        parser.add_argument('--rate-limit',
+                            type=int,
+                            default=0,
+                            help='Maximum number of requests per second, '
+                            'beyond which requests fail with HTTP 429')
+
+    def handle(self, *args, **options):
+        lms = StubLMS(latency=options['latency'],
+                      jitter=options['jitter'],
+                      error_rate=options['error_rate'],
+                      rate_limit=options['rate_limit'])
+        server = StubLMSServer((options['host'], options['port']), lms)
+        self.stdout.write('Stub LMS listening at %s' % server.url)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        self.stdout.write('Answered %d requests.' % lms.requests)
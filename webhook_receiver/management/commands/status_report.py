@@ -0,0 +1,68 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Min
+
+from webhook_receiver import STATE
+from webhook_receiver.models import WebhookData, Order, OrderItem
+
+
+class Command(BaseCommand):
+    help = ('Report how many webhooks, orders, and order items are in '
+            'each state, and when the oldest unfinished ones were '
+            'received.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--explain',
+                            action='store_true',
+                            help='Also show the query plans for the '
+                            'report queries, to check that they use '
+                            'indexes')
+
+    def get_models(self):
+        return [model for model in apps.get_models()
+                if issubclass(model, (WebhookData, Order, OrderItem))]
+
+    def has_received(self, model):
+        return any(field.name == 'received' for field in model._meta.fields)
+
+    def handle(self, *args, **options):
+        for model in self.get_models():
+            self.stdout.write(model._meta.label)
+            has_received = self.has_received(model)
+
+            # Both of these queries only need the (status, received)
+            # or (status, order) index, not the table itself.
+            counts = model.objects.order_by().values(
+                'status'
+            ).annotate(count=Count('status'))
+            counts = dict((c['status'], c['count']) for c in counts)
+            for status, label in STATE.CHOICES:
+                line = '  %-12s %10d' % (label,
+                                         counts.get(status, 0))
+                unfinished = status != STATE.PROCESSED
+                if has_received and unfinished and counts.get(status):
+                    oldest = model.objects.filter(
+                        status=status
+                    ).aggregate(oldest=Min('received'))['oldest']
+                    line += '  (oldest: %s)' % oldest.isoformat()
+                self.stdout.write(line)
+
+            if options['explain']:
+                self.explain(model)
+
+    def explain(self, model):
+        querysets = [
+            model.objects.order_by().values('status').annotate(
+                count=Count('status')
+            ),
+        ]
+        if self.has_received(model):
+            querysets.append(
+                model.objects.filter(status=STATE.PROCESSING).values(
+                    'status'
+                ).annotate(oldest=Min('received'))
+            )
+        for queryset in querysets:
+            self.stdout.write('  %s' % queryset.query)
+            for line in queryset.explain().splitlines():
+                self.stdout.write('    %s' % line)
@@ -0,0 +1,66 @@
+import re
+
+from django.apps import apps
+from django.core.management.base import BaseCommand
+
+from requests.exceptions import RequestException
+
+from webhook_receiver.cache import sku_cache
+from webhook_receiver.models import CourseMapping, OrderItem
+from webhook_receiver.utils import COURSE_ID_REGEX, SKULookupException
+from webhook_receiver.utils import record_course_mapping, resolve_course_id
+
+
+class Command(BaseCommand):
+    help = ('Resolve the SKUs of all order items received so far via the '
+            'LMS, and record them as course mappings.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--refresh',
+                            action='store_true',
+                            help='Also resolve SKUs that already have a '
+                            'course mapping. Mappings that were not '
+                            'resolved via the LMS are left unchanged.')
+        parser.add_argument('--dry-run',
+                            action='store_true',
+                            help='Only list the SKUs that would be '
+                            'resolved.')
+
+    def get_skus(self):
+        skus = set()
+        for model in apps.get_models():
+            if issubclass(model, OrderItem):
+                skus.update(model.objects.values_list('sku',
+                                                      flat=True).distinct())
+        return sorted(sku for sku in skus
+                      if not re.match(COURSE_ID_REGEX, sku))
+
+    def handle(self, *args, **options):
+        skus = self.get_skus()
+        existing = CourseMapping.objects.filter(sku__in=skus)
+        if options['refresh']:
+            existing = existing.filter(origin=CourseMapping.MANUAL)
+        skip = set(existing.values_list('sku', flat=True))
+        skus = [sku for sku in skus if sku not in skip]
+
+        if options['dry_run']:
+            for sku in skus:
+                self.stdout.write(sku)
+            return
+
+        resolved = failed = 0
+        for sku in skus:
+            try:
+                course_id = resolve_course_id(sku)
+            except (SKULookupException, RequestException) as e:
+                self.stderr.write('Unable to resolve SKU %s: %s' % (sku, e))
+                failed += 1
+                continue
+            record_course_mapping(sku, course_id, CourseMapping.RESOLVED)
+            sku_cache.delete(sku)
+            resolved += 1
+
+        self.stdout.write('Resolved %d SKUs (%d failed, '
+                          '%d already mapped).' % (resolved,
+                                                   failed,
+                                                   len(skip)))
@@ -0,0 +1,185 @@
+"""Prometheus metrics for the webhook receiver.
+
+Metrics are only recorded if settings.WEBHOOK_RECEIVER_METRICS is
+enabled, and the prometheus_client package is installed. To collect
+metrics from several processes (such as gunicorn and Celery workers),
+point the PROMETHEUS_MULTIPROC_DIR environment variable of all of
+them to the same, initially empty, directory.
+"""
+import functools
+import os
+import time
+
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.utils import timezone
+
+from .circuitbreaker import CircuitBreaker
+from .profiling import get_profile
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+    from prometheus_client.core import GaugeMetricFamily
+except ImportError:
+    prometheus_client = None
+
+
+class CircuitStateCollector(object):
+    """Report the state of the circuit breaker for the LMS, which we
+    look up in the cache on every scrape, rather than track in each
+    process."""
+
+    STATES = (CircuitBreaker.CLOSED,
+              CircuitBreaker.HALF_OPEN,
+              CircuitBreaker.OPEN)
+
+    def collect(self):
+        breaker = CircuitBreaker(settings.WEBHOOK_RECEIVER_LMS_BASE_URL)
+        current = breaker.state()
+        gauge = GaugeMetricFamily('webhook_receiver_lms_circuit_state',
+                                  'State of the circuit breaker for the LMS',
+                                  labels=['state'])
+        for state in self.STATES:
+            gauge.add_metric([state], 1 if state == current else 0)
+        yield gauge
+
+
+if prometheus_client is not None:
+    registry = prometheus_client.CollectorRegistry()
+
+    WEBHOOKS = prometheus_client.Counter(
+        'webhook_receiver_webhooks',
+        'Webhooks received, by platform and HTTP response status',
+        ['platform', 'status'],
+        registry=registry)
+    WEBHOOK_DURATION = prometheus_client.Histogram(
+        'webhook_receiver_webhook_duration_seconds',
+        'Time spent handling webhooks, by platform and step',
+        ['platform', 'step'],
+        registry=registry)
+    QUEUE_LAG = prometheus_client.Histogram(
+        'webhook_receiver_queue_lag_seconds',
+        'Time from receiving a webhook to processing its order',
+        ['platform'],
+        buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600),
+        registry=registry)
+    ORDERS = prometheus_client.Counter(
+        'webhook_receiver_orders',
+        'Order processing attempts, by platform and outcome',
+        ['platform', 'outcome'],
+        registry=registry)
+    LMS_DURATION = prometheus_client.Histogram(
+        'webhook_receiver_lms_duration_seconds',
+        'Time spent on LMS operations',
+        ['operation'],
+        registry=registry)
+    LMS_RESPONSES = prometheus_client.Counter(
+        'webhook_receiver_lms_responses',
+        'Responses to requests to the LMS, by HTTP status '
+        '("error" if there was none)',
+        ['status'],
+        registry=registry)
+
+    LMS_CONNECTIONS = prometheus_client.Counter(
+        'webhook_receiver_lms_connections',
+        'HTTP requests sent to the LMS (including retries), by whether '
+        'they opened a new connection ("new") or reused one ("reused")',
+        ['connection'],
+        registry=registry)
+
+    HISTOGRAMS = {
+        'webhook': WEBHOOK_DURATION,
+        'lms': LMS_DURATION,
+    }
+
+    if not os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry.register(CircuitStateCollector())
+
+
+def is_enabled():
+    return prometheus_client is not None and settings.WEBHOOK_RECEIVER_METRICS
+
+
+def get_registry():
+    """Return the registry to export metrics from. In multiprocess
+    mode, that is a fresh one that collects the metrics of all
+    processes."""
+    if not os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        return registry
+    collector_registry = prometheus_client.CollectorRegistry()
+    multiprocess.MultiProcessCollector(collector_registry)
+    collector_registry.register(CircuitStateCollector())
+    return collector_registry
+
+
+@contextmanager
+def timed(histogram, **labels):
+    """Record the time spent in the block (or, used as a decorator, in
+    the function) in the 'webhook' or 'lms' histogram, with the given
+    labels. Also add it to the profile of the current request, if it
+    is being profiled (see webhook_receiver.profiling)."""
+    enabled = is_enabled()
+    profile = get_profile()
+    if not enabled and profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        if enabled:
+            HISTOGRAMS[histogram].labels(**labels).observe(elapsed)
+        if profile is not None:
+            profile.add(labels.get('step') or labels['operation'], elapsed)
+
+
+def count_webhooks(platform):
+    """Decorate a webhook view, to count the webhooks it receives, by
+    response status, and the time it takes to handle them."""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            with timed('webhook', platform=platform, step='total'):
+                response = view(request, *args, **kwargs)
+            if is_enabled():
+                WEBHOOKS.labels(platform=platform,
+                                status=response.status_code).inc()
+            return response
+        return wrapper
+    return decorator
+
+
+def count_order(platform, outcome):
+    """Count an attempt to process an order, whose outcome is
+    'success', 'retry', or 'failure'."""
+    if is_enabled():
+        ORDERS.labels(platform=platform, outcome=outcome).inc()
+
+
+def observe_queue_lag(platform, received):
+    """Record how long ago we received the webhook that we are now
+    processing."""
+    if is_enabled():
+        lag = (timezone.now() - received).total_seconds()
+        QUEUE_LAG.labels(platform=platform).observe(max(lag, 0))
+
+
+def count_lms_response(response):
+    """Count a response from the LMS, or the failure to get one, if
+    response is None."""
+    if is_enabled():
+        status = response.status_code if response is not None else 'error'
+        LMS_RESPONSES.labels(status=status).inc()
+
+
+def count_lms_connections(opened, reused):
+    """Count requests sent to the LMS over opened new connections, and
+    over reused ones."""
+    if is_enabled():
+        if opened:
+            LMS_CONNECTIONS.labels(connection='new').inc(opened)
+        if reused:
+            LMS_CONNECTIONS.labels(connection='reused').inc(reused)
@@ -0,0 +1,26 @@
+# Generated by Django 2.2.28 on 2026-10-16 23:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webhook_receiver', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CourseMapping',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sku', models.CharField(max_length=254, unique=True)),
+                ('course_id', models.CharField(max_length=255)),
+                ('origin', models.IntegerField(choices=[(0, 'Manual'), (1, 'Resolved')], default=0)),
+                ('modified', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 2.2.28 on 2026-10-17 00:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import django_jsonfield_backport.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webhook_receiver', '0002_coursemapping'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task', models.CharField(max_length=254)),
+                ('kwargs', django_jsonfield_backport.models.JSONField(default=dict)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('webhook', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='webhook_receiver.JSONWebhookData')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 2.2.28 on 2026-10-17 00:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webhook_receiver', '0003_outboxentry'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='jsonwebhookdata',
+            index=models.Index(fields=['status', 'received'], name='wr_webhook_status_received'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 2.2.28 on 2026-10-17 00:12
+
+from django.db import migrations
+import webhook_receiver.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webhook_receiver', '0004_status_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='jsonwebhookdata',
+            name='body',
+            field=webhook_receiver.models.CompressedBinaryField(),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-17 00:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webhook_receiver', '0005_compressed_body'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='jsonwebhookdata',
+            name='delivery_id',
+            field=models.CharField(blank=True, max_length=100, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-17 01:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webhook_receiver', '0006_delivery_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='jsonwebhookdata',
+            name='content_mode',
+            field=models.CharField(choices=[('full', 'Full'), ('minimal', 'Minimal'), ('none', 'None')], default='full', max_length=10),
+        ),
+    ]
@@ -1,6 +1,7 @@
 from django.db.models import Model
 from django.db.models import GenericIPAddressField, BinaryField, DateTimeField
 from django.db.models import CharField, BigIntegerField, EmailField
+from django.db.models import IntegerField, ForeignKey, CASCADE, Index
 try:
     # Django 3.1 and later has a built-in JSONField
     from django.db.models import JSONField
@@ -9,12 +10,19 @@ except ImportError:
     # django-jsonfield-backport
     from django_jsonfield_backport.models import JSONField
 
+from django.conf import settings
 from django_fsm import FSMIntegerField, ConcurrentTransitionMixin, transition
 from django.utils import timezone
 
 from . import STATE
 
+import json
 import logging
+import os
+import socket
+import zlib
+
+from datetime import timedelta
 
 
 APP_LABEL = 'webhook_receiver'
@@ -22,6 +30,70 @@ APP_LABEL = 'webhook_receiver'
 logger = logging.getLogger(__name__)
 
 
+def get_lease_owner():
+    """Identify this process, as the owner of order leases."""
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def format_error(error):
+    """Describe an exception (or a string) for Order.last_error."""
+    if isinstance(error, Exception):
+        error = '%s: %s' % (type(error).__name__, error)
+    return error[:254]
+
+
+class CompressedBinaryField(BinaryField):
+    """A BinaryField that stores its value compressed.
+
+    Compressed values are stored with a header identifying the
+    compression (zlib or zstd), so that we can read them regardless
+    of the compression currently configured (in
+    settings.WEBHOOK_RECEIVER_BODY_COMPRESSION), and values without
+    such a header, such as those stored before we compressed them,
+    are read as is. We also store values as is if compressing them
+    doesn't make them any smaller.
+    """
+
+    ZLIB_HEADER = b'\x00zl'
+    ZSTD_HEADER = b'\x00zs'
+
+    @classmethod
+    def compress(cls, value, compression=None):
+        if compression is None:
+            compression = settings.WEBHOOK_RECEIVER_BODY_COMPRESSION
+        if compression == 'zlib':
+            compressed = cls.ZLIB_HEADER + zlib.compress(value)
+        elif compression == 'zstd':
+            import zstandard
+            compressor = zstandard.ZstdCompressor()
+            compressed = cls.ZSTD_HEADER + compressor.compress(value)
+        else:
+            return value
+        return compressed if len(compressed) < len(value) else value
+
+    @classmethod
+    def decompress(cls, value):
+        header = value[:len(cls.ZLIB_HEADER)]
+        if header == cls.ZLIB_HEADER:
+            return zlib.decompress(value[len(cls.ZLIB_HEADER):])
+        elif header == cls.ZSTD_HEADER:
+            import zstandard
+            return zstandard.ZstdDecompressor().decompress(
+                value[len(cls.ZSTD_HEADER):]
+            )
+        return value
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return value
+        return self.decompress(bytes(value))
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if value is not None:
+            value = self.compress(bytes(value))
+        return super().get_db_prep_value(value, connection, prepared)
+
+
 class WebhookData(ConcurrentTransitionMixin, Model):
     """Abstract base class for webhook data."""
     class Meta:
@@ -46,7 +118,7 @@ class WebhookData(ConcurrentTransitionMixin, Model):
     # This is for storing the webhook payload exactly as received
     # (i.e. from request.body), which comes in handy for signature
     # verification.
-    body = BinaryField()
+    body = CompressedBinaryField()
 
     @transition(field=status,
                 source=NEW,
@@ -74,10 +146,122 @@ class JSONWebhookData(WebhookData):
     class Meta:
         app_label = APP_LABEL
         abstract = False
+        indexes = [
+            Index(fields=['status', 'received'],
+                  name='wr_webhook_status_received'),
+        ]
+
+    FULL_CONTENT = 'full'
+    MINIMAL_CONTENT = 'minimal'
+    NO_CONTENT = 'none'
+
+    CONTENT_CHOICES = (
+        (FULL_CONTENT, 'Full'),
+        (MINIMAL_CONTENT, 'Minimal'),
+        (NO_CONTENT, 'None'),
+    )
 
     # In addition to the webhook source and timestamp, we also want
     # the webhook content, which in this case is always JSON data.
+    # Depending on settings.WEBHOOK_RECEIVER_STORE_CONTENT at the time
+    # we received the webhook, which we record in content_mode, this
+    # may only contain the fields we need for processing orders, or be
+    # empty; use payload to always get the full content, or
+    # order_content to get at least the fields we need for processing
+    # orders.
     content = JSONField(null=True)
+    content_mode = CharField(max_length=10,
+                             choices=CONTENT_CHOICES,
+                             default=FULL_CONTENT)
+
+    # The platform's ID for this delivery of the webhook (prefixed
+    # with the platform name), which we record once we've accepted
+    # it, so that we can ignore redeliveries.
+    delivery_id = CharField(max_length=100, null=True, blank=True,
+                            unique=True)
+
+    _payload = None
+
+    @property
+    def payload(self):
+        """The full webhook content. Unless we stored the full content
+        in content (or have no body to parse), parse it from body
+        (once)."""
+        if self._payload is None:
+            full = self.content_mode == self.FULL_CONTENT
+            if self.content is not None and (full or not self.body):
+                return self.content
+            self._payload = json.loads(bytes(self.body).decode('utf-8'))
+        return self._payload
+
+    @property
+    def order_content(self):
+        """The webhook content, or at least the parts of it that we
+        need for processing orders. Unlike payload, this doesn't parse
+        body if content has what we need."""
+        if self._payload is None and self.content is not None:
+            return self.content
+        return self.payload
+
+    @payload.setter
+    def payload(self, value):
+        self._payload = value
+
+
+class CourseMapping(Model):
+    """A SKU, and the course ID it resolves to.
+
+    lookup_course_id() consults this table before it tries to resolve
+    a SKU via the LMS, and records the course IDs it does resolve that
+    way here.
+    """
+
+    class Meta:
+        app_label = APP_LABEL
+        abstract = False
+
+    MANUAL = 0
+    RESOLVED = 1
+
+    ORIGIN_CHOICES = (
+        (MANUAL, 'Manual'),
+        (RESOLVED, 'Resolved'),
+    )
+
+    sku = CharField(max_length=254, unique=True)
+    course_id = CharField(max_length=255)
+    origin = IntegerField(choices=ORIGIN_CHOICES,
+                          default=MANUAL)
+    modified = DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return '%s -> %s' % (self.sku, self.course_id)
+
+
+class OutboxEntry(Model):
+    """A Celery task waiting to be published for a webhook.
+
+    Webhook views store these in the database, rather than publishing
+    tasks to the Celery broker themselves, if
+    settings.WEBHOOK_RECEIVER_OUTBOX is enabled. The relay_outbox
+    management command then publishes them, and removes them from the
+    outbox.
+    """
+
+    class Meta:
+        app_label = APP_LABEL
+        abstract = False
+
+    webhook = ForeignKey(
+        JSONWebhookData,
+        on_delete=CASCADE
+    )
+    task = CharField(max_length=254)
+    kwargs = JSONField(default=dict)
+    created = DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return '%s (webhook %s)' % (self.task, self.webhook_id)
 
 
 class Order(ConcurrentTransitionMixin, Model):
@@ -100,6 +284,34 @@ class Order(ConcurrentTransitionMixin, Model):
     status = FSMIntegerField(choices=CHOICES,
                              default=NEW,
                              protected=True)
+    # Why we last failed to process the order, as the exception type
+    # and message (e.g. "HTTPError: 503 Server Error").
+    last_error = CharField(max_length=254, blank=True, default='')
+    # While we're processing the order, who is processing it, and
+    # until when. If the lease expires before the order is processed,
+    # whoever held it has probably died, and the order gets
+    # rescheduled (see webhook_receiver.utils.reap_expired_orders()).
+    lease_owner = CharField(max_length=254, blank=True, default='')
+    lease_expires = DateTimeField(null=True, blank=True)
+
+    def set_lease(self, timeout=None):
+        if timeout is None:
+            timeout = settings.WEBHOOK_RECEIVER_LEASE_TIMEOUT
+        self.lease_owner = get_lease_owner()
+        self.lease_expires = timezone.now() + timedelta(seconds=timeout)
+
+    def clear_lease(self):
+        self.lease_owner = ''
+        self.lease_expires = None
+
+    def renew_lease(self, timeout=None):
+        """Extend the lease on an order that we're already processing,
+        without touching anything else."""
+        self.set_lease(timeout)
+        type(self).objects.filter(pk=self.pk).update(
+            lease_owner=self.lease_owner,
+            lease_expires=self.lease_expires,
+        )
 
     @transition(field=status,
                 source=NEW,
@@ -107,6 +319,7 @@ class Order(ConcurrentTransitionMixin, Model):
                 on_error=ERROR)
     def start_processing(self):
         logger.debug('Processing order %s' % self.id)
+        self.set_lease()
 
     @transition(field=status,
                 source=PROCESSING,
@@ -114,12 +327,25 @@ class Order(ConcurrentTransitionMixin, Model):
                 on_error=ERROR)
     def finish_processing(self):
         logger.debug('Finishing order %s' % self.id)
+        self.clear_lease()
 
+    # An order can fail before we start processing it, for example if
+    # its webhook is missing.
     @transition(field=status,
-                source=PROCESSING,
+                source=[NEW, PROCESSING],
                 target=ERROR)
-    def fail(self):
+    def fail(self, error=None):
         logger.debug('Failed to process order %s' % self.id)
+        self.clear_lease()
+        if error is not None:
+            self.last_error = format_error(error)
+
+    @transition(field=status,
+                source=ERROR,
+                target=NEW)
+    def retry(self):
+        logger.debug('Retrying order %s' % self.id)
+        self.last_error = ''
 
 
 class OrderItem(ConcurrentTransitionMixin, Model):
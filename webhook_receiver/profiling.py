@@ -0,0 +1,136 @@
+"""Per-request profiling of webhook deliveries.
+
+ProfilerMiddleware profiles requests to the webhook URLs, if
+settings.WEBHOOK_RECEIVER_PROFILE is enabled, or the request carries
+the header named by settings.WEBHOOK_RECEIVER_PROFILE_HEADER, set to
+settings.WEBHOOK_RECEIVER_PROFILE_SECRET. It
+counts and times the request's SQL queries, and collects the time
+spent in the steps that code along the way wraps in profiled() (or
+webhook_receiver.metrics.timed()). It then logs a single line with
+the profile, and, if the profile was requested via the header, also
+returns it in a Server-Timing header. The settings only add the
+middleware if either is configured.
+
+Profiles only cover the thread that handles the request, so they
+miss the work that async webhook views do in their thread pool.
+"""
+import hmac
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection
+
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_PATH_PREFIX = '/webhooks/'
+
+_local = threading.local()
+
+
+class Profile(object):
+    """The SQL queries and the time spent in each profiled step of a
+    request."""
+
+    def __init__(self):
+        self.queries = 0
+        self.query_time = 0
+        self.timings = OrderedDict()
+
+    def add(self, name, seconds):
+        self.timings[name] = self.timings.get(name, 0) + seconds
+
+    def __call__(self, execute, sql, params, many, context):
+        # Act as a database execute wrapper.
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.query_time += time.perf_counter() - start
+
+    def format(self):
+        """Return the profile as a compact log message."""
+        parts = ['sql=%d/%.1fms' % (self.queries, self.query_time * 1000)]
+        parts.extend('%s=%.1fms' % (name, seconds * 1000)
+                     for name, seconds in self.timings.items())
+        return ' '.join(parts)
+
+    def server_timing(self):
+        """Return the profile as the value of a Server-Timing header."""
+        metrics = ['sql;dur=%.1f;desc="%d queries"' % (self.query_time * 1000,
+                                                       self.queries)]
+        metrics.extend('%s;dur=%.1f' % (name, seconds * 1000)
+                       for name, seconds in self.timings.items())
+        return ', '.join(metrics)
+
+
+def get_profile():
+    """Return the Profile of the current request, if it's being
+    profiled."""
+    return getattr(_local, 'profile', None)
+
+
+@contextmanager
+def profiled(name):
+    """Add the time spent in the block to the profile of the current
+    request (if any), as step name."""
+    profile = get_profile()
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add(name, time.perf_counter() - start)
+
+
+class ProfilerMiddleware(object):
+    """Profile requests to the webhook URLs, if so configured or
+    requested."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def is_requested(self, request):
+        # Anyone can send a header, so we only honor it if it carries
+        # the secret.
+        header = settings.WEBHOOK_RECEIVER_PROFILE_HEADER
+        secret = settings.WEBHOOK_RECEIVER_PROFILE_SECRET
+        if not (header and secret):
+            return False
+        value = request.headers.get(header, '')
+        return hmac.compare_digest(value.encode('utf-8'),
+                                   secret.encode('utf-8'))
+
+    def __call__(self, request):
+        if not request.path_info.startswith(WEBHOOK_PATH_PREFIX):
+            return self.get_response(request)
+        requested = self.is_requested(request)
+        if not (requested or settings.WEBHOOK_RECEIVER_PROFILE):
+            return self.get_response(request)
+
+        profile = _local.profile = Profile()
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(profile):
+                response = self.get_response(request)
+        finally:
+            _local.profile = None
+        # The webhook views usually time themselves already.
+        if 'total' not in profile.timings:
+            profile.add('total', time.perf_counter() - start)
+
+        logger.info('Profile of %s %s (%s): %s' % (request.method,
+                                                   request.path_info,
+                                                   response.status_code,
+                                                   profile.format()))
+        if requested:
+            response['Server-Timing'] = profile.server_timing()
+        return response
@@ -0,0 +1,158 @@
+import hashlib
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+
+from requests.exceptions import RequestException
+
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitExceeded(RequestException):
+    """Raised when we can't send a request to the LMS within
+    settings.WEBHOOK_RECEIVER_LMS_RATE_LIMIT_MAX_WAIT seconds, without
+    exceeding the rate limit."""
+    pass
+
+
+class AdaptiveRateLimiter(object):
+    """A rate limiter for requests to one LMS, shared between processes
+    via the Django cache named by
+    settings.WEBHOOK_RECEIVER_LMS_RATE_LIMIT_CACHE_ALIAS.
+
+    Requests take tokens from a bucket that is refilled at the start of
+    every second with as many tokens as the current rate allows. The
+    rate adapts to how the LMS copes (additive increase, multiplicative
+    decrease): every successful response raises it by
+    settings.WEBHOOK_RECEIVER_LMS_RATE_LIMIT_INCREASE requests per
+    second, up to the limit for the LMS (its entry in
+    settings.WEBHOOK_RECEIVER_LMS_RATE_LIMITS, or by default
+    settings.WEBHOOK_RECEIVER_LMS_RATE_LIMIT), and every
+    HTTP 429 or 5xx response (or failure to get a response at all)
+    multiplies it by settings.WEBHOOK_RECEIVER_LMS_RATE_LIMIT_DECREASE,
+    down to settings.WEBHOOK_RECEIVER_LMS_RATE_LIMIT_MIN.
+
+    If the cache is unavailable, we let requests through rather than
+    hold them up. Django's dummy cache stores nothing, so with it, we
+    don't limit requests at all.
+    """
+
+    KEY_PREFIX = 'webhook_receiver:ratelimit:'
+
+    # How long to remember the current rate for, if it doesn't change.
+    RATE_TIMEOUT = 3600
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.warned = False
+
+    @property
+    def cache(self):
+        return caches[settings.WEBHOOK_RECEIVER_LMS_RATE_LIMIT_CACHE_ALIAS]
+
+    @property
+    def max_rate(self):
+        """Return the configured rate limit for this LMS, in requests
+        per second."""
+        limits = dict((url.rstrip('/'), limit) for url, limit in
+                      settings.WEBHOOK_RECEIVER_LMS_RATE_LIMITS.items())
+        return limits.get(self.base_url.rstrip('/'),
+                          settings.WEBHOOK_RECEIVER_LMS_RATE_LIMIT)
+
+    @property
+    def enabled(self):
+        if self.max_rate <= 0:
+            return False
+        if isinstance(self.cache, DummyCache):
+            if not self.warned:
+                logger.warning('Not limiting the rate of requests to %s, '
+                               'which requires a shared cache' %
+                               self.base_url)
+                self.warned = True
+            return False
+        return True
+
+    def make_key(self, name):
+        # Keep a separate limit for every LMS, and hash the URL, so
+        # that the key is safe to use with memcached.
+        digest = hashlib.sha1(self.base_url.encode('utf-8')).hexdigest()
+        return '%s%s:%s' % (self.KEY_PREFIX, digest, name)
+
+    def get_rate(self):
+        """Return the current rate limit, in requests per second."""
+        max_rate = self.max_rate
+        try:
+            rate = self.cache.get(self.make_key('rate'))
+        except Exception as e:
+            logger.warning('Unable to read rate limit from cache: %s' % e)
+            rate = None
+        if rate is None:
+            return max_rate
+        return min(rate, max_rate)
+
+    def set_rate(self, rate):
+        try:
+            self.cache.set(self.make_key('rate'), rate, self.RATE_TIMEOUT)
+        except Exception as e:
+            logger.warning('Unable to write rate limit to cache: %s' % e)
+
+    def acquire(self):
+        """Wait until we may send a request. Raise RateLimitExceeded
+        if that would take longer than
+        settings.WEBHOOK_RECEIVER_LMS_RATE_LIMIT_MAX_WAIT seconds."""
+        if not self.enabled:
+            return
+        max_wait = settings.WEBHOOK_RECEIVER_LMS_RATE_LIMIT_MAX_WAIT
+        deadline = time.monotonic() + max_wait
+        while True:
+            now = time.time()
+            second = int(now)
+            key = self.make_key('tokens:%d' % second)
+            try:
+                self.cache.add(key, 0, 10)
+                used = self.cache.incr(key)
+            except Exception as e:
+                logger.warning('Unable to apply rate limit: %s' % e)
+                return
+            if used <= max(int(self.get_rate()), 1):
+                return
+
+            wait = second + 1 - now
+            if time.monotonic() + wait > deadline:
+                raise RateLimitExceeded('Rate limit for %s '
+                                        'exceeded' % self.base_url)
+            time.sleep(wait)
+
+    @staticmethod
+    def is_overloaded(response):
+        """Return whether response (or the lack of one) suggests that
+        the LMS is struggling."""
+        if response is None:
+            return True
+        return response.status_code == 429 or response.status_code >= 500
+
+    def record(self, response=None):
+        """Adapt the rate to response, or to the failure to get one, if
+        response is None."""
+        if not self.enabled:
+            return
+        rate = self.get_rate()
+        if self.is_overloaded(response):
+            new_rate = max(
+                rate * settings.WEBHOOK_RECEIVER_LMS_RATE_LIMIT_DECREASE,
+                settings.WEBHOOK_RECEIVER_LMS_RATE_LIMIT_MIN
+            )
+            if new_rate < rate:
+                logger.warning('Reducing rate of requests to %s to '
+                               '%.1f/s' % (self.base_url, new_rate))
+        else:
+            new_rate = min(
+                rate + settings.WEBHOOK_RECEIVER_LMS_RATE_LIMIT_INCREASE,
+                self.max_rate
+            )
+        if new_rate != rate:
+            self.set_rate(new_rate)
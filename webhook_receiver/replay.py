@@ -0,0 +1,243 @@
+"""Replay stored webhooks against a webhook receiver, for load tests
+and capacity planning. See the replay_webhooks management command.
+"""
+import functools
+import logging
+import operator
+import threading
+import time
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from django.db.models import Q
+from django.urls import reverse
+
+from .benchmark import percentile
+from .models import JSONWebhookData
+from .utils import get_hmac
+
+
+logger = logging.getLogger(__name__)
+
+# For each platform, the header that identifies it, the header that
+# carries the signature, the header that carries the delivery ID, the
+# header that names the shop, and the name of the webhook URL.
+PLATFORM_HEADERS = {
+    'shopify': {
+        'marker': 'X-Shopify-Hmac-Sha256',
+        'signature': 'X-Shopify-Hmac-Sha256',
+        'delivery_id': 'X-Shopify-Webhook-Id',
+        'shop': 'X-Shopify-Shop-Domain',
+        'url_name': 'shopify_order_create',
+    },
+    'woocommerce': {
+        'marker': 'X-Wc-Webhook-Signature',
+        'signature': 'X-Wc-Webhook-Signature',
+        'delivery_id': 'X-Wc-Webhook-Delivery-Id',
+        'shop': 'X-Wc-Webhook-Source',
+        'url_name': 'woocommerce_order_create',
+    },
+}
+
+# Headers that describe the original connection, rather than the
+# webhook, and that we therefore don't replay.
+SKIPPED_HEADERS = ('host', 'content-length', 'connection',
+                   'transfer-encoding', 'accept-encoding')
+
+
+def get_webhook_platform(webhook):
+    """Return the platform that sent webhook, judging by its headers,
+    or None if we can't tell."""
+    headers = set(name.lower() for name in webhook.headers)
+    for platform, conf in PLATFORM_HEADERS.items():
+        if conf['marker'].lower() in headers:
+            return platform
+    return None
+
+
+def iter_webhooks(platforms=None, since=None, until=None, statuses=None,
+                  batch_size=100):
+    """Yield stored webhooks from platforms (default: all), received
+    since and until the given times, in the given states, in the
+    order we received them, and with their platforms. Load them in
+    batches of batch_size, so that we needn't keep them all in
+    memory."""
+    webhooks = JSONWebhookData.objects.order_by('id')
+    if platforms:
+        # We store headers as Django presents them, so their names
+        # are capitalized like the markers.
+        webhooks = webhooks.filter(functools.reduce(operator.or_, (
+            Q(headers__has_key=PLATFORM_HEADERS[platform]['marker'])
+            for platform in platforms
+        )))
+    if since:
+        webhooks = webhooks.filter(received__gte=since)
+    if until:
+        webhooks = webhooks.filter(received__lt=until)
+    if statuses:
+        webhooks = webhooks.filter(status__in=statuses)
+
+    last_id = None
+    while True:
+        batch = webhooks
+        if last_id is not None:
+            batch = batch.filter(id__gt=last_id)
+        batch = list(batch[:batch_size])
+        if not batch:
+            return
+        last_id = batch[-1].id
+
+        for webhook in batch:
+            platform = get_webhook_platform(webhook)
+            if platform is None:
+                logger.debug('Skipping webhook %s from an unknown '
+                             'platform' % webhook.id)
+                continue
+            yield webhook, platform
+
+
+def get_replay_headers(webhook, platform, secret, shop=None,
+                       new_delivery_id=True):
+    """Return the headers to replay webhook with: the original ones,
+    but signed with secret, and optionally with a different shop
+    domain or source, and a new delivery ID."""
+    conf = PLATFORM_HEADERS[platform]
+    headers = dict((name, value) for name, value in webhook.headers.items()
+                   if name.lower() not in SKIPPED_HEADERS)
+    headers[conf['signature']] = get_hmac(secret, bytes(webhook.body))
+    if shop:
+        headers[conf['shop']] = shop
+    if new_delivery_id and conf['delivery_id'] in headers:
+        headers[conf['delivery_id']] = str(uuid.uuid4())
+    return headers
+
+
+class ReplayResult(object):
+    """The outcome of a replay: the latency (in seconds) and HTTP
+    status ('error' if there was no response) of each request, and
+    how long the replay took overall."""
+
+    def __init__(self):
+        self.latencies = []
+        self.statuses = {}
+        self.elapsed = 0
+        self._lock = threading.Lock()
+
+    def record(self, status, latency):
+        with self._lock:
+            self.latencies.append(latency)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    @property
+    def count(self):
+        return len(self.latencies)
+
+    @property
+    def errors(self):
+        return sum(count for status, count in self.statuses.items()
+                   if status == 'error' or status >= 400)
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'rate': self.count / self.elapsed if self.elapsed else 0,
+            'p50': percentile(self.latencies, 50),
+            'p99': percentile(self.latencies, 99),
+            'statuses': dict((str(status), count) for status, count
+                             in sorted(self.statuses.items(), key=str)),
+        }
+
+
+class Replayer(object):
+    """Replay webhooks to the webhook receiver at base_url, each
+    re-signed with the secret for its platform in secrets, with up to
+    concurrency requests in flight.
+
+    Send at most rate requests per second or, if speedup is set, keep
+    the original intervals between webhooks, divided by speedup. If
+    neither is set, send requests as fast as the receiver answers
+    them.
+    """
+
+    def __init__(self, base_url, secrets, concurrency=1, rate=0,
+                 speedup=0, shops=None, new_delivery_ids=True,
+                 timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.secrets = secrets
+        self.concurrency = concurrency
+        self.rate = rate
+        self.speedup = speedup
+        self.shops = shops or {}
+        self.new_delivery_ids = new_delivery_ids
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def get_session(self):
+        # requests sessions aren't guaranteed to be thread-safe, so
+        # give each worker thread its own.
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def get_url(self, platform):
+        return self.base_url + reverse(PLATFORM_HEADERS[platform]['url_name'])
+
+    def send(self, result, url, headers, body):
+        start = time.perf_counter()
+        try:
+            response = self.get_session().post(url, data=body,
+                                               headers=headers,
+                                               timeout=self.timeout)
+            status = response.status_code
+        except requests.RequestException as e:
+            logger.warning('Failed to replay webhook to %s: %s' % (url, e))
+            status = 'error'
+        result.record(status, time.perf_counter() - start)
+
+    def get_delay(self, index, webhook, first):
+        """Return how many seconds after starting the replay to send
+        the index-th webhook."""
+        if self.speedup:
+            offset = (webhook.received - first.received).total_seconds()
+            return offset / self.speedup
+        if self.rate:
+            return index / self.rate
+        return 0
+
+    def replay(self, webhooks):
+        """Replay webhooks, an iterable of (webhook, platform) tuples,
+        and return a ReplayResult."""
+        result = ReplayResult()
+        # Don't read webhooks much further ahead than we can send them.
+        slots = threading.BoundedSemaphore(self.concurrency * 2)
+
+        def release(future):
+            slots.release()
+
+        start = time.monotonic()
+        first = None
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for index, (webhook, platform) in enumerate(webhooks):
+                if first is None:
+                    first = webhook
+                wait = start + self.get_delay(index, webhook, first)
+                wait -= time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+
+                headers = get_replay_headers(webhook, platform,
+                                             self.secrets[platform],
+                                             self.shops.get(platform),
+                                             self.new_delivery_ids)
+                slots.acquire()
+                future = executor.submit(self.send, result,
+                                         self.get_url(platform),
+                                         headers, bytes(webhook.body))
+                future.add_done_callback(release)
+        result.elapsed = time.monotonic() - start
+        return result
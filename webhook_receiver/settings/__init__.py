@@ -1,4 +1,5 @@
 from __future__ import unicode_literals
+import django
 import environ
 import os
 import platform
@@ -27,6 +28,12 @@ INSTALLED_APPS = [
     'webhook_receiver_woocommerce',
 ]
 
+# For Django versions before 3.1, JSONField comes from
+# django-jsonfield-backport, which can only read JSON data back from
+# the database if it is an installed app.
+if django.VERSION < (3, 1):
+    INSTALLED_APPS.append('django_jsonfield_backport')
+
 MIDDLEWARE = [
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
@@ -164,10 +171,140 @@ WEBHOOK_RECEIVER_EDX_OAUTH2_SECRET = env.str(
     'DJANGO_WEBHOOK_RECEIVER_EDX_OAUTH2_SECRET',
     default='')
 
+# Outbound HTTP requests to the LMS share a pool of up to
+# WEBHOOK_RECEIVER_LMS_POOL_SIZE keep-alive connections (per
+# process), and time out after WEBHOOK_RECEIVER_LMS_CONNECT_TIMEOUT
+# seconds when connecting, or WEBHOOK_RECEIVER_LMS_READ_TIMEOUT
+# seconds when waiting for a response. Idempotent requests (like SKU
+# lookups, but not enrollments) are retried up to
+# WEBHOOK_RECEIVER_LMS_MAX_RETRIES times on connection errors and on
+# HTTP 502, 503, and 504, waiting WEBHOOK_RECEIVER_LMS_RETRY_BACKOFF
+# seconds before the second retry, and twice as long before each
+# subsequent one.
+WEBHOOK_RECEIVER_LMS_POOL_SIZE = env.int(
+    'DJANGO_WEBHOOK_RECEIVER_LMS_POOL_SIZE',
+    default=10)
+WEBHOOK_RECEIVER_LMS_CONNECT_TIMEOUT = env.float(
+    'DJANGO_WEBHOOK_RECEIVER_LMS_CONNECT_TIMEOUT',
+    default=5.0)
+WEBHOOK_RECEIVER_LMS_READ_TIMEOUT = env.float(
+    'DJANGO_WEBHOOK_RECEIVER_LMS_READ_TIMEOUT',
+    default=30.0)
+WEBHOOK_RECEIVER_LMS_MAX_RETRIES = env.int(
+    'DJANGO_WEBHOOK_RECEIVER_LMS_MAX_RETRIES',
+    default=2)
+WEBHOOK_RECEIVER_LMS_RETRY_BACKOFF = env.float(
+    'DJANGO_WEBHOOK_RECEIVER_LMS_RETRY_BACKOFF',
+    default=0.5)
+
+# If WEBHOOK_RECEIVER_LMS_RATE_LIMIT is greater than 0, all processes
+# together send at most that many requests per second to the LMS. The
+# limit adapts to how the LMS copes: every HTTP 429 or 5xx response
+# multiplies it by WEBHOOK_RECEIVER_LMS_RATE_LIMIT_DECREASE (down to
+# WEBHOOK_RECEIVER_LMS_RATE_LIMIT_MIN), and every successful response
+# raises it by WEBHOOK_RECEIVER_LMS_RATE_LIMIT_INCREASE, back up to
+# WEBHOOK_RECEIVER_LMS_RATE_LIMIT. A request that would have to wait
+# longer than WEBHOOK_RECEIVER_LMS_RATE_LIMIT_MAX_WAIT seconds fails,
+# and is retried later. Rate limiting requires a Django cache that
+# all processes share, named by
+# WEBHOOK_RECEIVER_LMS_RATE_LIMIT_CACHE_ALIAS; with Django's dummy
+# cache, requests aren't limited.
+#
+# WEBHOOK_RECEIVER_LMS_RATE_LIMITS overrides the limit for individual
+# LMS base URLs, given as "https://lms.example.com=10;..." in the
+# environment. The other rate limit settings apply to all of them.
+WEBHOOK_RECEIVER_LMS_RATE_LIMIT = env.float(
+    'DJANGO_WEBHOOK_RECEIVER_LMS_RATE_LIMIT',
+    default=0.0)
+WEBHOOK_RECEIVER_LMS_RATE_LIMITS = env.dict(
+    'DJANGO_WEBHOOK_RECEIVER_LMS_RATE_LIMITS',
+    cast={'value': float},
+    default={})
+WEBHOOK_RECEIVER_LMS_RATE_LIMIT_MIN = env.float(
+    'DJANGO_WEBHOOK_RECEIVER_LMS_RATE_LIMIT_MIN',
+    default=1.0)
+WEBHOOK_RECEIVER_LMS_RATE_LIMIT_INCREASE = env.float(
+    'DJANGO_WEBHOOK_RECEIVER_LMS_RATE_LIMIT_INCREASE',
+    default=0.5)
+WEBHOOK_RECEIVER_LMS_RATE_LIMIT_DECREASE = env.float(
+    'DJANGO_WEBHOOK_RECEIVER_LMS_RATE_LIMIT_DECREASE',
+    default=0.5)
+WEBHOOK_RECEIVER_LMS_RATE_LIMIT_MAX_WAIT = env.float(
+    'DJANGO_WEBHOOK_RECEIVER_LMS_RATE_LIMIT_MAX_WAIT',
+    default=2.0)
+WEBHOOK_RECEIVER_LMS_RATE_LIMIT_CACHE_ALIAS = env.str(
+    'DJANGO_WEBHOOK_RECEIVER_LMS_RATE_LIMIT_CACHE_ALIAS',
+    default='default')
+
+# If WEBHOOK_RECEIVER_LMS_BREAKER_FAILURE_RATE is greater than 0, we
+# stop sending requests to the LMS for
+# WEBHOOK_RECEIVER_LMS_BREAKER_COOLDOWN seconds whenever at least
+# that fraction of the requests that we sent within a window of
+# WEBHOOK_RECEIVER_LMS_BREAKER_WINDOW seconds failed (provided they
+# were at least WEBHOOK_RECEIVER_LMS_BREAKER_MIN_REQUESTS), and
+# then only send single probe requests until one succeeds. Orders
+# that we can't process meanwhile are rescheduled, without counting
+# that as a retry. Like rate limiting, this requires a Django cache
+# that all processes share, named by
+# WEBHOOK_RECEIVER_LMS_BREAKER_CACHE_ALIAS.
+WEBHOOK_RECEIVER_LMS_BREAKER_FAILURE_RATE = env.float(
+    'DJANGO_WEBHOOK_RECEIVER_LMS_BREAKER_FAILURE_RATE',
+    default=0.0)
+WEBHOOK_RECEIVER_LMS_BREAKER_MIN_REQUESTS = env.int(
+    'DJANGO_WEBHOOK_RECEIVER_LMS_BREAKER_MIN_REQUESTS',
+    default=10)
+WEBHOOK_RECEIVER_LMS_BREAKER_WINDOW = env.int(
+    'DJANGO_WEBHOOK_RECEIVER_LMS_BREAKER_WINDOW',
+    default=60)
+WEBHOOK_RECEIVER_LMS_BREAKER_COOLDOWN = env.int(
+    'DJANGO_WEBHOOK_RECEIVER_LMS_BREAKER_COOLDOWN',
+    default=30)
+WEBHOOK_RECEIVER_LMS_BREAKER_CACHE_ALIAS = env.str(
+    'DJANGO_WEBHOOK_RECEIVER_LMS_BREAKER_CACHE_ALIAS',
+    default='default')
+
+# Consider OAuth2 access tokens for the LMS expired this many seconds
+# before they actually do, and fetch a new one.
+WEBHOOK_RECEIVER_OAUTH2_TOKEN_EXPIRY_MARGIN = env.int(
+    'DJANGO_WEBHOOK_RECEIVER_OAUTH2_TOKEN_EXPIRY_MARGIN',
+    default=60)
+
 WEBHOOK_RECEIVER_SKU_PREFIX = env.str(
     'DJANGO_WEBHOOK_RECEIVER_SKU_PREFIX',
     default='')
 
+# Resolved SKUs are cached for WEBHOOK_RECEIVER_SKU_CACHE_TIMEOUT
+# seconds, SKUs that we could not resolve for
+# WEBHOOK_RECEIVER_SKU_CACHE_NEGATIVE_TIMEOUT seconds. A timeout of 0
+# disables caching. The cache has two tiers: an in-process LRU cache
+# holding up to WEBHOOK_RECEIVER_SKU_CACHE_LOCAL_SIZE SKUs, for at
+# most WEBHOOK_RECEIVER_SKU_CACHE_LOCAL_TIMEOUT seconds (which is how
+# long other processes may take to notice a changed course mapping),
+# and the Django cache named by WEBHOOK_RECEIVER_SKU_CACHE_ALIAS.
+WEBHOOK_RECEIVER_SKU_CACHE_TIMEOUT = env.int(
+    'DJANGO_WEBHOOK_RECEIVER_SKU_CACHE_TIMEOUT',
+    default=3600)
+WEBHOOK_RECEIVER_SKU_CACHE_NEGATIVE_TIMEOUT = env.int(
+    'DJANGO_WEBHOOK_RECEIVER_SKU_CACHE_NEGATIVE_TIMEOUT',
+    default=300)
+WEBHOOK_RECEIVER_SKU_CACHE_LOCAL_SIZE = env.int(
+    'DJANGO_WEBHOOK_RECEIVER_SKU_CACHE_LOCAL_SIZE',
+    default=1024)
+WEBHOOK_RECEIVER_SKU_CACHE_LOCAL_TIMEOUT = env.int(
+    'DJANGO_WEBHOOK_RECEIVER_SKU_CACHE_LOCAL_TIMEOUT',
+    default=10)
+WEBHOOK_RECEIVER_SKU_CACHE_ALIAS = env.str(
+    'DJANGO_WEBHOOK_RECEIVER_SKU_CACHE_ALIAS',
+    default='default')
+
+# If enabled, SKUs that we resolve via the LMS are recorded as course
+# mappings in the database, so that we don't need to resolve them
+# again.
+WEBHOOK_RECEIVER_RECORD_COURSE_MAPPINGS = env.bool(
+    'DJANGO_WEBHOOK_RECEIVER_RECORD_COURSE_MAPPINGS',
+    default=True
+)
+
 WEBHOOK_RECEIVER_AUTO_ENROLL = env.bool(
     'DJANGO_WEBHOOK_RECEIVER_AUTO_ENROLL',
     default=True
@@ -178,6 +315,172 @@ WEBHOOK_RECEIVER_SEND_ENROLLMENT_EMAIL = env.bool(
     default=True
 )
 
+# If enabled, incoming webhooks are validated in memory and written
+# to the database only once, in their final state (PROCESSED or
+# ERROR), rather than being saved on receipt and on every state
+# transition.
+WEBHOOK_RECEIVER_SINGLE_WRITE_INGEST = env.bool(
+    'DJANGO_WEBHOOK_RECEIVER_SINGLE_WRITE_INGEST',
+    default=False
+)
+
+# What to store as the parsed content of a webhook, in addition to
+# its raw body: "full" (the whole payload), "minimal" (only the parts
+# we need for processing orders), or "none" (nothing, parsing the
+# body again whenever we need the payload). Every webhook records
+# what we stored for it, and unless that is the full payload, we
+# parse the body whenever we need it, so you can change this at any
+# time.
+WEBHOOK_RECEIVER_STORE_CONTENT = env.str(
+    'DJANGO_WEBHOOK_RECEIVER_STORE_CONTENT',
+    default='full')
+
+# If enabled, we record the delivery IDs of the webhooks we accept,
+# and acknowledge redeliveries of them without processing them again.
+# Recently accepted delivery IDs are cached in the default cache for
+# WEBHOOK_RECEIVER_DELIVERY_CACHE_TIMEOUT seconds (0 disables
+# caching), so that we can usually recognize a redelivery without
+# querying the database.
+WEBHOOK_RECEIVER_DEDUPLICATE_DELIVERIES = env.bool(
+    'DJANGO_WEBHOOK_RECEIVER_DEDUPLICATE_DELIVERIES',
+    default=True)
+WEBHOOK_RECEIVER_DELIVERY_CACHE_TIMEOUT = env.int(
+    'DJANGO_WEBHOOK_RECEIVER_DELIVERY_CACHE_TIMEOUT',
+    default=86400)
+
+# Compression for the raw webhook bodies we store in the database:
+# "none", "zlib", or "zstd" (which requires the zstandard package).
+# Compressed bodies remain readable after changing this; use the
+# recompress_webhooks management command to convert existing rows.
+WEBHOOK_RECEIVER_BODY_COMPRESSION = env.str(
+    'DJANGO_WEBHOOK_RECEIVER_BODY_COMPRESSION',
+    default='none')
+
+# If enabled, webhook views don't publish processing tasks to the
+# Celery broker themselves, but store them in an outbox in the
+# database. The relay_outbox management command then publishes them,
+# WEBHOOK_RECEIVER_OUTBOX_BATCH_SIZE at a time.
+WEBHOOK_RECEIVER_OUTBOX = env.bool(
+    'DJANGO_WEBHOOK_RECEIVER_OUTBOX',
+    default=False
+)
+WEBHOOK_RECEIVER_OUTBOX_BATCH_SIZE = env.int(
+    'DJANGO_WEBHOOK_RECEIVER_OUTBOX_BATCH_SIZE',
+    default=100)
+
+# If enabled, webhooks are served by async views. This requires
+# Django 3.1 or later, and only makes sense when serving the webhook
+# receiver via ASGI (webhook_receiver.asgi).
+WEBHOOK_RECEIVER_ASYNC_VIEWS = env.bool(
+    'DJANGO_WEBHOOK_RECEIVER_ASYNC_VIEWS',
+    default=False
+)
+
+# If enabled, and the prometheus_client package is installed, we
+# record Prometheus metrics, and export them at /metrics. For
+# multiprocess deployments, also set the PROMETHEUS_MULTIPROC_DIR
+# environment variable.
+WEBHOOK_RECEIVER_METRICS = env.bool(
+    'DJANGO_WEBHOOK_RECEIVER_METRICS',
+    default=False
+)
+
+# If WEBHOOK_RECEIVER_PROFILE is enabled, we log a profile of every
+# webhook delivery: the number of SQL queries and the time spent on
+# them, and the time spent in each step of handling the webhook. If
+# WEBHOOK_RECEIVER_PROFILE_HEADER names a request header (such as
+# X-Webhook-Receiver-Profile), and WEBHOOK_RECEIVER_PROFILE_SECRET is
+# set, we also profile webhook deliveries whose header carries the
+# secret, and return their profile in a Server-Timing response
+# header. Without either, we don't install the profiling middleware.
+WEBHOOK_RECEIVER_PROFILE = env.bool(
+    'DJANGO_WEBHOOK_RECEIVER_PROFILE',
+    default=False
+)
+WEBHOOK_RECEIVER_PROFILE_HEADER = env.str(
+    'DJANGO_WEBHOOK_RECEIVER_PROFILE_HEADER',
+    default=''
+)
+WEBHOOK_RECEIVER_PROFILE_SECRET = env.str(
+    'DJANGO_WEBHOOK_RECEIVER_PROFILE_SECRET',
+    default=''
+)
+if WEBHOOK_RECEIVER_PROFILE or all((WEBHOOK_RECEIVER_PROFILE_HEADER,
+                                    WEBHOOK_RECEIVER_PROFILE_SECRET)):
+    MIDDLEWARE.insert(0, 'webhook_receiver.profiling.ProfilerMiddleware')
+
+# Unless batching enrollments (see below), send up to this many
+# enrollment requests for the line items of an order at a time. With
+# 1, line items are processed strictly one after the other.
+WEBHOOK_RECEIVER_LINE_ITEM_CONCURRENCY = env.int(
+    'DJANGO_WEBHOOK_RECEIVER_LINE_ITEM_CONCURRENCY',
+    default=1)
+
+# If enabled, the line items of an order are enrolled with one bulk
+# enrollment request per course (and per
+# WEBHOOK_RECEIVER_BATCH_SIZE line items), rather than with one
+# request per line item. If WEBHOOK_RECEIVER_BATCH_WINDOW is greater
+# than 0, line items are collected across all orders received within
+# that many seconds, and enrolled together. That requires a cache
+# that all workers share (see DJANGO_CACHE_URL); with the default
+# dummy cache, the window is ignored.
+WEBHOOK_RECEIVER_BATCH_ENROLLMENTS = env.bool(
+    'DJANGO_WEBHOOK_RECEIVER_BATCH_ENROLLMENTS',
+    default=False
+)
+WEBHOOK_RECEIVER_BATCH_SIZE = env.int(
+    'DJANGO_WEBHOOK_RECEIVER_BATCH_SIZE',
+    default=100)
+WEBHOOK_RECEIVER_BATCH_WINDOW = env.int(
+    'DJANGO_WEBHOOK_RECEIVER_BATCH_WINDOW',
+    default=0)
+
+# While processing an order, a worker holds a lease on it for
+# WEBHOOK_RECEIVER_LEASE_TIMEOUT seconds, which it renews on every
+# attempt. The webhook_receiver.tasks.reap task, meant to be run
+# periodically via Celery beat, reschedules orders whose lease has
+# expired (because the worker died while processing them), up to
+# WEBHOOK_RECEIVER_REAP_BATCH_SIZE orders per platform and run. The
+# lease timeout must exceed the time between task retries.
+WEBHOOK_RECEIVER_LEASE_TIMEOUT = env.int(
+    'DJANGO_WEBHOOK_RECEIVER_LEASE_TIMEOUT',
+    default=600)
+WEBHOOK_RECEIVER_REAP_BATCH_SIZE = env.int(
+    'DJANGO_WEBHOOK_RECEIVER_REAP_BATCH_SIZE',
+    default=100)
+
+# Failed orders that we retry (with the retry_orders management
+# command, or the corresponding admin action) are scheduled for
+# processing WEBHOOK_RECEIVER_RETRY_BATCH_SIZE at a time, at a rate
+# of at most WEBHOOK_RECEIVER_RETRY_RATE orders per second (0 means
+# no limit).
+WEBHOOK_RECEIVER_RETRY_BATCH_SIZE = env.int(
+    'DJANGO_WEBHOOK_RECEIVER_RETRY_BATCH_SIZE',
+    default=50)
+WEBHOOK_RECEIVER_RETRY_RATE = env.float(
+    'DJANGO_WEBHOOK_RECEIVER_RETRY_RATE',
+    default=5.0)
+
+# Webhooks that we processed successfully more than
+# WEBHOOK_RECEIVER_ARCHIVE_AFTER_DAYS days ago can be moved from the
+# database into compressed archive files in
+# WEBHOOK_RECEIVER_ARCHIVE_DIR ("gzip" or "zstd" compressed, the
+# latter requiring the zstandard package), at most
+# WEBHOOK_RECEIVER_ARCHIVE_BATCH_SIZE webhooks per file. Archival is
+# disabled unless WEBHOOK_RECEIVER_ARCHIVE_DIR is set.
+WEBHOOK_RECEIVER_ARCHIVE_DIR = env.str(
+    'DJANGO_WEBHOOK_RECEIVER_ARCHIVE_DIR',
+    default='')
+WEBHOOK_RECEIVER_ARCHIVE_AFTER_DAYS = env.int(
+    'DJANGO_WEBHOOK_RECEIVER_ARCHIVE_AFTER_DAYS',
+    default=365)
+WEBHOOK_RECEIVER_ARCHIVE_BATCH_SIZE = env.int(
+    'DJANGO_WEBHOOK_RECEIVER_ARCHIVE_BATCH_SIZE',
+    default=10000)
+WEBHOOK_RECEIVER_ARCHIVE_COMPRESSION = env.str(
+    'DJANGO_WEBHOOK_RECEIVER_ARCHIVE_COMPRESSION',
+    default='gzip')
+
 WEBHOOK_RECEIVER_SETTINGS = {
     'shopify': {
         'shop_domain': env.str(
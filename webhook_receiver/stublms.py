@@ -0,0 +1,180 @@
+"""A stub LMS, for benchmarks and load tests.
+
+StubLMS answers the requests that the webhook receiver sends to the
+LMS (for an OAuth2 access token, to resolve a SKU, and to enroll
+learners), optionally slowly, failing some of them, or enforcing a
+rate limit. It can answer them either in-process (StubLMSAdapter,
+which never touches the network), or via HTTP (StubLMSServer, see
+the run_stub_lms management command).
+"""
+import io
+import json
+import logging
+import random
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+from django.conf import settings
+
+from requests import Response
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+
+logger = logging.getLogger(__name__)
+
+
+class StubLMS(object):
+    """Answer LMS requests. Every request takes latency seconds (give
+    or take up to jitter seconds), a fraction error_rate of them fail
+    with HTTP 503, and if rate_limit is set, requests beyond that
+    many per second fail with HTTP 429."""
+
+    def __init__(self, latency=0, jitter=0, error_rate=0, rate_limit=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.requests = 0
+        self._second = None
+        self._second_requests = 0
+        self._lock = threading.Lock()
+
+    def is_rate_limited(self):
+        with self._lock:
+            self.requests += 1
+            if not self.rate_limit:
+                return False
+            second = int(time.time())
+            if second != self._second:
+                self._second = second
+                self._second_requests = 0
+            self._second_requests += 1
+            return self._second_requests > self.rate_limit
+
+    def handle(self, method, url, body=b''):
+        """Answer a request for url, which must be absolute. Return
+        the response status, data (to be sent as JSON, or None for no
+        body), and headers."""
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+        if self.is_rate_limited():
+            return 429, None, {'Retry-After': '1'}
+        if self.error_rate and random.random() < self.error_rate:
+            return 503, None, {}
+
+        parsed = urlparse(url)
+        path = parsed.path
+        sku_path = '/%s' % settings.WEBHOOK_RECEIVER_SKU_PREFIX
+        if method == 'POST' and path.endswith('/oauth2/access_token'):
+            return 200, {
+                'access_token': 'stub',
+                'expires_in': 3600,
+            }, {}
+        elif method == 'POST' and path.endswith('/bulk_enroll/'):
+            return 200, self.enroll(body), {}
+        elif path.startswith('/courses/course-v1:'):
+            return 200, None, {}
+        elif method in ('GET', 'HEAD') and path.startswith(sku_path):
+            # The SKU prefix may well be empty, so check this last.
+            sku = path[len(sku_path):]
+            location = '%s://%s/courses/course-v1:org+%s+run/about' % (
+                parsed.scheme, parsed.netloc, sku)
+            return 302, None, {'Location': location}
+        return 404, None, {}
+
+    def enroll(self, body):
+        if isinstance(body, bytes):
+            body = body.decode('utf-8')
+        params = parse_qs(body or '')
+        course_id = params['courses'][0]
+        results = [{'identifier': identifier,
+                    'after': {'enrollment': False, 'allowed': True}}
+                   for identifier in params['identifiers'][0].split(',')]
+        return {
+            'action': 'enroll',
+            'courses': {course_id: {'action': 'enroll',
+                                    'results': results}},
+        }
+
+
+class StubLMSAdapter(BaseAdapter):
+    """A requests transport adapter that lets a StubLMS answer
+    requests in-process."""
+
+    def __init__(self, lms):
+        super().__init__()
+        self.lms = lms
+
+    def send(self, request, **kwargs):
+        status_code, data, headers = self.lms.handle(request.method,
+                                                     request.url,
+                                                     request.body)
+        response = Response()
+        response.status_code = status_code
+        response.headers = CaseInsensitiveDict(headers)
+        content = b''
+        if data is not None:
+            content = json.dumps(data).encode('utf-8')
+            response.headers['Content-Type'] = 'application/json'
+        response._content = content
+        response.raw = io.BytesIO(content)
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+
+    def close(self):
+        pass
+
+
+class StubLMSRequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def respond(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        url = 'http://%s%s' % (self.headers.get('Host'), self.path)
+        status_code, data, headers = self.server.lms.handle(self.command,
+                                                            url, body)
+        content = b''
+        if data is not None:
+            content = json.dumps(data).encode('utf-8')
+            headers = dict(headers, **{'Content-Type': 'application/json'})
+
+        self.send_response(status_code)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(content)
+
+    do_GET = do_HEAD = do_POST = respond
+
+    def log_message(self, format, *args):
+        logger.debug('%s - %s' % (self.address_string(), format % args))
+
+
+class StubLMSServer(ThreadingMixIn, HTTPServer):
+    """An HTTP server for a StubLMS, which handles every request in a
+    thread of its own."""
+
+    daemon_threads = True
+
+    def __init__(self, address, lms):
+        super().__init__(address, StubLMSRequestHandler)
+        self.lms = lms
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return 'http://%s:%d' % (host, port)
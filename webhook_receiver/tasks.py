@@ -1,8 +1,14 @@
-from celery import Task
+from celery import Task, shared_task
+from celery.exceptions import Ignore
 from celery.utils.log import get_task_logger
 
+from django.conf import settings
 from django.db import transaction
 
+from .archive import archive_webhooks
+from .metrics import count_order
+from .utils import APP_LABEL_PREFIX, get_order_models, get_platform_tasks
+
 logger = get_task_logger(__name__)
 
 
@@ -19,10 +25,39 @@ class OrderTask(Task):
 
         self.order = None
 
+    def defer(self, exc, countdown):
+        """Run this task again in countdown seconds, without counting
+        that against its retries, because exc (such as CircuitOpen)
+        says that trying again any sooner is pointless.
+
+        When running eagerly (as in tests), where we can't schedule
+        anything for later, just raise exc.
+        """
+        if self.request.is_eager or self.request.called_directly:
+            raise exc
+        logger.warning('Deferring order %s by %d seconds: %s' % (
+            self.order.id, countdown, exc))
+        self.signature_from_request(self.request,
+                                    countdown=countdown,
+                                    retries=self.request.retries).apply_async()
+        raise Ignore()
+
+    def get_platform(self):
+        """Return the name of the platform the order comes from."""
+        return self.order._meta.app_label[len(APP_LABEL_PREFIX):]
+
     def on_success(self, retval, task_id, args, kwargs):
         "Success handler: log successful order processing."
+        if self.order.status == self.order.PROCESSING:
+            # The order's line items are waiting for a batched
+            # enrollment, after which settle_orders() counts the
+            # order's outcome.
+            logger.info('Queued order %s for batched '
+                        'enrollment' % self.order.id)
+            return
         logger.info('Successfully processed '
                     'order %s' % self.order.id)
+        count_order(self.get_platform(), 'success')
 
     def on_retry(self, exc, task_id, args, kwargs, einfo):
         """Retry handler: log an exception stack trace and a prose message,
@@ -34,6 +69,7 @@ class OrderTask(Task):
                        '(task ID %s), retrying: %s' % (self.order.id,
                                                        task_id,
                                                        exc))
+        count_order(self.get_platform(), 'retry')
 
     def on_failure(self, exc, task_id, args, kwargs, einfo):
         """Failure handler: log an exception stack trace and a prose message,
@@ -45,6 +81,31 @@ class OrderTask(Task):
                      '(task ID %s): %s' % (self.order.id,
                                            task_id,
                                            exc))
-        self.order.fail()
+        count_order(self.get_platform(), 'failure')
+        self.order.fail(exc)
         with transaction.atomic():
             self.order.save()
+
+
+@shared_task(bind=True)
+def archive(self):
+    """Archive webhooks that are due for archival, if we have an
+    archive directory configured. Meant to be run periodically, via
+    Celery beat."""
+
+    if not settings.WEBHOOK_RECEIVER_ARCHIVE_DIR:
+        logger.debug('No archive directory configured, '
+                     'not archiving webhooks')
+        return 0
+    return archive_webhooks()
+
+
+@shared_task(bind=True)
+def reap(self):
+    """Reschedule orders whose lease has expired, on all platforms.
+    Meant to be run periodically, via Celery beat."""
+
+    reaped = 0
+    for platform, model in sorted(get_order_models().items()):
+        reaped += get_platform_tasks(model).reap_expired_leases()
+    return reaped
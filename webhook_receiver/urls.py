@@ -1,6 +1,8 @@
 from django.contrib import admin
 from django.urls import include, path
 
+from .views import metrics
+
 
 urlpatterns = [
     path('webhooks/shopify/',
@@ -9,4 +11,7 @@ urlpatterns = [
          include('webhook_receiver_woocommerce.urls')),
     path('admin/',
          admin.site.urls),
+    path('metrics',
+         metrics,
+         name='metrics'),
 ]
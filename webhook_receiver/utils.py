@@ -1,24 +1,58 @@
 import base64
+import django
+import functools
 import hashlib
 import hmac
+import importlib
 import json
 import logging
+import operator
 import re
 import requests
+import threading
+import time
 
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 from urllib.parse import urlparse
 
+from django.apps import apps
+from django.core.cache import cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.exceptions import ImproperlyConfigured, ValidationError
 from django.core.validators import validate_email
 from django.conf import settings
-from django.db import transaction
+from django.db import close_old_connections, connection, transaction
+from django.db import IntegrityError
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 
-from edx_rest_api_client.client import OAuthAPIClient
+from celery import current_app
+from django_fsm import ConcurrentTransition
+
+from edx_rest_api_client.auth import SuppliedJwtAuth
+from edx_rest_api_client.client import USER_AGENT
 from ipware import get_client_ip
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+from urllib3.util.retry import Retry
 
-from .models import JSONWebhookData
+from .cache import sku_cache
+from .circuitbreaker import CircuitBreaker
+from .metrics import count_lms_connections, count_lms_response
+from .metrics import count_order, timed
+from .profiling import profiled
+from .ratelimit import AdaptiveRateLimiter
+from .models import CourseMapping, JSONWebhookData, Order, OutboxEntry
 
 
 EDX_BULK_ENROLLMENT_API_PATH = '%s/api/bulk_enroll/v1/bulk_enroll/'
+EDX_OAUTH2_ACCESS_TOKEN_PATH = '%s/oauth2/access_token'
+
+# Platform apps are labeled webhook_receiver_<platform>
+APP_LABEL_PREFIX = 'webhook_receiver_'
 
 logger = logging.getLogger(__name__)
 
@@ -27,53 +61,605 @@ class SKULookupException(Exception):
     pass
 
 
-def receive_json_webhook(request):
-    # Grab data from the request, and save it to the database right
-    # away.
-    data = JSONWebhookData(headers=dict(request.headers),
-                           body=request.body)
-    with transaction.atomic():
-        data.save()
+class MissingWebhookException(Exception):
+    pass
 
-    # Transition the state from NEW to PROCESSING
-    data.start_processing()
-    with transaction.atomic():
-        data.save()
+
+class EnrollmentException(Exception):
+    pass
+
+
+class LMSRetry(Retry):
+    """A urllib3 Retry that calls on_retry with every response it
+    retries on (or None, if there was no response), so that the
+    LMSSession can report it, too."""
+
+    def __init__(self, *args, on_retry=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.on_retry = on_retry
+
+    def new(self, **kwargs):
+        retry = super().new(**kwargs)
+        retry.on_retry = self.on_retry
+        return retry
+
+    def increment(self, method=None, url=None, response=None, error=None,
+                  *args, **kwargs):
+        # This raises MaxRetryError, or the original error, if we won't
+        # retry after all, in which case the session reports the final
+        # outcome itself.
+        retry = super().increment(method, url, response, error,
+                                  *args, **kwargs)
+        if self.on_retry is not None:
+            self.on_retry(response)
+        return retry
+
+
+class LMSSession(requests.Session):
+    """A requests.Session for talking to the LMS.
+
+    It keeps a pool of up to settings.WEBHOOK_RECEIVER_LMS_POOL_SIZE
+    connections, which it keeps alive and reuses; it applies
+    settings.WEBHOOK_RECEIVER_LMS_CONNECT_TIMEOUT and
+    settings.WEBHOOK_RECEIVER_LMS_READ_TIMEOUT to any request that
+    doesn't set its own timeout; and it retries idempotent requests
+    (up to settings.WEBHOOK_RECEIVER_LMS_MAX_RETRIES times, with
+    exponential backoff) on connection errors, and on HTTP 502, 503
+    and 504 responses. If given an AdaptiveRateLimiter and a
+    CircuitBreaker, it also keeps to the rate limit, fails fast while
+    the circuit is open, and reports every response to both,
+    including those it retries on. It counts how many requests open
+    new connections, and how many reuse one, in the metrics.
+    """
+
+    RETRY_STATUSES = (502, 503, 504)
+
+    def __init__(self, limiter=None, breaker=None):
+        super().__init__()
+        self.limiter = limiter
+        self.breaker = breaker
+        self.headers['User-Agent'] = USER_AGENT
+        self.timeout = (settings.WEBHOOK_RECEIVER_LMS_CONNECT_TIMEOUT,
+                        settings.WEBHOOK_RECEIVER_LMS_READ_TIMEOUT)
+
+        retry = LMSRetry(
+            total=settings.WEBHOOK_RECEIVER_LMS_MAX_RETRIES,
+            backoff_factor=settings.WEBHOOK_RECEIVER_LMS_RETRY_BACKOFF,
+            status_forcelist=self.RETRY_STATUSES,
+            raise_on_status=False,
+            on_retry=self.record_retry,
+        )
+        self.adapter = HTTPAdapter(
+            pool_connections=settings.WEBHOOK_RECEIVER_LMS_POOL_SIZE,
+            pool_maxsize=settings.WEBHOOK_RECEIVER_LMS_POOL_SIZE,
+            max_retries=retry,
+        )
+        self.mount('http://', self.adapter)
+        self.mount('https://', self.adapter)
+
+        self._counted = self.connection_stats()
+        self._counted_lock = threading.Lock()
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        probe = False
+        if self.breaker is not None:
+            probe = self.breaker.before_request()
+        if self.limiter is not None:
+            try:
+                self.limiter.acquire()
+            except Exception:
+                # We're not sending the probe after all, so don't keep
+                # everyone else from probing until it times out.
+                if probe:
+                    self.breaker.release_probe()
+                raise
+
+        response = None
+        try:
+            response = super().request(method, url, **kwargs)
+        finally:
+            # If we got no response, report that as a failure.
+            self.record(response, probe=probe)
+            self.count_connections()
+        return response
+
+    def record(self, response, probe=False):
+        """Report a response from the LMS (or the failure to get one,
+        if response is None) to the metrics, the rate limiter, and the
+        circuit breaker."""
+        count_lms_response(response)
+        if self.limiter is not None:
+            self.limiter.record(response)
+        if self.breaker is not None:
+            self.breaker.record(response, probe=probe)
+
+    def record_retry(self, response):
+        """Report a urllib3 response that we are about to retry on,
+        or None, if we are retrying after getting no response.
+
+        A probe is only settled by the final response, so we report
+        these as regular requests."""
+        if response is not None:
+            retried = requests.Response()
+            retried.status_code = response.status
+            response = retried
+        self.record(response)
+
+    def connection_stats(self):
+        """Return how many connections we have opened, and how many
+        requests we have sent over them, for the connection pools
+        that are currently alive."""
+        pools = self.adapter.poolmanager.pools
+        num_connections = num_requests = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            num_connections += pool.num_connections
+            num_requests += pool.num_requests
+        return {
+            'connections': num_connections,
+            'requests': num_requests,
+            'reused': max(num_requests - num_connections, 0),
+        }
+
+    def count_connections(self):
+        """Count the connections that our pools have opened, and the
+        requests they have sent, since we last counted them, in the
+        metrics."""
+        stats = self.connection_stats()
+        with self._counted_lock:
+            # If a pool was discarded, its counts are gone, too.
+            opened = max(stats['connections'] - self._counted['connections'],
+                         0)
+            sent = max(stats['requests'] - self._counted['requests'], 0)
+            self._counted = stats
+        count_lms_connections(opened, max(sent - opened, 0))
+
+
+class LMSClient(object):
+    """An OAuth2-authenticated HTTP client for the Open edX LMS.
+
+    Unlike edx_rest_api_client's OAuthAPIClient, which we would
+    otherwise instantiate for every request, an LMSClient is meant to
+    be long-lived: it keeps a single LMSSession (so that
+    connections to the LMS are kept alive and reused), and it caches
+    its client-credentials access token until shortly before the
+    token expires. Use get_lms_client() to get the shared instance.
+    """
+
+    def __init__(self, base_url, client_id, client_secret):
+        self.base_url = base_url.rstrip('/')
+        self.client_id = client_id
+        self.client_secret = client_secret
+
+        self.session = LMSSession(
+            limiter=AdaptiveRateLimiter(self.base_url),
+            breaker=CircuitBreaker(self.base_url),
+        )
+
+        self.token_requests = 0
+        self._token = None
+        self._token_expires = 0
+        self._token_lock = threading.Lock()
+
+    def get_access_token(self, refresh=False):
+        """Return a valid access token, fetching a new one if we don't
+        have one yet, if ours is about to expire, or if refresh is
+        True."""
+        with self._token_lock:
+            expired = time.monotonic() >= self._token_expires
+            if refresh or expired or self._token is None:
+                self._fetch_access_token()
+            return self._token
+
+    def _fetch_access_token(self):
+        token_url = EDX_OAUTH2_ACCESS_TOKEN_PATH % self.base_url
+        logger.debug('Requesting access token from %s' % token_url)
+        self.token_requests += 1
+        response = self.session.post(
+            token_url,
+            data={
+                'grant_type': 'client_credentials',
+                'client_id': self.client_id,
+                'client_secret': self.client_secret,
+                'token_type': 'jwt',
+            },
+        )
+        response.raise_for_status()
+        token_data = response.json()
+
+        # Consider the token expired a little early, so that we never
+        # send a request with a token that expires while in flight.
+        expires_in = token_data['expires_in']
+        margin = min(settings.WEBHOOK_RECEIVER_OAUTH2_TOKEN_EXPIRY_MARGIN,
+                     expires_in / 2)
+        self._token = token_data['access_token']
+        self._token_expires = time.monotonic() + expires_in - margin
+
+    def request(self, method, url, **kwargs):
+        """Send an authenticated request to the LMS.
+
+        If the LMS rejects our access token with HTTP 401 (for
+        example, because it has been revoked), fetch a new token and
+        retry the request once.
+        """
+        token = self.get_access_token()
+        response = self.session.request(method, url,
+                                        auth=SuppliedJwtAuth(token),
+                                        **kwargs)
+        if response.status_code == 401:
+            logger.warning('Request to %s was rejected with HTTP 401, '
+                           'retrying with a new access token' % url)
+            token = self.get_access_token(refresh=True)
+            response = self.session.request(method, url,
+                                            auth=SuppliedJwtAuth(token),
+                                            **kwargs)
+        return response
+
+    def post(self, url, data=None, **kwargs):
+        return self.request('POST', url, data=data, **kwargs)
+
+    def head(self, url, **kwargs):
+        """Send an unauthenticated HEAD request to the LMS."""
+        return self.session.head(url, **kwargs)
+
+    def connection_stats(self):
+        return self.session.connection_stats()
+
+    def close(self):
+        self.session.close()
+
+
+_lms_clients = {}
+_lms_clients_lock = threading.Lock()
+
+
+def get_lms_client():
+    """Return the process-wide LMSClient for the configured LMS and
+    OAuth2 credentials, creating it on first use."""
+    key = (settings.WEBHOOK_RECEIVER_LMS_BASE_URL,
+           settings.WEBHOOK_RECEIVER_EDX_OAUTH2_KEY,
+           settings.WEBHOOK_RECEIVER_EDX_OAUTH2_SECRET)
+    with _lms_clients_lock:
+        client = _lms_clients.get(key)
+        if client is None:
+            client = _lms_clients[key] = LMSClient(*key)
+    return client
+
+
+def reset_lms_clients():
+    """Close all LMS clients, discarding their cached access tokens."""
+    with _lms_clients_lock:
+        for client in _lms_clients.values():
+            client.close()
+        _lms_clients.clear()
+
+
+def receive_json_webhook(request, single_write=None):
+    """Record an incoming webhook, and parse its payload as JSON.
+
+    By default, the webhook is saved to the database right away, and
+    then again on every state change. If single_write is True (or
+    settings.WEBHOOK_RECEIVER_SINGLE_WRITE_INGEST is set, and
+    single_write is not given), the webhook is instead only built in
+    memory, and the caller's subsequent fail_and_save() or
+    finish_and_save() persists it exactly once, in its final state.
+    """
+    if single_write is None:
+        single_write = settings.WEBHOOK_RECEIVER_SINGLE_WRITE_INGEST
 
     # Look up the source IP
     ip, is_routable = get_client_ip(request)
     if ip is None:
-        logger.warning("Unable to get client IP for webhook %s" % data.id)
-    data.source = ip
-    with transaction.atomic():
-        data.save()
+        logger.warning("Unable to get client IP for incoming webhook")
+
+    # Grab data from the request.
+    data = JSONWebhookData(headers=dict(request.headers),
+                           body=request.body,
+                           source=ip)
+
+    if single_write:
+        # Transition the state from NEW to PROCESSING, without
+        # touching the database.
+        data.start_processing()
+    else:
+        # Save the webhook to the database right away, and then again
+        # on transitioning the state from NEW to PROCESSING.
+        with transaction.atomic():
+            data.save()
+        data.start_processing()
+        with transaction.atomic():
+            data.save()
 
     # Parse the payload as JSON
     try:
-        try:
-            data.content = json.loads(data.body)
-        except TypeError:
-            # Python <3.6 can't call json.loads() on a byte string
-            data.content = json.loads(data.body.decode('utf-8'))
+        with profiled('parse'):
+            try:
+                data.payload = json.loads(data.body)
+            except TypeError:
+                # Python <3.6 can't call json.loads() on a byte string
+                data.payload = json.loads(data.body.decode('utf-8'))
     except Exception:
         # For any other exception, set the state to ERROR and then
         # throw the exception up the stack.
         fail_and_save(data)
         raise
 
+    data.content_mode, data.content = get_stored_content(data.payload)
+
     return data
 
 
+# The parts of a webhook payload that we need for processing orders:
+# for each top-level key, either None (keep the whole value), or the
+# keys to keep in the value (or, for a list, in each of its items).
+MINIMAL_CONTENT_FIELDS = {
+    'id': None,
+    'date_paid_gmt': None,
+    'customer': ('email', 'first_name', 'last_name'),
+    'billing': ('email', 'first_name', 'last_name'),
+    'line_items': ('sku', 'properties', 'meta_data'),
+}
+
+
+def get_stored_content(payload):
+    """Return what to store as a webhook's content, according to
+    settings.WEBHOOK_RECEIVER_STORE_CONTENT: the full payload
+    ("full"), the parts of it that we need for processing orders
+    ("minimal"), or nothing ("none"). The full payload is always
+    available from the webhook body.
+
+    Return it along with the content mode to record for it, which says
+    which of these it is.
+    """
+    mode = settings.WEBHOOK_RECEIVER_STORE_CONTENT
+    if mode == 'none':
+        return JSONWebhookData.NO_CONTENT, None
+    if mode != 'minimal' or not isinstance(payload, dict):
+        return JSONWebhookData.FULL_CONTENT, payload
+
+    def prune(value, keys):
+        if keys is None:
+            return value
+        if isinstance(value, list):
+            return [prune(v, keys) for v in value]
+        if isinstance(value, dict):
+            return dict((k, v) for k, v in value.items() if k in keys)
+        return value
+
+    return JSONWebhookData.MINIMAL_CONTENT, dict(
+        (key, prune(payload[key], keys))
+        for key, keys in MINIMAL_CONTENT_FIELDS.items()
+        if key in payload
+    )
+
+
+def get_delivery_id(request, platform, header):
+    """Return the platform's ID for the delivery of a webhook, from
+    the given request header, prefixed with the platform name. Return
+    None if the request doesn't have that header."""
+    delivery_id = request.headers.get(header)
+    if not delivery_id:
+        return None
+    return '%s:%s' % (platform, delivery_id)
+
+
+def get_delivery_cache_key(delivery_id):
+    # Hash the delivery ID, so that the key is safe to use with
+    # memcached regardless of what characters it contains.
+    digest = hashlib.sha1(delivery_id.encode('utf-8')).hexdigest()
+    return 'webhook_receiver:delivery:%s' % digest
+
+
+def remember_delivery(delivery_id):
+    timeout = settings.WEBHOOK_RECEIVER_DELIVERY_CACHE_TIMEOUT
+    if timeout <= 0:
+        return
+    try:
+        cache.set(get_delivery_cache_key(delivery_id), True, timeout)
+    except Exception as e:
+        logger.warning('Unable to cache delivery %s: %s' % (delivery_id, e))
+
+
+def is_duplicate_delivery(delivery_id):
+    """Return True if we have already accepted a webhook with
+    delivery_id.
+
+    We check the cache first, and only query the database on a cache
+    miss. The unique constraint on JSONWebhookData.delivery_id
+    remains the authority, for deliveries that arrive concurrently.
+    """
+    if not delivery_id or \
+       not settings.WEBHOOK_RECEIVER_DEDUPLICATE_DELIVERIES:
+        return False
+
+    try:
+        if cache.get(get_delivery_cache_key(delivery_id)):
+            return True
+    except Exception as e:
+        logger.warning('Unable to read delivery %s from cache: %s' % (
+            delivery_id, e))
+
+    duplicate = JSONWebhookData.objects.filter(
+        delivery_id=delivery_id
+    ).exists()
+    if duplicate:
+        remember_delivery(delivery_id)
+    return duplicate
+
+
 def fail_and_save(data):
     data.fail()
     with transaction.atomic():
         data.save()
 
 
-def finish_and_save(data):
+def finish_and_save(data, delivery_id=None):
+    """Mark the webhook data as processed, and save it, recording
+    delivery_id if given. Return False if we've already accepted a
+    webhook with the same delivery_id (in which case the data is
+    saved without one), True otherwise.
+
+    If called within a transaction, we only remember delivery_id in
+    the cache once that transaction commits.
+    """
     data.finish_processing()
+    if settings.WEBHOOK_RECEIVER_DEDUPLICATE_DELIVERIES:
+        data.delivery_id = delivery_id
+    try:
+        with transaction.atomic():
+            data.save()
+    except IntegrityError:
+        if not data.delivery_id:
+            raise
+        # We lost a race with a concurrent delivery of the same
+        # webhook.
+        data.delivery_id = None
+        with transaction.atomic():
+            data.save()
+        transaction.on_commit(lambda: remember_delivery(delivery_id))
+        return False
+    if data.delivery_id:
+        transaction.on_commit(lambda: remember_delivery(delivery_id))
+    return True
+
+
+def accept_delivery(data, delivery_id):
+    """Record delivery_id for the webhook data, which must already be
+    saved, so that we ignore redeliveries from now on. Call this only
+    once we've done everything the webhook requires, so that if that
+    fails, we process the sender's redelivery. Return False if we've
+    meanwhile accepted another webhook with the same delivery_id,
+    True otherwise."""
+    if not delivery_id or \
+       not settings.WEBHOOK_RECEIVER_DEDUPLICATE_DELIVERIES:
+        return True
+    data.delivery_id = delivery_id
+    try:
+        with transaction.atomic():
+            data.save(update_fields=['delivery_id'])
+    except IntegrityError:
+        # A concurrent delivery of the same webhook got there first.
+        data.delivery_id = None
+        return False
+    finally:
+        transaction.on_commit(lambda: remember_delivery(delivery_id))
+    return True
+
+
+def enqueue_webhook(data, task, **kwargs):
+    """Add a task to the outbox, to be published for the webhook data
+    by relay_outbox()."""
     with transaction.atomic():
-        data.save()
+        return OutboxEntry.objects.create(webhook=data,
+                                          task=task.name,
+                                          kwargs=dict(kwargs,
+                                                      webhook_id=data.id))
+
+
+def finish_and_enqueue(data, delivery_id, task, **kwargs):
+    """Mark the webhook data as processed, save it with delivery_id
+    (see finish_and_save()), and add a task for it to the outbox (see
+    enqueue_webhook()), all in one transaction. So if adding the task
+    fails, the webhook remains unfinished, and its delivery
+    unaccepted, so that the sender's redelivery gets processed.
+
+    Return False, without adding a task, if we've already accepted a
+    webhook with the same delivery_id, True otherwise.
+    """
+    with transaction.atomic():
+        if not finish_and_save(data, delivery_id):
+            return False
+        enqueue_webhook(data, task, **kwargs)
+    return True
+
+
+def relay_outbox(batch_size=None):
+    """Publish up to batch_size tasks from the outbox, and remove them
+    from it. Return the number of tasks published.
+
+    Entries stay locked until we've published all of them, so several
+    relays can run in parallel. If publishing a task fails, the whole
+    batch stays in the outbox, so some of its tasks may be published
+    twice. That's OK, because processing a webhook is idempotent.
+    """
+    if batch_size is None:
+        batch_size = settings.WEBHOOK_RECEIVER_OUTBOX_BATCH_SIZE
+
+    with transaction.atomic():
+        entries = OutboxEntry.objects.order_by('id')
+        if connection.features.has_select_for_update_skip_locked:
+            entries = entries.select_for_update(skip_locked=True)
+        else:
+            entries = entries.select_for_update()
+        entries = list(entries[:batch_size])
+
+        for entry in entries:
+            # Look the task up in the registry (rather than using
+            # send_task()), so that this also works in always-eager
+            # mode.
+            current_app.tasks[entry.task].apply_async(kwargs=entry.kwargs)
+
+        OutboxEntry.objects.filter(
+            id__in=[entry.id for entry in entries]
+        ).delete()
+
+    if entries:
+        logger.info('Relayed %d tasks from the outbox' % len(entries))
+    return len(entries)
+
+
+def recompress_webhook_bodies(compression=None, batch_size=1000,
+                              max_batches=None):
+    """Rewrite the stored bodies of webhooks with compression (by
+    default, settings.WEBHOOK_RECEIVER_BODY_COMPRESSION), batch_size
+    rows at a time. Return a tuple of the number of webhooks examined
+    and the number of them we rewrote.
+
+    We read and write the stored bodies with raw SQL, bypassing
+    CompressedBinaryField, so that we can tell how each of them is
+    stored, and leave alone those already stored as we want them.
+    """
+    if compression is None:
+        compression = settings.WEBHOOK_RECEIVER_BODY_COMPRESSION
+
+    field = JSONWebhookData._meta.get_field('body')
+    pk = JSONWebhookData._meta.pk
+    quote = connection.ops.quote_name
+    table = quote(JSONWebhookData._meta.db_table)
+    select = 'SELECT %s, %s FROM %s WHERE %s > %%s ORDER BY %s LIMIT %%s' % (
+        quote(pk.column), quote(field.column), table,
+        quote(pk.column), quote(pk.column)
+    )
+    update = 'UPDATE %s SET %s = %%s WHERE %s = %%s' % (
+        table, quote(field.column), quote(pk.column)
+    )
+
+    examined = rewritten = batches = 0
+    last_id = 0
+    while max_batches is None or batches < max_batches:
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(select, [last_id, batch_size])
+                rows = cursor.fetchall()
+                for webhook_id, stored in rows:
+                    stored = bytes(stored)
+                    body = field.decompress(stored)
+                    value = field.compress(body, compression)
+                    if value != stored:
+                        cursor.execute(update, [value, webhook_id])
+                        rewritten += 1
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        examined += len(rows)
+        batches += 1
+        logger.info('Recompressed webhook bodies up to ID %s' % last_id)
+
+    return examined, rewritten
 
 
 def get_hmac(key, body):
@@ -87,23 +673,87 @@ def hmac_is_valid(key, body, hmac_to_verify):
     return get_hmac(key, body) == hmac_to_verify
 
 
+COURSE_ID_REGEX = 'course-v1:[^/]+'
+
+
+@timed('lms', operation='lookup_course_id')
 def lookup_course_id(sku):
     """Look up the course ID for a SKU"""
-    course_id_regex = 'course-v1:[^/]+'
 
     # If the SKU we're given matches the regex from the beginning of
     # its string, great. It looks like a course ID, use it verbatim.
-    if re.match(course_id_regex, sku):
+    if re.match(COURSE_ID_REGEX, sku):
         return sku
 
-    # OK, the SKU does not look like a course ID. So, expect to be
-    # able to look up the actual course ID via an HTTP redirect.
+    # Next, see if we've recently resolved the same SKU.
+    cached = sku_cache.get(sku)
+    if cached:
+        logger.debug('Resolved SKU %s to cached '
+                     'course ID %s.' % (sku, cached))
+        return cached
+
+    # Then, see if we have a stored mapping for the SKU. We check
+    # that even if we've recently failed to resolve the SKU, so that
+    # a mapping that was added since then takes effect right away.
+    mapping = CourseMapping.objects.filter(sku=sku).first()
+    if mapping:
+        logger.debug('Resolved SKU %s to mapped '
+                     'course ID %s.' % (sku, mapping.course_id))
+        sku_cache.set(sku, mapping.course_id)
+        return mapping.course_id
+
+    if cached == sku_cache.NOT_FOUND:
+        raise SKULookupException('Unable to find a course ID '
+                                 'matching SKU %s (cached)' % sku)
+
+    # Otherwise, resolve the SKU, and record and cache the
+    # result. Don't cache HTTP errors, as they may well be transient.
+    try:
+        course_id = resolve_course_id(sku)
+    except SKULookupException:
+        sku_cache.set(sku, sku_cache.NOT_FOUND)
+        raise
+    if settings.WEBHOOK_RECEIVER_RECORD_COURSE_MAPPINGS:
+        record_course_mapping(sku, course_id, CourseMapping.RESOLVED)
+    sku_cache.set(sku, course_id)
+    return course_id
+
+
+def record_course_mapping(sku, course_id, origin=CourseMapping.MANUAL):
+    """Store the course ID for a SKU, replacing any course ID we
+    previously stored for it. Return True if this changed the
+    mapping."""
+    mapping, created = CourseMapping.objects.get_or_create(
+        sku=sku,
+        defaults={
+            'course_id': course_id,
+            'origin': origin,
+        }
+    )
+    if created:
+        logger.info('Mapped SKU %s to course ID %s.' % (sku, course_id))
+        return True
+    if mapping.course_id == course_id:
+        return False
+    logger.info('Remapped SKU %s from course ID %s '
+                'to %s.' % (sku, mapping.course_id, course_id))
+    mapping.course_id = course_id
+    mapping.origin = origin
+    mapping.save()
+    return True
+
+
+def resolve_course_id(sku):
+    """Resolve a SKU to a course ID, by looking it up on the LMS"""
+
+    # The SKU does not look like a course ID. So, expect to be able
+    # to look up the actual course ID via an HTTP redirect.
     lookup_url = '%s/%s%s' % (settings.WEBHOOK_RECEIVER_LMS_BASE_URL,
                               settings.WEBHOOK_RECEIVER_SKU_PREFIX,
                               sku)
     logger.debug('Resolving SKU %s by looking up %s.' % (sku, lookup_url))
-    resp = requests.head(lookup_url,
-                         allow_redirects=True)
+    resp = get_lms_client().head(lookup_url,
+                                 allow_redirects=True)
     resp.raise_for_status()
 
     # The redirect could point to anywhere in the course: the course
@@ -113,7 +763,7 @@ def lookup_course_id(sku):
     # "course-v1" up to and excluding the next slash, if there is one.
     logger.debug('Resolving SKU %s returned URL %s.' % (sku, resp.url))
     path = urlparse(resp.url).path
-    matches = re.findall(course_id_regex,
+    matches = re.findall(COURSE_ID_REGEX,
                          path)
 
     # We've found a match, great. Evidently this redirect helped us to
@@ -130,6 +780,7 @@ def lookup_course_id(sku):
                              'matching SKU %s' % sku)
 
 
+@timed('lms', operation='enroll_in_course')
 def enroll_in_course(
         course_id,
         email,
@@ -145,25 +796,66 @@ def enroll_in_course(
     # Raises ValidationError if invalid
     validate_email(email)
 
-    client = OAuthAPIClient(
-        settings.WEBHOOK_RECEIVER_LMS_BASE_URL,
-        settings.WEBHOOK_RECEIVER_EDX_OAUTH2_KEY,
-        settings.WEBHOOK_RECEIVER_EDX_OAUTH2_SECRET,
-    )
-
-    bulk_enroll_url = EDX_BULK_ENROLLMENT_API_PATH % settings.WEBHOOK_RECEIVER_LMS_BASE_URL  # noqa: E501
-
     # The bulk enrollment API allows us to enroll multiple identifiers
     # at once, using a comma-separated list for the courses and
-    # identifiers parameters. We deliberately want to process
+    # identifiers parameters. Here, we deliberately want to process
     # enrollments one by one, so we use a single request for each
-    # course/identifier combination.
+    # course/identifier combination. (For the alternative, see
+    # bulk_enroll_in_course().)
+    post_bulk_enrollment(course_id, [email], send_email, auto_enroll)
+
+
+@timed('lms', operation='bulk_enroll_in_course')
+def bulk_enroll_in_course(
+        course_id,
+        emails,
+        send_email=settings.WEBHOOK_RECEIVER_SEND_ENROLLMENT_EMAIL,
+        auto_enroll=settings.WEBHOOK_RECEIVER_AUTO_ENROLL
+):
+    """
+    Auto-enroll several emails in a course, using a single request.
+
+    Return the set of emails that the LMS reports as successfully
+    enrolled (or, for learners that don't have an account yet, as
+    allowed to enroll).
+    """
+
+    # Raises ValidationError if invalid
+    for email in emails:
+        validate_email(email)
+
+    response_data = post_bulk_enrollment(course_id, emails,
+                                         send_email, auto_enroll)
+
+    # The response contains a result for each identifier that we've
+    # sent, which flags the identifier if it's invalid, or if the LMS
+    # couldn't enroll it.
+    course_data = response_data.get('courses', {}).get(course_id, {})
+    enrolled = set()
+    for result in course_data.get('results', []):
+        if result.get('invalidIdentifier') or result.get('error'):
+            logger.error('Unable to enroll %s '
+                         'in course %s: %s' % (result.get('identifier'),
+                                               course_id,
+                                               result))
+            continue
+        enrolled.add(result.get('identifier'))
+    return enrolled
+
+
+def post_bulk_enrollment(course_id, emails, send_email, auto_enroll):
+    """Send a request to the bulk enrollment API, and return the
+    response data."""
+    client = get_lms_client()
+
+    bulk_enroll_url = EDX_BULK_ENROLLMENT_API_PATH % settings.WEBHOOK_RECEIVER_LMS_BASE_URL  # noqa: E501
+
     request_params = {
         "auto_enroll": auto_enroll,
         "email_students": send_email,
         "action": "enroll",
         "courses": course_id,
-        "identifiers": email,
+        "identifiers": ','.join(emails),
     }
 
     logger.debug("Sending POST request "
@@ -180,7 +872,8 @@ def enroll_in_course(
     # HTTP 400: if we've sent a malformed request (for example, one
     #           with a course ID in a format that Open edX can't
     #           parse)
-    # HTTP 401: if our authentication token has expired
+    # HTTP 401: if our authentication token has expired, and
+    #           fetching a new one didn't help either
     # HTTP 403: if our auth token is linked to a user ID that lacks
     #           staff credentials in one of the courses we want to
     #           enroll the learner in
@@ -195,5 +888,492 @@ def enroll_in_course(
     response.raise_for_status()
 
     # If all is well, log the response at the debug level.
+    response_data = response.json()
     logger.debug("Received response from %s: %s " % (bulk_enroll_url,
-                                                     response.json()))
+                                                     response_data))
+    return response_data
+
+
+def get_batch_window():
+    """Return the number of seconds for which to collect order items
+    from several orders into batched enrollments, or 0 if we only
+    batch the items of a single order (or don't batch at all).
+
+    Batching across orders relies on a cache that all workers share,
+    so that only one flush is scheduled per window. Django's dummy
+    cache stores nothing, so with it, every order would schedule a
+    flush of its own; in that case, we rather enroll the items of
+    each order right away.
+    """
+    if not settings.WEBHOOK_RECEIVER_BATCH_ENROLLMENTS:
+        return 0
+    window = settings.WEBHOOK_RECEIVER_BATCH_WINDOW
+    if window and isinstance(caches['default'], DummyCache):
+        logger.warning('Ignoring WEBHOOK_RECEIVER_BATCH_WINDOW, '
+                       'which requires a shared cache')
+        return 0
+    return window
+
+
+def get_order_webhook(order, webhook_id=None):
+    """Return the webhook to process order from: the one with
+    webhook_id, if given, or else the one the order was created from.
+
+    Raise MissingWebhookException if there is no such webhook, which
+    is the case for orders that predate linking orders to their
+    webhooks, and for orders whose webhook has been archived.
+    """
+    if webhook_id is None or webhook_id == order.webhook_id:
+        webhook = order.webhook
+    else:
+        # The order was created from an earlier webhook than the one
+        # we were asked to process.
+        webhook = JSONWebhookData.objects.filter(id=webhook_id).first()
+    if webhook is None:
+        raise MissingWebhookException(
+            'Order %s has no webhook to process it from; restore its '
+            'webhook from the archive to retry it' % order.id)
+    return webhook
+
+
+def record_order_items(order_item_model, order, keys):
+    """Record the line items of an order, given as (sku, email)
+    tuples, and start processing the new ones. Return the
+    OrderItems, in the order of keys, leaving out duplicate keys.
+
+    This takes three queries regardless of the number of line items:
+    one INSERT for all of them (skipping those we've already recorded,
+    by way of the unique constraint on order, SKU and email), one
+    UPDATE to start processing those that are new, and one SELECT to
+    fetch them all.
+    """
+    keys = list(OrderedDict.fromkeys(keys))
+    if not keys:
+        return []
+    with transaction.atomic():
+        order_item_model.objects.bulk_create(
+            [order_item_model(order=order, sku=sku, email=email)
+             for sku, email in keys],
+            ignore_conflicts=True
+        )
+        # Filtering on the status makes this update the equivalent of
+        # start_processing() on every new line item, including the
+        # protection against concurrent transitions. Line items are
+        # keyed on both SKU and email, so match on both.
+        matches_keys = functools.reduce(operator.or_, (
+            Q(sku=sku, email=email) for sku, email in keys
+        ))
+        order_item_model.objects.filter(
+            matches_keys,
+            order=order,
+            status=order_item_model.NEW,
+        ).update(status=order_item_model.PROCESSING)
+
+    recorded = dict(((order_item.sku, order_item.email), order_item)
+                    for order_item in order_item_model.objects.filter(
+                        order=order))
+
+    order_items = []
+    for key in keys:
+        try:
+            order_item = recorded[key]
+        except KeyError:
+            # Some databases silently skip rows that violate other
+            # constraints than the unique one, too.
+            raise IntegrityError('Unable to record line item %s '
+                                 'for order %s' % (key, order.id))
+        if order_item.status == order_item_model.PROCESSED:
+            logger.warning('Order item %s has already '
+                           'been processed, ignoring' % order_item.id)
+        elif order_item.status == order_item_model.ERROR:
+            logger.warning('Order item %s has previously '
+                           'failed to process, ignoring' % order_item.id)
+        order_items.append(order_item)
+    return order_items
+
+
+def enroll_order_items(order_items):
+    """Enroll a number of order items, using one bulk enrollment
+    request per course (and per settings.WEBHOOK_RECEIVER_BATCH_SIZE
+    items).
+
+    Only order items in the PROCESSING state are enrolled. Those that
+    the LMS reports as enrolled are marked PROCESSED; those with an
+    invalid email address or SKU, or that the LMS refuses to enroll,
+    are marked ERROR. Return the list of all order items that are
+    now in the ERROR state.
+
+    If a request to the LMS fails, carry on with the other courses,
+    and then raise the first such exception, leaving the affected
+    order items in the PROCESSING state so that we can retry them.
+    """
+    request_error = None
+
+    # Group order items by course ID.
+    courses = OrderedDict()
+    for order_item in order_items:
+        if order_item.status != order_item.PROCESSING:
+            continue
+        try:
+            validate_email(order_item.email)
+            course_id = lookup_course_id(order_item.sku)
+        except (ValidationError, SKULookupException) as e:
+            logger.error('Unable to enroll order item %s: %s' % (order_item.id,
+                                                                 e))
+            fail_order_item(order_item)
+            continue
+        except RequestException as e:
+            request_error = request_error or e
+            continue
+        courses.setdefault(course_id, []).append(order_item)
+
+    # Enroll each course's order items in batches.
+    batch_size = settings.WEBHOOK_RECEIVER_BATCH_SIZE
+    for course_id, course_items in courses.items():
+        for i in range(0, len(course_items), batch_size):
+            batch = course_items[i:i + batch_size]
+            emails = list(OrderedDict.fromkeys(o.email for o in batch))
+            try:
+                enrolled = bulk_enroll_in_course(course_id, emails)
+            except RequestException as e:
+                request_error = request_error or e
+                continue
+            enrolled = set(email.lower() for email in enrolled)
+            for order_item in batch:
+                if order_item.email.lower() in enrolled:
+                    finish_order_item(order_item)
+                else:
+                    fail_order_item(order_item)
+
+    if request_error is not None:
+        raise request_error
+
+    return [o for o in order_items if o.status == o.ERROR]
+
+
+def enroll_order_items_concurrently(order_items, max_workers):
+    """Enroll a number of order items, with one enrollment request
+    each, but sending up to max_workers requests at a time.
+
+    Only order items in the PROCESSING state are enrolled, and those
+    that are, are marked PROCESSED. All database access happens in
+    the calling thread; only the enrollment requests themselves are
+    sent from a thread pool.
+
+    If looking up a SKU fails, raise that exception right away. If an
+    enrollment fails, carry on with the other order items, and then
+    raise the first such exception, leaving the affected order items
+    in the PROCESSING state so that we can retry them.
+    """
+    pending = [o for o in order_items if o.status == o.PROCESSING]
+    if not pending:
+        return
+
+    # An order usually contains few distinct SKUs, which we most
+    # likely have cached, and looking them up may involve the
+    # database, so we do that here rather than in the pool.
+    course_ids = dict((sku, lookup_course_id(sku))
+                      for sku in OrderedDict.fromkeys(o.sku for o in pending))
+
+    error = None
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [(order_item,
+                    executor.submit(enroll_in_course,
+                                    course_ids[order_item.sku],
+                                    order_item.email))
+                   for order_item in pending]
+        for order_item, future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                logger.error('Unable to enroll order '
+                             'item %s: %s' % (order_item.id, e))
+                error = error or e
+                continue
+            finish_order_item(order_item)
+
+    if error is not None:
+        raise error
+
+
+def finish_order_item(order_item):
+    order_item.finish_processing()
+    try:
+        with transaction.atomic():
+            order_item.save()
+    except ConcurrentTransition:
+        logger.warning('Order item %s was concurrently '
+                       'processed elsewhere' % order_item.id)
+
+
+def fail_order_item(order_item):
+    order_item.fail()
+    try:
+        with transaction.atomic():
+            order_item.save()
+    except ConcurrentTransition:
+        logger.warning('Order item %s was concurrently '
+                       'processed elsewhere' % order_item.id)
+
+
+def flush_pending_enrollments(order_model, order_item_model):
+    """Enroll the items of all orders that are waiting for a batched
+    enrollment, and then finish (or fail) those orders."""
+    order_items = list(order_item_model.objects.filter(
+        status=order_item_model.PROCESSING,
+        order__status=order_model.PROCESSING,
+    ).select_related('order'))
+    if not order_items:
+        return
+
+    logger.info('Enrolling %d pending order items' % len(order_items))
+    orders = dict((o.order_id, o.order) for o in order_items)
+    try:
+        enroll_order_items(order_items)
+    finally:
+        # Even if some enrollment requests failed, some orders may
+        # be complete now.
+        settle_orders(orders.values(), order_item_model)
+
+
+def settle_orders(orders, order_item_model):
+    """Finish the orders whose items have all been processed, and fail
+    those with any failed item, counting either outcome in the
+    metrics. Leave all others as they are."""
+    item_states = defaultdict(set)
+    for order_id, status in order_item_model.objects.filter(
+            order__in=orders).values_list('order_id', 'status'):
+        item_states[order_id].add(status)
+
+    for order in orders:
+        states = item_states[order.id]
+        if states & {order_item_model.NEW, order_item_model.PROCESSING}:
+            continue
+        if order_item_model.ERROR in states:
+            logger.error('Failed to enroll some items of order %s' % order.id)
+            order.fail(EnrollmentException('Failed to enroll some '
+                                           'order items'))
+            outcome = 'failure'
+        else:
+            logger.info('Successfully processed order %s' % order.id)
+            order.finish_processing()
+            outcome = 'success'
+        try:
+            with transaction.atomic():
+                order.save()
+        except ConcurrentTransition:
+            logger.warning('Order %s was concurrently '
+                           'processed elsewhere' % order.id)
+            continue
+        count_order(order._meta.app_label[len(APP_LABEL_PREFIX):], outcome)
+
+
+def retry_orders(orders, order_item_model, task, send_email=False,
+                 rate=None, batch_size=None, countdown=False):
+    """Reset failed orders (and their failed items), and schedule them
+    for processing with task again. Return the number of orders.
+
+    To spare the LMS a stampede, we schedule orders in batches of
+    batch_size (by default, settings.WEBHOOK_RECEIVER_RETRY_BATCH_SIZE),
+    at no more than rate (by default,
+    settings.WEBHOOK_RECEIVER_RETRY_RATE) orders per second. We
+    either wait between batches, or, if countdown is True, schedule
+    them right away, but with increasing countdowns.
+
+    We skip orders that have no webhook to process them from (see
+    get_order_webhook()), because they would only fail again.
+    """
+    if rate is None:
+        rate = settings.WEBHOOK_RECEIVER_RETRY_RATE
+    if batch_size is None:
+        batch_size = settings.WEBHOOK_RECEIVER_RETRY_BATCH_SIZE
+    interval = batch_size / rate if rate > 0 else 0
+
+    orders = orders.filter(status=orders.model.ERROR)
+    missing = orders.filter(webhook__isnull=True).count()
+    if missing:
+        logger.warning('Skipping %d failed orders without a webhook; '
+                       'restore their webhooks to retry them' % missing)
+    orders = orders.filter(webhook__isnull=False).order_by('id')
+    retried = batches = 0
+    last_id = None
+    while True:
+        batch = orders
+        if last_id is not None:
+            batch = batch.filter(id__gt=last_id)
+        batch = list(batch[:batch_size])
+        if not batch:
+            break
+        last_id = batch[-1].id
+
+        if batches and interval and not countdown:
+            time.sleep(interval)
+
+        for order in batch:
+            order.retry()
+            try:
+                with transaction.atomic():
+                    order.save()
+                    # Reset all of the order's failed items in one
+                    # query, rather than transitioning them one by
+                    # one.
+                    order_item_model.objects.filter(
+                        order=order,
+                        status=order_item_model.ERROR,
+                    ).update(status=order_item_model.NEW)
+            except ConcurrentTransition:
+                logger.warning('Order %s was concurrently '
+                               'retried elsewhere' % order.id)
+                continue
+            task.apply_async((order.id, order.webhook_id, send_email),
+                             countdown=batches * interval if countdown else None)  # noqa: E501
+            retried += 1
+
+        logger.info('Scheduled %d failed orders for '
+                    'processing' % len(batch))
+        batches += 1
+
+    return retried
+
+
+def reap_expired_orders(order_model, task, send_email=False,
+                        batch_size=None):
+    """Reschedule up to batch_size (by default,
+    settings.WEBHOOK_RECEIVER_REAP_BATCH_SIZE) orders that we're
+    processing, but whose lease has expired, for processing with task
+    again. Return the number of orders rescheduled.
+
+    Orders that we started processing before we had leases don't have
+    one; we consider those expired once they were received longer
+    than the lease timeout ago. Orders that don't have a webhook to
+    process them from can never complete, so we fail those instead.
+    """
+    if batch_size is None:
+        batch_size = settings.WEBHOOK_RECEIVER_REAP_BATCH_SIZE
+    now = timezone.now()
+    timeout = timedelta(seconds=settings.WEBHOOK_RECEIVER_LEASE_TIMEOUT)
+
+    # Expired leases are found with the (status, lease_expires)
+    # index, and unleased orders with the (status, received) one.
+    expired = Q(lease_expires__lt=now)
+    unleased = Q(lease_expires__isnull=True, received__lt=now - timeout)
+    expired = order_model.objects.filter(
+        expired | unleased,
+        status=order_model.PROCESSING,
+    ).order_by('lease_expires')[:batch_size]
+
+    reaped = 0
+    for order in expired:
+        owner, expires = order.lease_owner, order.lease_expires
+        # Take over the lease, unless someone else (such as another
+        # reaper, or the owner renewing it) got there first.
+        order.set_lease()
+        if expires is None:
+            unchanged = Q(lease_expires__isnull=True)
+        else:
+            unchanged = Q(lease_expires=expires)
+        claimed = order_model.objects.filter(
+            unchanged,
+            pk=order.pk,
+            status=order_model.PROCESSING,
+        ).update(lease_owner=order.lease_owner,
+                 lease_expires=order.lease_expires)
+        if not claimed:
+            continue
+
+        try:
+            get_order_webhook(order)
+        except MissingWebhookException as e:
+            logger.error('Lease of %s on order %s expired at %s, '
+                         'but it has no webhook: failing it' % (
+                             owner or 'unknown owner', order.id, expires))
+            order.fail(e)
+            order.save()
+            continue
+
+        logger.warning('Lease of %s on order %s expired at %s, '
+                       'rescheduling' % (owner or 'unknown owner',
+                                         order.id,
+                                         expires))
+        task.apply_async((order.id, order.webhook_id, send_email))
+        reaped += 1
+
+    return reaped
+
+
+def parse_timestamp(value):
+    """Parse an ISO 8601 date or time, given on the command line."""
+    timestamp = parse_datetime(value)
+    if timestamp is None:
+        date = parse_date(value)
+        if date is None:
+            raise ValueError('Invalid date: %s' % value)
+        timestamp = timezone.datetime(date.year, date.month, date.day)
+    if settings.USE_TZ and timezone.is_naive(timestamp):
+        timestamp = timezone.make_aware(timestamp)
+    return timestamp
+
+
+def get_order_models():
+    """Return the concrete Order models of all installed platform apps,
+    keyed by platform name (the app label without the
+    "webhook_receiver_" prefix, e.g. "shopify")."""
+    return dict((model._meta.app_label[len(APP_LABEL_PREFIX):], model)
+                for model in apps.get_models()
+                if issubclass(model, Order))
+
+
+def get_platform_tasks(order_model):
+    """Return the tasks module of the platform app of order_model."""
+    return importlib.import_module('%s.tasks' % order_model._meta.app_label)
+
+
+def schedule_enrollment_flush(task):
+    """Schedule task (a flush_enrollments task) to run at the end of
+    the batch window, unless it is already scheduled."""
+    window = get_batch_window()
+    if cache.add('webhook_receiver:flush:%s' % task.name, True, window):
+        task.apply_async(countdown=window)
+
+
+def async_webhook_view(view):
+    """Turn a synchronous webhook view into an async one.
+
+    When served via ASGI, Django runs all synchronous views in one
+    shared thread, so a single slow database commit or broker publish
+    holds up every other webhook delivery. The async view instead runs
+    the synchronous one in a thread pool, where it gets its own
+    database connection, and leaves the event loop free to accept
+    more requests in the meantime.
+
+    This requires asgiref, which comes with Django 3.0 and later.
+    """
+    from asgiref.sync import sync_to_async
+
+    def run(request):
+        # Database connections are per thread, and Django only
+        # cleans them up in the thread that handles the request, so
+        # we must take care of our pool threads' connections.
+        close_old_connections()
+        try:
+            return view(request)
+        finally:
+            close_old_connections()
+
+    @functools.wraps(view)
+    async def async_view(request):
+        return await sync_to_async(run, thread_sensitive=False)(request)
+
+    return async_view
+
+
+def get_webhook_view(view):
+    """Return the view to serve webhooks with: view itself or, if
+    settings.WEBHOOK_RECEIVER_ASYNC_VIEWS is enabled, an async view
+    made from it (see async_webhook_view())."""
+    if not settings.WEBHOOK_RECEIVER_ASYNC_VIEWS:
+        return view
+    if django.VERSION < (3, 1):
+        raise ImproperlyConfigured('WEBHOOK_RECEIVER_ASYNC_VIEWS '
+                                   'requires Django 3.1 or later')
+    return async_webhook_view(view)
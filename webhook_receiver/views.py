@@ -0,0 +1,15 @@
+from django.http import Http404, HttpResponse
+from django.views.decorators.http import require_GET
+
+from .metrics import get_registry, is_enabled
+
+
+@require_GET
+def metrics(request):
+    """Export Prometheus metrics, if enabled."""
+    if not is_enabled():
+        raise Http404('Metrics are not enabled')
+
+    from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+    return HttpResponse(generate_latest(get_registry()),
+                        content_type=CONTENT_TYPE_LATEST)
@@ -1,6 +1,33 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+
+from .models import ShopifyOrder
+from .models import ShopifyOrderItem
+from .tasks import retry_failed_orders
+
+
+@admin.register(ShopifyOrder)
+class ShopifyOrderAdmin(admin.ModelAdmin):
+    list_display = ('id', 'email', 'status', 'received', 'last_error')
+    list_filter = ('status',)
+    search_fields = ('id', 'email', 'last_error')
+    actions = ['retry']
+
+    def retry(self, request, queryset):
+        # Don't make the request wait for throttling; schedule the
+        # orders with increasing countdowns instead.
+        count = retry_failed_orders(queryset, countdown=True)
+        self.message_user(request,
+                          'Scheduled %d failed orders for '
+                          'processing.' % count)
+        missing = queryset.filter(status=ShopifyOrder.ERROR,
+                                  webhook__isnull=True).count()
+        if missing:
+            self.message_user(request,
+                              'Skipped %d failed orders without a '
+                              'webhook; restore their webhooks to retry '
+                              'them.' % missing,
+                              level=messages.WARNING)
+    retry.short_description = 'Retry selected failed orders'
 
-from .models import ShopifyOrder, ShopifyOrderItem
 
-admin.site.register(ShopifyOrder)
 admin.site.register(ShopifyOrderItem)
@@ -0,0 +1,21 @@
+# Generated by Django 2.2.28 on 2026-10-17 00:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webhook_receiver_shopify', '0006_add_webhook_fk'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='shopifyorder',
+            index=models.Index(fields=['status', 'received'], name='wr_shopify_order_status_recv'),
+        ),
+        migrations.AddIndex(
+            model_name='shopifyorderitem',
+            index=models.Index(fields=['status', 'order'], name='wr_shopify_item_status_order'),
+        ),
+    ]
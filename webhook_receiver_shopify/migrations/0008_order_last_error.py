@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-17 00:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webhook_receiver_shopify', '0007_status_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='shopifyorder',
+            name='last_error',
+            field=models.CharField(blank=True, default='', max_length=254),
+        ),
+    ]
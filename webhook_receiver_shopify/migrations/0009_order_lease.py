@@ -0,0 +1,27 @@
+# Generated by Django 2.2.28 on 2026-10-17 00:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webhook_receiver_shopify', '0008_order_last_error'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='shopifyorder',
+            name='lease_expires',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='shopifyorder',
+            name='lease_owner',
+            field=models.CharField(blank=True, default='', max_length=254),
+        ),
+        migrations.AddIndex(
+            model_name='shopifyorder',
+            index=models.Index(fields=['status', 'lease_expires'], name='wr_shopify_order_lease'),
+        ),
+    ]
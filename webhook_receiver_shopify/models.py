@@ -1,4 +1,4 @@
-from django.db.models import UniqueConstraint, ForeignKey
+from django.db.models import UniqueConstraint, ForeignKey, Index
 from django.db.models import PROTECT, SET_NULL
 
 from webhook_receiver.models import Order, OrderItem, JSONWebhookData
@@ -11,6 +11,12 @@ class ShopifyOrder(Order):
     class Meta:
         app_label = APP_LABEL
         abstract = False
+        indexes = [
+            Index(fields=['status', 'received'],
+                  name='wr_shopify_order_status_recv'),
+            Index(fields=['status', 'lease_expires'],
+                  name='wr_shopify_order_lease'),
+        ]
 
     webhook = ForeignKey(
         JSONWebhookData,
@@ -24,6 +30,10 @@ class ShopifyOrderItem(OrderItem):
     class Meta:
         app_label = APP_LABEL
         abstract = False
+        indexes = [
+            Index(fields=['status', 'order'],
+                  name='wr_shopify_item_status_order'),
+        ]
         constraints = [
             UniqueConstraint(fields=['order', 'sku', 'email'],
                              name='unique_order_sku_email')
@@ -1,12 +1,25 @@
 from celery import shared_task
 from celery.utils.log import get_task_logger
 
+from django.conf import settings
+from django.db import DatabaseError
+
 from requests.exceptions import HTTPError
 
+from webhook_receiver.circuitbreaker import CircuitOpen
+from webhook_receiver.metrics import observe_queue_lag
+from webhook_receiver.models import JSONWebhookData
+from webhook_receiver.ratelimit import RateLimitExceeded
 from webhook_receiver.tasks import OrderTask
+from webhook_receiver.utils import flush_pending_enrollments
+from webhook_receiver.utils import get_batch_window, retry_orders
+from webhook_receiver.utils import get_order_webhook
+from webhook_receiver.utils import reap_expired_orders
+from webhook_receiver.utils import schedule_enrollment_flush
 
 from .models import ShopifyOrder as Order
-from .utils import process_order
+from .models import ShopifyOrderItem as OrderItem
+from .utils import process_order, record_order
 
 
 logger = get_task_logger(__name__)
@@ -16,15 +29,97 @@ logger = get_task_logger(__name__)
              max_retries=3,
              soft_time_limit=5,
              base=OrderTask,
-             autoretry_for=(HTTPError,))
-def process(self, data, send_email=False):
-    """Parse input data for line items, and create enrollments.
+             autoretry_for=(HTTPError, RateLimitExceeded))
+def process(self, order_id, webhook_id=None, send_email=False):
+    """Parse the webhook payload for the order's line items, and create
+    enrollments.
+
+    The payload is loaded from the database, so that the task message
+    only needs to carry the order and webhook IDs.
 
     On any error, raise the exception in order to be handled by
     on_failure().
     """
 
-    logger.debug('Processing order data: %s' % data)
-    self.order = Order.objects.get(id=data['id'])
+    if isinstance(order_id, dict):
+        # This is a task message queued by an earlier version, which
+        # passed the full webhook payload and the send_email flag as
+        # positional arguments.
+        data = order_id
+        if webhook_id is not None:
+            send_email = webhook_id
+        logger.debug('Processing order data: %s' % data)
+        self.order = Order.objects.get(id=data['id'])
+    else:
+        self.order = Order.objects.select_related(
+            'webhook'
+        ).get(id=order_id)
+        webhook = get_order_webhook(self.order, webhook_id)
+        data = webhook.order_content
+        if not self.request.retries:
+            observe_queue_lag('shopify', webhook.received)
+        logger.debug('Processing order %s '
+                     'from webhook %s' % (self.order.id, webhook.id))
+
+    try:
+        process_order(self.order, data, send_email)
+    except CircuitOpen as e:
+        # Don't waste a retry while the LMS is down.
+        self.defer(e, e.retry_after)
+
+    if get_batch_window():
+        schedule_enrollment_flush(flush_enrollments)
+
+
+@shared_task(bind=True,
+             max_retries=3,
+             autoretry_for=(HTTPError, RateLimitExceeded, CircuitOpen))
+def flush_enrollments(self):
+    """Enroll the line items of all orders waiting for a batched
+    enrollment, and finish those orders."""
+
+    flush_pending_enrollments(Order, OrderItem)
+
+
+@shared_task(bind=True,
+             max_retries=3,
+             autoretry_for=(DatabaseError,))
+def process_webhook(self, webhook_id, send_email=False):
+    """Record the order contained in a webhook that was accepted via
+    the outbox, and schedule it for processing."""
+
+    data = JSONWebhookData.objects.get(id=webhook_id)
+    order, created = record_order(data)
+    if created:
+        logger.info('Created order %s' % order.id)
+    else:
+        logger.info('Retrieved order %s' % order.id)
+
+    if order.status == Order.NEW:
+        logger.info('Scheduling order %s for processing' % order.id)
+        process.delay(order.id, data.id, send_email)
+    else:
+        logger.info('Order %s already processed, '
+                    'nothing to do' % order.id)
+
+
+def retry_failed_orders(orders, **kwargs):
+    """Reset the failed orders among orders, and schedule them for
+    processing again. See webhook_receiver.utils.retry_orders() for
+    the keyword arguments."""
+
+    conf = settings.WEBHOOK_RECEIVER_SETTINGS['shopify']
+    return retry_orders(orders, OrderItem, process,
+                        send_email=conf.get('send_email', True),
+                        **kwargs)
+
+
+def reap_expired_leases(**kwargs):
+    """Reschedule the orders whose lease has expired. See
+    webhook_receiver.utils.reap_expired_orders() for the keyword
+    arguments."""
 
-    process_order(self.order, data, send_email)
+    conf = settings.WEBHOOK_RECEIVER_SETTINGS['shopify']
+    return reap_expired_orders(Order, process,
+                               send_email=conf.get('send_email', True),
+                               **kwargs)
@@ -1,9 +1,13 @@
+from webhook_receiver.utils import get_webhook_view
+
 from .views import order_create
 
 from django.urls import path
 
+view = get_webhook_view(order_create)
+
 urlpatterns = [
     path('order/create',
-         order_create,
+         view,
          name='shopify_order_create'),
 ]
@@ -7,12 +7,16 @@ from django.http import HttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 
+from webhook_receiver.metrics import count_webhooks, timed
 from webhook_receiver.utils import receive_json_webhook, hmac_is_valid
 from webhook_receiver.utils import fail_and_save, finish_and_save
+from webhook_receiver.utils import accept_delivery
+from webhook_receiver.utils import finish_and_enqueue
+from webhook_receiver.utils import get_delivery_id, is_duplicate_delivery
 
 from .utils import record_order
 from .models import Order
-from .tasks import process
+from .tasks import process, process_webhook
 
 
 logger = logging.getLogger(__name__)
@@ -20,12 +24,21 @@ logger = logging.getLogger(__name__)
 
 @csrf_exempt
 @require_POST
+@count_webhooks('shopify')
 def order_create(request):
     # Load configuration
     conf = settings.WEBHOOK_RECEIVER_SETTINGS['shopify']
 
+    # If we've already accepted this delivery of the webhook, the
+    # sender is just retrying it, and we needn't do anything else.
+    delivery_id = get_delivery_id(request, 'shopify', 'X-Shopify-Webhook-Id')
+    if is_duplicate_delivery(delivery_id):
+        logger.info('Ignoring duplicate delivery %s' % delivery_id)
+        return HttpResponse(status=200)
+
     try:
-        data = receive_json_webhook(request)
+        with timed('webhook', platform='shopify', step='receive'):
+            data = receive_json_webhook(request)
     except Exception:
         return HttpResponse(status=400)
 
@@ -48,34 +61,54 @@ def order_create(request):
         fail_and_save(data)
         return HttpResponse(status=400)
 
-    if (not hmac_is_valid(conf['api_key'],
-                          data.body,
-                          hmac)):
+    with timed('webhook', platform='shopify', step='hmac'):
+        valid = hmac_is_valid(conf['api_key'], data.body, hmac)
+    if not valid:
         logger.error('Failed to verify HMAC signature')
         fail_and_save(data)
         return HttpResponse(status=403)
 
+    send_email = True
+    try:
+        send_email = conf['send_email']
+    except KeyError:
+        pass
+
+    # If we're using an outbox, leave everything else to the tasks
+    # that it relays.
+    if settings.WEBHOOK_RECEIVER_OUTBOX:
+        with timed('webhook', platform='shopify', step='enqueue'):
+            queued = finish_and_enqueue(data, delivery_id, process_webhook,
+                                        send_email=send_email)
+        if not queued:
+            logger.info('Ignoring duplicate delivery %s' % delivery_id)
+            return HttpResponse(status=200)
+        logger.info('Queued webhook %s for processing' % data.id)
+        return HttpResponse(status=200)
+
+    # Record the webhook, but only accept its delivery once we've
+    # published the task that processes its order, so that if
+    # anything fails before then, we process the sender's redelivery.
     finish_and_save(data)
 
     # Record order
-    order, created = record_order(data)
+    with timed('webhook', platform='shopify', step='record_order'):
+        order, created = record_order(data)
     if created:
         logger.info('Created order %s' % order.id)
     else:
         logger.info('Retrieved order %s' % order.id)
 
-    send_email = True
-    try:
-        send_email = conf['send_email']
-    except KeyError:
-        pass
-
     # Process order
     if order.status == Order.NEW:
         logger.info('Scheduling order %s for processing' % order.id)
-        process.delay(data.content, send_email)
+        with timed('webhook', platform='shopify', step='publish'):
+            process.delay(order.id, data.id, send_email)
     else:
         logger.info('Order %s already processed, '
                     'nothing to do' % order.id)
 
+    if not accept_delivery(data, delivery_id):
+        logger.info('Delivery %s was concurrently accepted '
+                    'elsewhere' % delivery_id)
     return HttpResponse(status=200)
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-17 00:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webhook_receiver_woocommerce', '0004_status_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='woocommerceorder',
+            name='last_error',
+            field=models.CharField(blank=True, default='', max_length=254),
+        ),
+    ]
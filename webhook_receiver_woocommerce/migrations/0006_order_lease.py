@@ -0,0 +1,27 @@
+# Generated by Django 2.2.28 on 2026-10-17 00:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webhook_receiver_woocommerce', '0005_order_last_error'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='woocommerceorder',
+            name='lease_expires',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='woocommerceorder',
+            name='lease_owner',
+            field=models.CharField(blank=True, default='', max_length=254),
+        ),
+        migrations.AddIndex(
+            model_name='woocommerceorder',
+            index=models.Index(fields=['status', 'lease_expires'], name='wr_woo_order_lease'),
+        ),
+    ]
@@ -1,12 +1,16 @@
+from webhook_receiver.utils import get_webhook_view
+
 from .views import order_create_or_update
 
 from django.urls import path
 
+view = get_webhook_view(order_create_or_update)
+
 urlpatterns = [
     path('order/create',
-         order_create_or_update,
+         view,
          name='woocommerce_order_create'),
     path('order/update',
-         order_create_or_update,
+         view,
          name='woocommerce_order_update'),
 ]
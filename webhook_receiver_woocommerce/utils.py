@@ -2,9 +2,14 @@ from __future__ import unicode_literals
 
 import logging
 
-from django.db import transaction
+from django.conf import settings
+from django.db import IntegrityError, transaction
 
 from webhook_receiver.utils import enroll_in_course, lookup_course_id
+from webhook_receiver.utils import enroll_order_items, get_batch_window
+from webhook_receiver.utils import enroll_order_items_concurrently
+from webhook_receiver.utils import record_order_items
+from webhook_receiver.utils import EnrollmentException
 
 from .models import WooCommerceOrder as Order
 from .models import WooCommerceOrderItem as OrderItem
@@ -14,15 +19,28 @@ logger = logging.getLogger(__name__)
 
 
 def record_order(data):
-    return Order.objects.get_or_create(
-        id=data.content['id'],
-        defaults={
-            'webhook': data,
-            'email': data.content['billing']['email'],
-            'first_name': data.content['billing']['first_name'],
-            'last_name': data.content['billing']['last_name']
-        }
-    )
+    """Record the order from the webhook data, unless we already have.
+    Return the order, and whether we created it.
+
+    We optimistically try to insert the order, so that recording a
+    new order takes a single query, and only fetch the existing order
+    if that fails.
+    """
+    try:
+        with transaction.atomic():
+            return Order.objects.create(
+                id=data.payload['id'],
+                webhook=data,
+                email=data.payload['billing']['email'],
+                first_name=data.payload['billing']['first_name'],
+                last_name=data.payload['billing']['last_name']
+            ), True
+    except IntegrityError:
+        order = Order.objects.filter(id=data.payload['id']).first()
+        if order is None:
+            # We failed to insert the order for some other reason.
+            raise
+        return order, False
 
 
 def process_order(order, data, send_email=False):
@@ -38,6 +56,7 @@ def process_order(order, data, send_email=False):
     if order.status == Order.PROCESSING:
         logger.warning('Order %s is already '
                        'being processed, retrying' % order.id)
+        order.renew_lease()
     else:
         # Start processing the order. A concurrent attempt to access the
         # same order will result in django_fsm.ConcurrentTransition on
@@ -46,14 +65,52 @@ def process_order(order, data, send_email=False):
         with transaction.atomic():
             order.save()
 
-    # Process line items
-    for item in data['line_items']:
-        # Process the line item. If the enrollment throws
-        # an exception, we throw that exception up the stack so we can
-        # attempt to retry order processing.
-        process_line_item(order, item)
-        logger.debug('Successfully processed line item '
-                     '%s for order %s' % (item, order.id))
+    if settings.WEBHOOK_RECEIVER_BATCH_ENROLLMENTS:
+        # Record all line items first, so we can then enroll them in
+        # bulk.
+        order_items = record_line_items(order, data['line_items'])
+
+        if get_batch_window():
+            # Leave the order in the PROCESSING state. The next
+            # flush_enrollments task picks up its line items, along
+            # with those of any other orders received in the meantime,
+            # and finishes the order.
+            logger.debug('Queued line items of order %s '
+                         'for batched enrollment' % order.id)
+            return order
+
+        # If an enrollment request throws an exception, we throw that
+        # exception up the stack so we can attempt to retry order
+        # processing. Line items that the LMS refuses to enroll,
+        # however, fail the order.
+        failed = enroll_order_items(order_items)
+        if failed:
+            raise EnrollmentException('Failed to enroll %d line item(s) '
+                                      'for order %s' % (len(failed),
+                                                        order.id))
+    elif settings.WEBHOOK_RECEIVER_LINE_ITEM_CONCURRENCY > 1:
+        # Record all line items first, then enroll them concurrently.
+        # As when processing them sequentially, any exception from
+        # the LMS goes up the stack so we can retry order processing.
+        order_items = record_line_items(order, data['line_items'])
+        enroll_order_items_concurrently(
+            order_items,
+            settings.WEBHOOK_RECEIVER_LINE_ITEM_CONCURRENCY
+        )
+        failed = [o for o in order_items if o.status == OrderItem.ERROR]
+        if failed:
+            raise EnrollmentException('%d line item(s) of order %s have '
+                                      'previously failed to '
+                                      'process' % (len(failed), order.id))
+    else:
+        # Process line items
+        for order_item in record_line_items(order, data['line_items']):
+            # Process the line item. If the enrollment throws
+            # an exception, we throw that exception up the stack so we
+            # can attempt to retry order processing.
+            process_order_item(order_item)
+            logger.debug('Successfully processed line item '
+                         '%s for order %s' % (order_item.id, order.id))
 
     # Mark the order status
     order.finish_processing()
@@ -66,10 +123,56 @@ def process_order(order, data, send_email=False):
 def process_line_item(order, item):
     """Process a line item of an order.
 
-    Extract sku and properties.email, create an OrderItem, create an
-    enrollment, and mark the OrderItem as processed. Propagate any
+    Record the line item (see record_line_item()), and process the
+    resulting OrderItem (see process_order_item()). Propagate any
     errors, to be handled up the stack.
     """
+    return process_order_item(record_line_item(order, item))
+
+
+def process_order_item(order_item):
+    """Process a recorded line item of an order.
+
+    Create an enrollment, and mark the OrderItem as processed.
+    Propagate any errors, to be handled up the stack.
+    """
+    if order_item.status == OrderItem.PROCESSED:
+        return
+    elif order_item.status == OrderItem.ERROR:
+        raise EnrollmentException('Order item %s has previously '
+                                  'failed to process' % order_item.id)
+
+    # Create an enrollment for the line item
+    course_id = lookup_course_id(order_item.sku)
+    enroll_in_course(course_id, order_item.email)
+
+    # Mark the item as processed
+    order_item.finish_processing()
+    with transaction.atomic():
+        order_item.save()
+
+    return order_item
+
+
+def record_line_items(order, items):
+    """Record the line items of an order.
+
+    Create an OrderItem for each line item (or fetch the existing
+    one), and start processing those that aren't already processed
+    or failed. Return the OrderItems.
+    """
+    return record_order_items(OrderItem, order,
+                              [get_line_item_key(item) for item in items])
+
+
+def record_line_item(order, item):
+    """Record a line item of an order, and return its OrderItem."""
+    return record_line_items(order, [item])[0]
+
+
+def get_line_item_key(item):
+    """Extract sku and the email address from the meta data of a
+    line item of an order, and return them as a tuple."""
 
     # Fetch SKU from the item
     sku = item['sku']
@@ -96,32 +199,4 @@ def process_line_item(order, item):
         except (IndexError, KeyError):
             pass
 
-    # Store line item, prop
-    order_item, created = OrderItem.objects.get_or_create(
-        order=order,
-        sku=sku,
-        email=email
-    )
-
-    if order_item.status == OrderItem.PROCESSED:
-        logger.warning('Order item %s has already '
-                       'been processed, ignoring' % order_item.id)
-        return
-    elif order_item.status == OrderItem.PROCESSING:
-        logger.warning('Order item %s is already '
-                       'being processed, retrying' % order_item.id)
-    else:
-        order_item.start_processing()
-        with transaction.atomic():
-            order_item.save()
-
-    # Create an enrollment for the line item
-    course_id = lookup_course_id(sku)
-    enroll_in_course(course_id, email)
-
-    # Mark the item as processed
-    order_item.finish_processing()
-    with transaction.atomic():
-        order_item.save()
-
-    return order_item
+    return sku, email
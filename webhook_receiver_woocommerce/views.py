@@ -11,11 +11,15 @@ from django.views.decorators.http import require_POST
 
 from ipware import get_client_ip
 
+from webhook_receiver.metrics import count_webhooks, timed
 from webhook_receiver.utils import receive_json_webhook, hmac_is_valid
 from webhook_receiver.utils import fail_and_save, finish_and_save
+from webhook_receiver.utils import accept_delivery
+from webhook_receiver.utils import finish_and_enqueue
+from webhook_receiver.utils import get_delivery_id, is_duplicate_delivery
 from .utils import record_order
 from .models import WooCommerceOrder as Order
-from .tasks import process
+from .tasks import process, process_webhook
 
 
 logger = logging.getLogger(__name__)
@@ -23,6 +27,7 @@ logger = logging.getLogger(__name__)
 
 @csrf_exempt
 @require_POST
+@count_webhooks('woocommerce')
 def order_create_or_update(request):
     # Load configuration
     conf = settings.WEBHOOK_RECEIVER_SETTINGS['woocommerce']
@@ -58,10 +63,19 @@ def order_create_or_update(request):
                                           user_agent))
             return HttpResponse(status=400)
 
+    # If we've already accepted this delivery of the webhook, the
+    # sender is just retrying it, and we needn't do anything else.
+    delivery_id = get_delivery_id(request, 'woocommerce',
+                                  'X-Wc-Webhook-Delivery-Id')
+    if is_duplicate_delivery(delivery_id):
+        logger.info('Ignoring duplicate delivery %s' % delivery_id)
+        return HttpResponse(status=200)
+
     # Here, we're sure that what we got is JSON, so let's start
     # processing it.
     try:
-        data = receive_json_webhook(request)
+        with timed('webhook', platform='woocommerce', step='receive'):
+            data = receive_json_webhook(request)
     except Exception:
         return HttpResponse(status=400)
 
@@ -84,23 +98,20 @@ def order_create_or_update(request):
         fail_and_save(data)
         return HttpResponse(status=400)
 
-    if (not hmac_is_valid(conf['secret'],
-                          data.body,
-                          hmac)):
+    with timed('webhook', platform='woocommerce', step='hmac'):
+        valid = hmac_is_valid(conf['secret'], data.body, hmac)
+    if not valid:
         logger.error('Failed to verify HMAC signature')
         fail_and_save(data)
         return HttpResponse(status=403)
 
-    # OK, we have valid, signed, JSON data. Put that into the
-    # database, so we have a record of the transaction.
-    finish_and_save(data)
-
     # If we require that an order be paid before we can process it,
-    # and it isn't, bail here and wait for the order to be
-    # subsequently updated.
+    # and it isn't, we bail here and wait for the order to be
+    # subsequently updated. In that case, we record the webhook, but
+    # don't consider the delivery accepted.
     require_payment = conf.get('require_payment', False)
+    date_paid_gmt = data.payload.get('date_paid_gmt')
     if require_payment:
-        date_paid_gmt = data.content.get('date_paid_gmt')
         if date_paid_gmt:
             try:
                 parse_date(date_paid_gmt)
@@ -110,26 +121,51 @@ def order_create_or_update(request):
                              'date_paid_gmt: %s' % (data.id,
                                                     date_paid_gmt))
         else:
+            finish_and_save(data)
             logger.warn('Webhook payload %s contains '
                         'empty value for '
                         'date_paid_gmt' % data.id)
             return HttpResponse(status=402)
 
+    send_email = conf.get('send_email', True)
+
+    # If we're using an outbox, leave everything else to the tasks
+    # that it relays.
+    if settings.WEBHOOK_RECEIVER_OUTBOX:
+        with timed('webhook', platform='woocommerce', step='enqueue'):
+            queued = finish_and_enqueue(data, delivery_id, process_webhook,
+                                        send_email=send_email)
+        if not queued:
+            logger.info('Ignoring duplicate delivery %s' % delivery_id)
+            return HttpResponse(status=200)
+        logger.info('Queued webhook %s for processing' % data.id)
+        return HttpResponse(status=200)
+
+    # OK, we have valid, signed, JSON data. Put that into the
+    # database, so we have a record of the transaction. Only accept
+    # its delivery once we've published the task that processes its
+    # order, so that if anything fails before then, we process the
+    # sender's redelivery.
+    finish_and_save(data)
+
     # Record order
-    order, created = record_order(data)
+    with timed('webhook', platform='woocommerce', step='record_order'):
+        order, created = record_order(data)
     if created:
         logger.info('Created order %s' % order.id)
     else:
         logger.info('Retrieved order %s' % order.id)
 
-    send_email = conf.get('send_email', True)
-
     # Process order
     if order.status == Order.NEW:
         logger.info('Scheduling order %s for processing' % order.id)
-        process.delay(data.content, send_email)
+        with timed('webhook', platform='woocommerce', step='publish'):
+            process.delay(order.id, data.id, send_email)
     else:
         logger.info('Order %s already processed, '
                     'nothing to do' % order.id)
 
+    if not accept_delivery(data, delivery_id):
+        logger.info('Delivery %s was concurrently accepted '
+                    'elsewhere' % delivery_id)
     return HttpResponse(status=200)